@@ -0,0 +1,157 @@
+import columnarexport
+import generatebase
+import generatelocation
+import generateorganization
+import generatepractitioner
+import referencedata
+
+from scipy.spatial import cKDTree
+import numpy as np
+import random
+import os
+os.chdir(os.path.dirname(os.path.realpath(__file__)))
+
+NETWORK_KEY = -1
+
+
+def _unit_vectors(lat, long):
+    """Points on the unit sphere. Chord distance between them is monotonic in great-circle distance, so a KD-tree over them finds the nearest clinic exactly."""
+    lat = np.radians(lat)
+    long = np.radians(long)
+    return np.column_stack((np.cos(lat)*np.cos(long), np.cos(lat)*np.sin(long), np.sin(lat)))
+
+
+class ClinicNetwork():
+    def __init__(self, clinics, seed=0):
+        """
+        Network of clinic Organizations and Locations placed at zipcodes of zipcodes.csv, weighted by estimated
+        population. Patients are drawn from the same population weights and assigned to their nearest clinic through a
+        KD-tree, queried once per batch. The network is reproducible from (clinics, seed).
+
+        :param clinics: number of clinics
+        :param seed: run seed
+        """
+        data = referencedata.get()
+        self.lat = data['zipcode_lat']
+        self.long = data['zipcode_long']
+        located = np.flatnonzero(~np.isnan(self.lat) & ~np.isnan(self.long))
+        if clinics > len(located):
+            raise ValueError(f'clinics must be at most {len(located)}')
+        # +1 so zipcodes without a population estimate can still be drawn
+        weights = data['zipcode_population'][located] + 1
+        self.zipcode_rows = located
+        self.zipcode_p = weights/weights.sum()
+
+        self.seed = seed
+        random_state = np.random.RandomState(seed % 2**32)
+        self.clinic_rows = random_state.choice(located, size=clinics, replace=False, p=self.zipcode_p)
+        self.numbers = random_state.randint(1, 9999, clinics)
+        self.streets = random_state.randint(0, len(data['street']), clinics)
+        self.phones = random_state.randint(0, 10000, clinics)
+        self.tree = cKDTree(_unit_vectors(self.lat[self.clinic_rows], self.long[self.clinic_rows]))
+        self.panel_start = None
+        self.Organizations = []
+        self.Locations = []
+        self.Practitioners = []
+
+    def __str__(self):
+        return f'ClinicNetwork:{len(self.clinic_rows)} clinics; practitioners: {len(self.Practitioners)}; committed: {len(self.Organizations)}'
+
+    @staticmethod
+    def __repr__():
+        return 'ClinicNetwork(clinics,seed)'
+
+    def add_panels(self, patients, panel_size=300, panel_shape=4.0):
+        """
+        Staffs every clinic with a fixed pool of practitioners. Each clinic gets enough practitioners for its expected
+        share of the cohort (the population nearest to it); each practitioner gets a panel capacity drawn from a gamma
+        distribution, and patients are assigned in proportion to it.
+
+        :param patients: size of the cohort
+        :param panel_size: mean panel size
+        :param panel_shape: gamma shape of the panel sizes. The coefficient of variation is 1/sqrt(panel_shape).
+        """
+        random_state = np.random.RandomState((self.seed * 15485863 + 1) % 2**32)
+        share = np.bincount(self.assign(self.zipcode_rows), weights=self.zipcode_p, minlength=len(self.clinic_rows))
+        counts = np.maximum(np.ceil(patients*share/panel_size).astype(np.int64), 1)
+        self.panel_clinic = np.repeat(np.arange(len(counts)), counts)
+        self.panel_start = np.concatenate(([0], np.cumsum(counts)))
+        self.panel_capacity = random_state.gamma(panel_shape, panel_size/panel_shape, int(counts.sum()))
+        self._panel_cum = np.concatenate(([0.], np.cumsum(self.panel_capacity)))
+
+    def assign_practitioners(self, clinics, random_state):
+        """
+        Picks a practitioner of each patient's clinic in proportion to panel capacity. One vectorized searchsorted over the cumulative capacities.
+
+        :param clinics: clinic index of each patient
+        :param random_state: numpy RandomState
+        :returns: array of practitioner indexes into Practitioners
+        """
+        first = self.panel_start[clinics]
+        last = self.panel_start[clinics+1] - 1
+        low = self._panel_cum[first]
+        target = low + random_state.random_sample(len(clinics))*(self._panel_cum[last+1] - low)
+        return np.clip(np.searchsorted(self._panel_cum, target, side='right') - 1, first, last)
+
+    def commit(self, graph=None, write=True):
+        """
+        Creates the Organization and Location of every clinic and the practitioners of add_panels(). The resources are keyed under NETWORK_KEY in the run journal and get deterministic identifiers, so every process of a run refers to the same clinics.
+
+        :param graph: ResourceGraph the resources are added to. The graph is run at the end.
+        :param write: writes the resources to GenerateBase.writer. Worker processes pass False as the parent already wrote them.
+        """
+        data = referencedata.get()
+        base = generatebase.GenerateBase
+        writer = base.writer
+        if writer is not None and not write:
+            # identifiers and ids are still assigned; nothing reaches the output files
+            base.writer = columnarexport.DiscardWriter()
+        base.patient_key = NETWORK_KEY
+        base.graph = graph
+        random.seed(f'{self.seed}-network')
+        try:
+            for k, row in enumerate(self.clinic_rows):
+                zipcode, city, state = (data[name][row].item() for name in ('zipcode', 'zipcode_city', 'zipcode_state'))
+                name = f'{city.title()} Family Planning Clinic {k}'
+                line = [f"{self.numbers[k]} {data['street'][self.streets[k]].item()} Street"]
+                Organization = generateorganization.GenerateOrganization(name=name, phone=f'(555) 555-{self.phones[k]:04d}', line=line,
+                                                                         city=city, postal_code=zipcode, state=state, key=f'Clinic{k}/Organization').Organization
+                Location = generatelocation.GenerateLocation(name=name, line=line, city=city, postal_code=zipcode, state=state,
+                                                             latitude=float(self.lat[row]), longitude=float(self.long[row]), Organization=Organization, key=f'Clinic{k}/Location').Location
+                self.Organizations.append(Organization)
+                self.Locations.append(Location)
+            if self.panel_start is not None:
+                for m, k in enumerate(self.panel_clinic):
+                    Practitioner = generatepractitioner.GeneratePractitioner(Organization=self.Organizations[k], Location=self.Locations[k],
+                                                                             key=f'Clinic{k}/Practitioner{m - self.panel_start[k]}').Practitioner
+                    self.Practitioners.append(Practitioner)
+        finally:
+            base.graph = None
+            base.writer = writer
+        if graph is not None:
+            graph.run()
+
+    def assign(self, zipcode_rows):
+        """
+        Nearest clinic of each zipcode. One vectorized KD-tree query, O(log clinics) per zipcode.
+
+        :param zipcode_rows: rows of the referencedata zipcode tables
+        :returns: array of clinic indexes
+        """
+        _, clinics = self.tree.query(_unit_vectors(self.lat[zipcode_rows], self.long[zipcode_rows]))
+        return clinics
+
+    def sample_patients(self, seed, batch_start, batch_size):
+        """
+        Draws the home zipcodes of a batch of patients, assigns each to its nearest clinic and, with add_panels(), to a practitioner of that clinic. Seeded per batch so resumed runs get the same assignment.
+
+        :param seed: run seed
+        :param batch_start: patient_key of the first patient in the batch
+        :param batch_size: number of patients in the batch
+        :returns: tuple of (zipcode rows, clinic indexes, practitioner indexes). Practitioner indexes are None without panels.
+        """
+        random_state = np.random.RandomState((seed * 104729 + batch_start) % 2**32)
+        zipcode_rows = random_state.choice(self.zipcode_rows, size=batch_size, p=self.zipcode_p)
+        clinics = self.assign(zipcode_rows)
+        practitioners = self.assign_practitioners(clinics, random_state) if self.panel_start is not None else None
+        return zipcode_rows, clinics, practitioners
@@ -0,0 +1,70 @@
+import runjournal
+
+import numpy as np
+import os
+os.chdir(os.path.dirname(os.path.realpath(__file__)))
+
+class CohortIndex():
+    GENDERS = np.array(['male', 'female', 'unknown'])
+
+    def __init__(self, rows):
+        """
+        Compact in-memory index of previously generated patients, held as numpy columns so millions of patients can be
+        sampled without Python objects per patient.
+
+        :param rows: iterable of (patient_key, patient_id, organization_id, practitioner_id, family, given, gender, birthdate, zipcode)
+        """
+        columns = list(zip(*rows)) or [()]*9
+        self.patient_key = np.array(columns[0], dtype=np.int64)
+        self.patient_id = np.array(columns[1], dtype=str)
+        self.organization_id = np.array(columns[2], dtype=str)
+        self.practitioner_id = np.array(columns[3], dtype=str)
+        self.family = np.array(columns[4], dtype=str)
+        self.given = np.array(columns[5], dtype=str)
+        gender_codes = {gender: i for i, gender in enumerate(self.GENDERS)}
+        self.gender = np.array([gender_codes.get(gender, 2) for gender in columns[6]], dtype=np.int8)
+        self.birthdate = np.array(columns[7], dtype='datetime64[D]')
+        self.zipcode = np.array(columns[8], dtype=str)
+
+    def __len__(self):
+        return len(self.patient_key)
+
+    def __str__(self):
+        return f'CohortIndex:{len(self)} patients; {self.nbytes()/1e6:.1f} MB'
+
+    @staticmethod
+    def __repr__():
+        return 'CohortIndex(rows)'
+
+    @classmethod
+    def from_journal(cls, path):
+        """Builds the index from the cohort table of a run journal."""
+        journal = runjournal.RunJournal(path)
+        try:
+            return cls(journal.cohort())
+        finally:
+            journal.close()
+
+    def nbytes(self):
+        """Memory used by the index columns."""
+        return sum(v.nbytes for v in vars(self).values() if isinstance(v, np.ndarray))
+
+    def gender_name(self, i):
+        """Returns the FHIR gender of patient i."""
+        return str(self.GENDERS[self.gender[i]])
+
+    def sample(self, n, random_state=None, replace=True):
+        """
+        Samples patients.
+
+        :param n: number of patients
+        :param random_state: numpy RandomState. Default is the global numpy random state.
+        :param replace: samples with replacement. Without, n must be at most len(self).
+        :returns: numpy array of row positions
+        """
+        rs = np.random if random_state is None else random_state
+        if len(self) == 0:
+            raise ValueError('CohortIndex is empty; run fpargenerator with --journal first')
+        if not replace:
+            return rs.choice(len(self), n, replace=False)
+        return rs.randint(0, len(self), n)
@@ -0,0 +1,153 @@
+import os
+os.chdir(os.path.dirname(os.path.realpath(__file__)))
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+if pa is not None:
+    SCHEMAS = {
+        'patients': pa.schema([
+            ('patient_key', pa.int64()), ('patient_id', pa.string()), ('organization_id', pa.string()), ('practitioner_id', pa.string()),
+            ('mrn', pa.string()), ('family', pa.string()), ('given', pa.string()), ('middle', pa.string()), ('gender', pa.string()), ('birthdate', pa.date32()),
+            ('city', pa.string()), ('state', pa.string()), ('zipcode', pa.string()),
+            ('race_code', pa.string()), ('race_display', pa.string()), ('ethnicity_code', pa.string()), ('ethnicity_display', pa.string()),
+            ]),
+        'conditions': pa.schema([
+            ('patient_key', pa.int64()), ('condition_id', pa.string()), ('icd_code', pa.string()), ('icd_description', pa.string()),
+            ]),
+        'encounters': pa.schema([
+            ('patient_key', pa.int64()), ('visit', pa.int64()), ('encounter_id', pa.string()), ('start', pa.string()), ('end', pa.string()),
+            ]),
+        'observations': pa.schema([
+            ('patient_key', pa.int64()), ('visit', pa.int64()), ('name', pa.string()), ('code', pa.string()), ('display', pa.string()), ('value_type', pa.string()),
+            ('value_quantity', pa.float64()), ('unit', pa.string()), ('value_code', pa.string()), ('value_display', pa.string()), ('effective', pa.string()),
+            ]),
+        'labs': pa.schema([
+            ('patient_key', pa.int64()), ('visit', pa.int64()), ('name', pa.string()), ('code', pa.string()), ('display', pa.string()), ('value', pa.string()), ('effective', pa.string()),
+            ]),
+        }
+
+
+def _str(value):
+    return None if value is None else str(value)
+
+
+class ColumnarExporter():
+    def __init__(self, directory, batch_size=65536, compression='zstd'):
+        """
+        Writes the generated FPAR cohort as Parquet tables (patients, conditions, encounters, observations, labs). Rows come straight
+        from the generators' values (GeneratePatient demographics, observation_dict, lab_dict) and are buffered into
+        Arrow record batches of batch_size rows, so tables of any size are written with bounded memory.
+
+        :param directory: output directory. Created if missing.
+        :param batch_size: rows per record batch
+        :param compression: parquet compression codec
+        """
+        if pa is None:
+            raise ImportError('columnar export requires the pyarrow package')
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.batch_size = batch_size
+        self.rows = {table: {name: [] for name in schema.names} for table, schema in SCHEMAS.items()}
+        self.counts = {table: 0 for table in SCHEMAS}
+        self.writers = {table: pq.ParquetWriter(os.path.join(directory, f'{table}.parquet'), schema, compression=compression) for table, schema in SCHEMAS.items()}
+
+    def __str__(self):
+        return f'ColumnarExporter:{self.directory}; rows: {self.counts}'
+
+    @staticmethod
+    def __repr__():
+        return 'ColumnarExporter(directory)'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _append(self, table, **row):
+        columns = self.rows[table]
+        for name, values in columns.items():
+            values.append(row.get(name))
+        if len(columns['patient_key']) >= self.batch_size:
+            self._flush(table)
+
+    def _flush(self, table):
+        columns = self.rows[table]
+        if not columns['patient_key']:
+            return
+        batch = pa.RecordBatch.from_pydict(columns, schema=SCHEMAS[table])
+        self.writers[table].write_batch(batch)
+        self.counts[table] += batch.num_rows
+        for values in columns.values():
+            values.clear()
+
+    def add_patient(self, patient_key, Patient, Condition, Practitioner, observation_dict, lab_dict, observation_times=None, lab_times=None):
+        """
+        Adds one patient's rows to the tables. Reads the records directly; no FHIR objects are built. Longitudinal runs pass observation_dict=None and add every visit with add_visit().
+
+        :param patient_key: position of the patient within the run
+        :param Patient: records.PatientRecord
+        :param Condition: records.ConditionRecord
+        :param Practitioner: records.PractitionerRecord
+        :param observation_dict: vitals observation_dict from GenerateObservationDict
+        :param lab_dict: lab_dict from GenerateFparLabs
+        :param observation_times: effective time of each vitals observation
+        :param lab_times: effective time of each lab
+        """
+        self._append('patients', patient_key=patient_key, patient_id=Patient.id, organization_id=Patient.organization.id, practitioner_id=Practitioner.id,
+            mrn=Patient.mrn, family=Patient.family, given=Patient.given, middle=Patient.middle, gender=Patient.gender, birthdate=Patient.birthdate,
+            city=_str(Patient.city), state=_str(Patient.state), zipcode=_str(Patient.zipcode),
+            race_code=_str(Patient.race_code), race_display=_str(Patient.race_description), ethnicity_code=_str(Patient.ethnicity_code), ethnicity_display=_str(Patient.ethnicity_description))
+        self._append('conditions', patient_key=patient_key, condition_id=Condition.id, icd_code=_str(Condition.icd_code), icd_description=_str(Condition.icd_description))
+        if observation_dict is not None:
+            self.add_visit(patient_key, None, observation_dict, lab_dict, observation_times=observation_times, lab_times=lab_times)
+
+    def add_visit(self, patient_key, visit, observation_dict, lab_dict, observation_times=None, lab_times=None, Encounter=None):
+        """
+        Adds the observations and labs of one visit.
+
+        :param patient_key: position of the patient within the run
+        :param visit: position of the visit within the patient's timeline. None for single visit runs.
+        :param observation_dict: vitals observation_dict from GenerateObservationDict
+        :param lab_dict: lab_dict from GenerateFparLabs
+        :param observation_times: effective time of each vitals observation
+        :param lab_times: effective time of each lab
+        :param Encounter: records.EncounterRecord of the visit
+        """
+        if Encounter is not None:
+            self._append('encounters', patient_key=patient_key, visit=visit, encounter_id=Encounter.id, start=Encounter.start, end=Encounter.end)
+
+        observation_times = observation_times if observation_times is not None else [None]*len(observation_dict)
+        for (name, value), effective in zip(observation_dict.items(), observation_times):
+            row = {'patient_key':patient_key, 'visit':visit, 'name':name, 'code':value['code'], 'display':value['display'], 'value_type':value['type'], 'unit':value.get('unit'), 'effective':_str(effective)}
+            if value['type'] == 'quantity':
+                row['value_quantity'] = None if value['value'] is None else float(value['value'])
+            else:
+                row['value_code'] = _str(value.get('value_loinc'))
+                row['value_display'] = _str(value.get('value_display'))
+            self._append('observations', **row)
+
+        lab_times = lab_times if lab_times is not None else [None]*len(lab_dict)
+        for (name, value), effective in zip(lab_dict.items(), lab_times):
+            self._append('labs', patient_key=patient_key, visit=visit, name=name, code=_str(value['code']), display=_str(value['display']), value=_str(value['value']), effective=_str(effective))
+
+    def close(self):
+        """Writes the remaining rows and closes the parquet files."""
+        for table in SCHEMAS:
+            self._flush(table)
+            self.writers[table].close()
+        return self.counts
+
+
+class DiscardWriter():
+    """Output sink used when only the columnar export is wanted: records get local ids and are never converted to FHIR, posted or written."""
+    # GenerateBase._commit_resource skips the identifiers and the write of writers that discard
+    discards = True
+
+    @staticmethod
+    def write(resource):
+        pass
@@ -0,0 +1,334 @@
+"""
+Converts existing patient, condition and observation tables to FHIR instead of generating random ones. CSV files are read
+in chunks of rows and every row is mapped onto the same records the Generate* classes build (records.PatientRecord,
+ConditionRecord, ObservationRecord), then committed through GenerateBase: written by the active writer or uploaded a
+chunk at a time through a scheduler.ResourceGraph. Memory depends on the chunk size, not on the size of the files.
+
+Identifiers are derived from the source patient_id and the row's natural key, so ingesting the same tables again
+produces the same identifiers and, with --output or --upload-mode put, the same ids.
+"""
+
+import generatebase
+import generateorganization
+import ndjsonwriter
+import ratecontroller
+import records
+import runlog
+import scheduler
+import timestamps
+
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import numpy as np
+import collections
+import hashlib
+import os
+os.chdir(os.path.dirname(os.path.realpath(__file__)))
+
+log = runlog.getLogger('csvingest')
+
+SOURCE_KEY = 'source'
+
+COLUMNS = {
+    'patients': ['patient_id', 'family', 'given', 'middle', 'gender', 'birthdate', 'line', 'city', 'state', 'zipcode',
+                 'race_code', 'race_description', 'ethnicity_code', 'ethnicity_description', 'mrn'],
+    'conditions': ['patient_id', 'condition_id', 'icd_code', 'icd_description'],
+    'observations': ['patient_id', 'observation_id', 'code', 'system', 'display', 'value', 'unit', 'value_code', 'value_system', 'effective'],
+    }
+REQUIRED = {
+    'patients': ['patient_id'],
+    'conditions': ['patient_id', 'icd_code'],
+    'observations': ['patient_id', 'code', 'effective'],
+    }
+GENDERS = {'f': 'female', 'female': 'female', 'w': 'female', 'm': 'male', 'male': 'male', 'o': 'other', 'other': 'other'}
+
+
+def _hash(keys):
+    """64-bit blake2b hashes of a sequence of keys as a numpy uint64 array."""
+    return np.frombuffer(b''.join(hashlib.blake2b(str(key).encode('utf-8'), digest_size=8).digest() for key in keys), dtype=np.uint64)
+
+
+class HashIndex():
+    def __init__(self):
+        """
+        Set of 64-bit key hashes kept as one sorted numpy array, 8 bytes per key. Added hashes are merged into the
+        array on the next lookup.
+        """
+        self._arrays = []
+        self._index = np.zeros(0, dtype=np.uint64)
+
+    def __str__(self):
+        return f'HashIndex:{len(self._index) + sum(len(array) for array in self._arrays)} hashes'
+
+    @staticmethod
+    def __repr__():
+        return 'HashIndex()'
+
+    def add(self, hashes):
+        """Adds a uint64 array of hashes."""
+        self._arrays.append(hashes)
+
+    def contains(self, hashes):
+        """Boolean array, True for the hashes of the index."""
+        if self._arrays:
+            self._index = np.unique(np.concatenate([self._index] + self._arrays))
+            self._arrays = []
+        if not len(self._index):
+            return np.zeros(len(hashes), dtype=bool)
+        positions = np.minimum(np.searchsorted(self._index, hashes), len(self._index)-1)
+        return self._index[positions] == hashes
+
+
+class CsvIngest(generatebase.GenerateBase):
+    def __init__(self, chunk_size=100000, columns=None, executor=None, Organization=None):
+        """
+        Ingests CSV tables. Ingested patients and the identifier keys of the conditions and observations read so far are
+        remembered as sorted arrays of 64-bit hashes (HashIndex), so rows of unknown patients and rows repeated anywhere
+        in the files are rejected whatever the chunk size. Upload ids of patients are kept in memory only when the server assigns
+        them (conditional uploads); with a writer or PUT uploads they are derived from the identifiers.
+
+        :param chunk_size: rows read per chunk
+        :param columns: dictionary of field name: CSV column name for columns named differently from COLUMNS
+        :param executor: ThreadPoolExecutor the chunks are uploaded with. Default uploads sequentially. Not used with a writer.
+        :param Organization: managing OrganizationRecord of the patients. Default leaves out managingOrganization.
+        """
+        self.chunk_size = chunk_size
+        self.columns = columns or {}
+        self.executor = executor
+        self.Organization = Organization
+        self.patient_ids = {}
+        self._ingested = HashIndex()
+        self._seen = HashIndex()
+        self.counts = collections.Counter()
+        self.rejected = collections.Counter()
+
+    def __str__(self):
+        return f'CsvIngest:{dict(self.counts)}; rejected: {sum(self.rejected.values())}'
+
+    @staticmethod
+    def __repr__():
+        return 'CsvIngest()'
+
+    @property
+    def deterministic(self):
+        """True when ids are derived from the identifiers instead of being assigned by the server."""
+        return self.writer is not None or self.upload_mode == 'put'
+
+    def _chunks(self, path, table):
+        """Chunks of a CSV file with the columns renamed to COLUMNS[table]; missing optional columns are None."""
+        sources = {self.columns.get(name, name): name for name in COLUMNS[table]}
+        for chunk in pd.read_csv(path, chunksize=self.chunk_size, dtype=str, usecols=lambda column: column in sources, skipinitialspace=True):
+            chunk = chunk.rename(columns=sources)
+            missing = [name for name in REQUIRED[table] if name not in chunk.columns]
+            if missing:
+                raise ValueError(f'{path} has no column for {missing}')
+            chunk = chunk.reindex(columns=COLUMNS[table])
+            yield chunk.astype(object).where(chunk.notna(), None)
+
+    def _commit_chunk(self, commit):
+        """Runs commit() with an upload graph for the chunk so its rows are uploaded concurrently. Writers and sequential uploads do not need one."""
+        if self.writer is not None or self.executor is None:
+            commit()
+            return
+        generatebase.GenerateBase.graph = scheduler.ResourceGraph(executor=self.executor)
+        try:
+            commit()
+            graph = generatebase.GenerateBase.graph
+        finally:
+            generatebase.GenerateBase.graph = None
+        graph.run()
+
+    def _patient(self, patient_id):
+        """Patient of a source patient_id for the references of conditions and observations, or None if it was not ingested. Call with GenerateBase.patient_key set to the patient's."""
+        if not self._ingested.contains(_hash([patient_id]))[0]:
+            return None
+        if not self.deterministic:
+            id = self.patient_ids.get(patient_id)
+            return None if id is None else records.ExistingRecord('Patient', id)
+        return records.ExistingRecord('Patient', self._id_from_identifier(self._create_identifier('Patient')))
+
+    @staticmethod
+    def _local_times(values):
+        """Parses timestamps in any mix of formats to naive clinic local times. Timestamps with a UTC offset or Z are converted; unparsable ones are NaT."""
+        values = values.astype(object)
+        aware = values.str.contains(r'(?:Z|[+-]\d\d:?\d\d)$', na=False).to_numpy(dtype=bool)
+        times = pd.Series(pd.NaT, index=values.index, dtype='datetime64[s]')
+        if (~aware).any():
+            times[~aware] = pd.to_datetime(values[~aware], errors='coerce', format='mixed')
+        if aware.any():
+            times[aware] = pd.to_datetime(values[aware], errors='coerce', format='mixed', utc=True).dt.tz_convert(timestamps.DEFAULT.tz).dt.tz_localize(None)
+        return times
+
+    def _reject(self, table, reason, count=1):
+        if count:
+            self.rejected[(table, reason)] += int(count)
+
+    def _repeated(self, keys, index):
+        """
+        Repeats of keys within the chunk or of keys already in index.
+
+        :param keys: Series of keys of a chunk
+        :param index: HashIndex of the keys of earlier chunks
+        :returns: tuple of (boolean array of repeated rows, hashes of the keys)
+        """
+        hashes = _hash(keys)
+        return keys.duplicated().to_numpy() | index.contains(hashes), hashes
+
+    def add_patients(self, path):
+        """
+        Ingests a patients CSV.
+
+        :param path: CSV with the columns of COLUMNS['patients']. birthdate is any date pandas parses; gender is f/female, m/male, o/other or unknown.
+        """
+        for chunk in self._chunks(path, 'patients'):
+            birthdate = pd.to_datetime(chunk.birthdate, errors='coerce', format='mixed')
+            gender = chunk.gender.str.strip().str.lower().map(GENDERS).fillna('unknown')
+            keep = chunk.patient_id.notna().to_numpy()
+            self._reject('patients', 'no patient_id', (~keep).sum())
+            chunk = chunk.assign(birthdate=[None if pd.isna(d) else d.date() for d in birthdate], gender=gender.to_numpy())[keep]
+            repeated, hashes = self._repeated(chunk.patient_id, self._ingested)
+            self._reject('patients', 'repeated patient_id', repeated.sum())
+            chunk = chunk[~repeated]
+            committed = []
+
+            def commit():
+                for row in chunk.itertuples(index=False):
+                    generatebase.GenerateBase.patient_key = f'{SOURCE_KEY}/{row.patient_id}'
+                    Patient = records.PatientRecord(row.family, row.given, row.gender, row.birthdate, row.line, row.city, row.state, row.zipcode,
+                                                    row.race_code, row.race_description, row.ethnicity_code, row.ethnicity_description, self.Organization, middle=row.middle, mrn=row.mrn)
+                    self._commit_resource(Patient, depends=[self.Organization] if self.Organization is not None else [])
+                    committed.append((row.patient_id, Patient))
+
+            self._commit_chunk(commit)
+            self._ingested.add(hashes[~repeated])
+            if not self.deterministic:
+                self.patient_ids.update((patient_id, Patient.id) for patient_id, Patient in committed)
+            self.counts['Patient'] += len(committed)
+            runlog.event(log, 'ingested', 'INGESTED %d patients from %s', self.counts['Patient'], path, resource_type='Patient', count=self.counts['Patient'], path=path)
+
+    def add_conditions(self, path):
+        """
+        Ingests a conditions CSV. Patients have to be ingested first.
+
+        :param path: CSV with the columns of COLUMNS['conditions']. A patient's conditions are keyed by condition_id, or by icd_code without it.
+        """
+        for chunk in self._chunks(path, 'conditions'):
+            keys = 'Condition/' + chunk.condition_id.where(chunk.condition_id.notna(), chunk.icd_code).astype(str)
+            # repeated rows would get the same identifier
+            repeated, hashes = self._repeated(f'{SOURCE_KEY}/' + chunk.patient_id.astype(str) + '/' + keys, self._seen)
+            self._reject('conditions', 'repeated row', repeated.sum())
+            chunk, keys, hashes = chunk[~repeated], keys[~repeated].tolist(), hashes[~repeated]
+            committed = np.zeros(len(chunk), dtype=bool)
+
+            def commit():
+                for i, (row, key) in enumerate(zip(chunk.itertuples(index=False), keys)):
+                    generatebase.GenerateBase.patient_key = f'{SOURCE_KEY}/{row.patient_id}'
+                    Patient = self._patient(row.patient_id) if row.patient_id is not None and row.icd_code is not None else None
+                    if Patient is None:
+                        self._reject('conditions', 'no icd_code or unknown patient_id')
+                        continue
+                    Condition = records.ConditionRecord(row.icd_code, row.icd_description, Patient)
+                    self._commit_resource(Condition, key=key, depends=[Patient])
+                    committed[i] = True
+
+            self._commit_chunk(commit)
+            self._seen.add(hashes)
+            self.counts['Condition'] += int(committed.sum())
+            runlog.event(log, 'ingested', 'INGESTED %d conditions from %s', self.counts['Condition'], path, resource_type='Condition', count=self.counts['Condition'], path=path)
+
+    def add_observations(self, path):
+        """
+        Ingests a vitals or labs CSV. Patients have to be ingested first. Rows with a value_code become coded values, numeric values become quantities and anything else a valueString.
+
+        :param path: CSV with the columns of COLUMNS['observations']. system defaults to LOINC. effective is any timestamp pandas parses; naive timestamps are clinic local time. A patient's observations are keyed by observation_id, or by code, effective time and value without it.
+        """
+        for chunk in self._chunks(path, 'observations'):
+            effective = self._local_times(chunk.effective)
+            known = effective.notna().to_numpy() & chunk.patient_id.notna().to_numpy() & chunk.code.notna().to_numpy()
+            self._reject('observations', 'no patient_id, code or effective time', (~known).sum())
+            chunk = chunk[known].assign(effective=timestamps.DEFAULT.render_many(effective[known].to_numpy(dtype='datetime64[s]')))
+            natural = chunk.code.astype(str) + '/' + chunk.effective.astype(str) + '/' + chunk.value.astype(str)
+            keys = 'Observation/' + chunk.observation_id.where(chunk.observation_id.notna(), natural).astype(str)
+            # repeated rows would get the same identifier
+            repeated, hashes = self._repeated(f'{SOURCE_KEY}/' + chunk.patient_id.astype(str) + '/' + keys, self._seen)
+            self._reject('observations', 'repeated row', repeated.sum())
+            chunk, keys, hashes = chunk[~repeated], keys[~repeated].tolist(), hashes[~repeated]
+            numeric = pd.to_numeric(chunk.value, errors='coerce').astype(float).tolist()
+            committed = np.zeros(len(chunk), dtype=bool)
+
+            def commit():
+                for i, (row, number, key) in enumerate(zip(chunk.itertuples(index=False), numeric, keys)):
+                    generatebase.GenerateBase.patient_key = f'{SOURCE_KEY}/{row.patient_id}'
+                    Patient = self._patient(row.patient_id)
+                    if Patient is None:
+                        self._reject('observations', 'unknown patient_id')
+                        continue
+                    measurement = {'code': row.code, 'system': row.system or 'http://loinc.org', 'display': row.display}
+                    if row.value_code is not None:
+                        measurement.update(type='codeable', value_loinc=row.value_code, value_system=row.value_system or 'http://loinc.org', value_display=row.value)
+                    elif not np.isnan(number):
+                        measurement.update(type='quantity', value=int(number) if number.is_integer() else number, unit=row.unit)
+                    else:
+                        measurement.update(type='valuestring', value=row.value)
+                    Observation = records.ObservationRecord(row.code, measurement, row.effective, Patient, None)
+                    self._commit_resource(Observation, key=key, depends=[Patient])
+                    committed[i] = True
+
+            self._commit_chunk(commit)
+            self._seen.add(hashes)
+            self.counts['Observation'] += int(committed.sum())
+            runlog.event(log, 'ingested', 'INGESTED %d observations from %s', self.counts['Observation'], path, resource_type='Observation', count=self.counts['Observation'], path=path)
+
+    def print_report(self):
+        print(self)
+        for (table, reason), count in sorted(self.rejected.items()):
+            print(f'rejected {count} {table} rows: {reason}')
+
+
+def parse_columns(text):
+    """
+    Parses field=column pairs.
+
+    :param text: comma separated pairs, i.e. 'patient_id=PAT_ID,family=LAST_NAME'
+    :returns: dictionary of field name: CSV column name
+    """
+    columns = {}
+    fields = {name for names in COLUMNS.values() for name in names}
+    for item in text.split(','):
+        field, _, column = item.partition('=')
+        if field.strip() not in fields or not column.strip():
+            raise ValueError(f'unknown column mapping {item}; fields are {sorted(fields)}')
+        columns[field.strip()] = column.strip()
+    return columns
+
+
+def main(args):
+    """Runs the ingest subcommand of fpargenerator."""
+    base = generatebase.GenerateBase
+    base.run_seed = args.seed or 0
+    base.upload_mode = args.upload_mode
+    base.use_limiter(ratecontroller.AdaptiveLimiter(max_limit=args.max_inflight, target_p95=args.target_p95, max_rps=args.max_rps))
+    writer = None
+    if args.output is not None:
+        writer = ndjsonwriter.NdjsonWriter(args.output, compression=None if args.compression == 'none' else args.compression, max_bytes=args.max_file_mb*1024**2)
+        base.writer = writer
+    executor = ThreadPoolExecutor(max_workers=args.parallel) if args.parallel > 1 and writer is None else None
+    try:
+        Organization = None
+        if args.organization is not None:
+            base.patient_key = SOURCE_KEY
+            Organization = generateorganization.GenerateOrganization(name=args.organization).Organization
+        ingest = CsvIngest(chunk_size=args.chunk_size, columns=parse_columns(args.columns) if args.columns else None, executor=executor, Organization=Organization)
+        for path in args.patients or []:
+            ingest.add_patients(path)
+        for path in args.conditions or []:
+            ingest.add_conditions(path)
+        for path in args.observations or []:
+            ingest.add_observations(path)
+        ingest.print_report()
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if writer is not None:
+            base.writer = None
+            runlog.event(log, 'wrote', 'WROTE %s to %s', writer.close(), writer.directory, directory=writer.directory)
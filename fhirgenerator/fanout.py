@@ -0,0 +1,241 @@
+import generatebase
+import latency
+import ratecontroller
+import runlog
+import scheduler
+
+from concurrent.futures import ThreadPoolExecutor, wait
+import requests
+import threading
+import logging
+import queue
+import time
+import os
+os.chdir(os.path.dirname(os.path.realpath(__file__)))
+
+log = runlog.getLogger('fanout')
+
+
+class Payload():
+    """Serialized resource of a patient graph. Quacks like a resource for GenerateBase.post_resource."""
+    __slots__ = ('resource_name', 'id', 'identifier', 'json', 'key')
+
+    def __init__(self, resource_name, id, identifier, json, key):
+        self.resource_name = resource_name
+        self.id = id
+        self.identifier = identifier
+        self.json = json
+        self.key = key
+
+    def __str__(self):
+        return f'Payload:{self.key}; id: {self.id}'
+
+    @staticmethod
+    def __repr__():
+        return 'Payload(resource_name,id,identifier,json,key)'
+
+    def as_json(self):
+        return self.json
+
+
+def _rewrite_references(js, ids):
+    """Copy of a resource json with every local reference replaced by the endpoint's server id."""
+    if isinstance(js, dict):
+        rewritten = {k: _rewrite_references(v, ids) for k, v in js.items()}
+        reference = rewritten.get('reference')
+        if isinstance(reference, str) and reference in ids:
+            rewritten['reference'] = ids[reference]
+        return rewritten
+    if isinstance(js, list):
+        return [_rewrite_references(v, ids) for v in js]
+    return js
+
+
+class Endpoint():
+    def __init__(self, name, url, upload_mode='conditional', parallel=4, backlog=1000, limiter=None):
+        """
+        One FHIR server of a FanoutPublisher. Has its own connection pool, adaptive limiter, id mapping, worker thread
+        and backlog of patient graphs, so a slow or failing server only delays itself.
+
+        :param name: endpoint name used in reports
+        :param url: FHIR base url
+        :param upload_mode: 'conditional' or 'put', see GenerateBase.upload_mode
+        :param parallel: concurrent uploads within a layer of a patient graph
+        :param backlog: patient graphs queued for this endpoint before the publisher waits for it
+        :param limiter: ratecontroller.AdaptiveLimiter. Default creates one.
+        """
+        self.name = name
+        self.url = url
+        self.parallel = parallel
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=parallel)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        # GenerateBase keeps the server settings on the class; each endpoint uploads through its own subclass
+        self.client = type(f'{name}Client', (generatebase.GenerateBase,), {
+            'server_url': url, 'session': session, 'upload_mode': upload_mode,
+            'limiter': limiter or ratecontroller.AdaptiveLimiter(),
+            'journal': None, 'graph': None, 'writer': None,
+            })
+        self.histogram = latency.LatencyHistogram()
+        self.uploaded = 0
+        self.errors = 0
+        self.failed_patients = []
+        self.shared_ids = {}
+        self._queue = queue.Queue(maxsize=backlog)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __str__(self):
+        return f'Endpoint:{self.name} {self.url}; uploaded: {self.uploaded}; failed patients: {len(self.failed_patients)}'
+
+    @staticmethod
+    def __repr__():
+        return 'Endpoint(name,url)'
+
+    def submit(self, patient_key, layers, shared=False):
+        """Queues a serialized patient graph. Blocks only when this endpoint's backlog is full."""
+        self._queue.put((patient_key, layers, shared))
+
+    def _upload(self, payload, ids):
+        js = _rewrite_references(payload.json, ids)
+        if self.client.upload_mode != 'put':
+            js.pop('id', None)
+        resource = Payload(payload.resource_name, payload.id, payload.identifier, js, payload.key)
+        start = time.monotonic()
+        try:
+            response = self.client.post_resource(resource)
+        finally:
+            seconds = time.monotonic() - start
+            self.histogram.record(seconds)
+        id = payload.id if self.client.upload_mode == 'put' else self.client()._extract_id(response)
+        runlog.resource(payload.resource_name, id, payload.key, seconds=seconds, endpoint=self.name)
+        return id
+
+    def _run_graph(self, executor, layers, shared):
+        ids = dict(self.shared_ids)
+        for layer in layers:
+            futures = [executor.submit(self._upload, payload, ids) for payload in layer]
+            wait(futures)
+            for payload, future in zip(layer, futures):
+                # raises the first failure of the layer; dependent layers are not attempted
+                ids[f'{payload.resource_name}/{payload.id}'] = f'{payload.resource_name}/{future.result()}'
+                self.uploaded += 1
+        if shared:
+            self.shared_ids = ids
+
+    def _run(self):
+        executor = ThreadPoolExecutor(max_workers=self.parallel)
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                patient_key, layers, shared = item
+                try:
+                    self._run_graph(executor, layers, shared)
+                except Exception as error:
+                    self.errors += 1
+                    self.failed_patients.append(patient_key)
+                    runlog.event(log, 'failed', '%s FAILED patient %s: %r', self.name, patient_key, error, level=logging.ERROR, endpoint=self.name, patient_key=patient_key, error=repr(error))
+        finally:
+            executor.shutdown()
+
+    def close(self):
+        """Waits until the backlog is uploaded."""
+        self._queue.put(None)
+        self._thread.join()
+
+
+class FanoutPublisher():
+    def __init__(self, endpoints, upload_mode='conditional', parallel=4, backlog=1000, max_inflight=64, target_p95=1.0, max_rps=None):
+        """
+        Uploads every generated patient graph to several FHIR servers. Each graph is generated and serialized once;
+        every endpoint then uploads it layer by layer on its own thread, mapping the local ids of the graph to the ids
+        its server assigns.
+
+        :param endpoints: dictionary of name: FHIR base url
+        :param upload_mode: 'conditional' or 'put', see GenerateBase.upload_mode
+        :param parallel: concurrent uploads within a layer, per endpoint
+        :param backlog: patient graphs queued per endpoint
+        :param max_inflight: upper bound of each endpoint's adaptive limiter
+        :param target_p95: p95 latency in seconds each endpoint's limiter treats as healthy
+        :param max_rps: hard cap on requests per second, per endpoint
+        """
+        self.start = time.monotonic()
+        self.endpoints = [Endpoint(name, url, upload_mode=upload_mode, parallel=parallel, backlog=backlog,
+                                   limiter=ratecontroller.AdaptiveLimiter(max_limit=max_inflight, target_p95=target_p95, max_rps=max_rps))
+                          for name, url in endpoints.items()]
+
+    def __str__(self):
+        return f"FanoutPublisher:{', '.join(endpoint.name for endpoint in self.endpoints)}"
+
+    @staticmethod
+    def __repr__():
+        return 'FanoutPublisher(endpoints)'
+
+    def publish(self, patient_key, layers, shared=False):
+        """
+        Hands a serialized patient graph to every endpoint.
+
+        :param patient_key: position of the patient within the run
+        :param layers: list of lists of Payload objects in upload order
+        :param shared: the graph holds resources referenced by later graphs (i.e. a clinic network). Each endpoint keeps its server ids for every graph published after it.
+        """
+        for endpoint in self.endpoints:
+            endpoint.submit(patient_key, layers, shared)
+
+    def close(self):
+        """
+        Waits for every endpoint to finish its backlog.
+
+        :returns: report dictionary in the layout of LoadDriver.report(), one row per endpoint
+        """
+        for endpoint in self.endpoints:
+            endpoint.close()
+        elapsed = time.monotonic() - self.start
+        return {endpoint.name: dict(endpoint.histogram.summary(), errors=endpoint.errors, rps=endpoint.histogram.total/elapsed) for endpoint in self.endpoints}
+
+
+class FanoutGraph(scheduler.ResourceGraph):
+    def __init__(self, publisher, patient_key, shared=False):
+        """
+        ResourceGraph that serializes a patient graph once and publishes it to every endpoint of a FanoutPublisher.
+        Resources get their deterministic local ids (see GenerateBase._id_from_identifier) so references can be
+        serialized before any server has assigned an id.
+
+        :param publisher: FanoutPublisher object
+        :param patient_key: position of the patient within the run
+        :param shared: see FanoutPublisher.publish
+        """
+        super().__init__()
+        self.publisher = publisher
+        self.patient_key = patient_key
+        self.shared = shared
+
+    def run(self):
+        layers = self.layers()
+        for layer in layers:
+            for node in layer:
+                node.resource.id = generatebase.GenerateBase._id_from_identifier(node.resource.identifier[0])
+        payloads = [[Payload(node.resource.resource_name, node.resource.id, node.resource.identifier, node.resource.as_json(), node.key) for node in layer] for layer in layers]
+        self.publisher.publish(self.patient_key, payloads, self.shared)
+        self.nodes = []
+        self._nodes_by_resource = {}
+
+
+def parse_endpoints(text):
+    """
+    Parses --endpoints: a comma separated list of names of generatebase.ENDPOINTS or name=url pairs.
+
+    :returns: dictionary of name: FHIR base url
+    """
+    endpoints = {}
+    for item in text.split(','):
+        name, _, url = item.strip().partition('=')
+        if not url:
+            if name not in generatebase.ENDPOINTS:
+                raise ValueError(f'unknown endpoint {name}; use one of {sorted(generatebase.ENDPOINTS)} or name=url')
+            url = generatebase.ENDPOINTS[name]
+        endpoints[name] = url if url.endswith('/') else url + '/'
+    return endpoints
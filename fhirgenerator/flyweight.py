@@ -0,0 +1,94 @@
+"""
+Interning layer for the immutable fragments repeated across generated resources (language, LOINC codes, race and
+ethnicity codings, Organization/Practitioner references). Each fragment is built once, frozen, and caches its
+as_json() dictionary so serializing a parent resource does not walk it again.
+
+The cached dictionaries are shared between every resource that embeds the fragment and must not be mutated.
+"""
+
+import fhirclient.models.codeableconcept as cc
+import fhirclient.models.coding as c
+import fhirclient.models.fhirreference as fr
+
+import functools
+import os
+os.chdir(os.path.dirname(os.path.realpath(__file__)))
+
+
+class _Interned():
+    """Mixin that freezes a fhirclient element and caches its serialized json."""
+    def _freeze(self):
+        self._json = super().as_json()
+        self._frozen = True
+        return self
+
+    def __setattr__(self, name, value):
+        if getattr(self, '_frozen', False):
+            raise AttributeError(f'{self.__class__.__name__} is interned and cannot be modified')
+        object.__setattr__(self, name, value)
+
+    def as_json(self):
+        return self._json
+
+
+class InternedCoding(_Interned, c.Coding):
+    pass
+
+
+class InternedCodeableConcept(_Interned, cc.CodeableConcept):
+    pass
+
+
+class InternedReference(_Interned, fr.FHIRReference):
+    pass
+
+
+@functools.lru_cache(maxsize=4096)
+def coding(code, system=None, display=None):
+    """
+    Returns the shared Coding object for (code, system, display).
+
+    :param code: code from standard System
+    :param system: coding System
+    :param display: how the resource should be displayed
+    :returns: InternedCoding FHIR object
+    """
+    Coding = InternedCoding()
+    Coding.code = code
+    Coding.system = system
+    Coding.display = display
+    return Coding._freeze()
+
+
+@functools.lru_cache(maxsize=4096)
+def codeable_concept(code, system=None, display=None):
+    """
+    Returns the shared CodeableConcept object wrapping coding(code, system, display).
+
+    :param code: code from standard System
+    :param system: coding System
+    :param display: how the resource should be displayed
+    :returns: InternedCodeableConcept FHIR object
+    """
+    CodeableConcept = InternedCodeableConcept()
+    CodeableConcept.coding = [coding(code, system, display)]
+    return CodeableConcept._freeze()
+
+
+@functools.lru_cache(maxsize=1024)
+def reference(resource_name, id):
+    """
+    Returns the shared reference to resource_name/id.
+
+    :param resource_name: FHIR resource name (i.e. Patient)
+    :param id: server id of the resource
+    :returns: InternedReference FHIR object
+    """
+    FHIRReference = InternedReference()
+    FHIRReference.reference = f'{resource_name}/{id}'
+    return FHIRReference._freeze()
+
+
+def cache_info():
+    """Returns the lru cache statistics of each interned fragment type."""
+    return {'coding': coding.cache_info(), 'codeable_concept': codeable_concept.cache_info(), 'reference': reference.cache_info()}
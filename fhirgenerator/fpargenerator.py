@@ -1,34 +1,461 @@
+import os
+# the modules below change to their own directory on import; command line paths are relative to the caller's
+CALLER_CWD = os.getcwd()
+
+import generatebase
 import generatepatient
 import generatelocation
 import generatecondition
+import generateencounter
 import generatepractitioner
 import generateobservation
 import generateobservationdict
 import generatefparlabs
 import generateorganization
+import identity
+import clinicnetwork
+import csvingest
+import columnarexport
+import fanout
+import fparsummary
+import integritycheck
+import loaddriver
+import ndjsonwriter
+import ratecontroller
+import referencedata
+import runjournal
+import runlog
+import scheduler
+import timestamps
+import topup
+import verify
+import workload
+import profiling
 import argparse
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+import random
+import datetime
+import time
+import numpy as np
+import os
+
+VISIT_BATCH_SIZE = 1000
+# arguments holding file or directory paths, resolved against CALLER_CWD
+PATH_ARGUMENTS = ['output', 'journal', 'export', 'profile', 'log_json', 'input', 'patients', 'conditions', 'observations']
+
+log = runlog.getLogger('fpargenerator')
 
 class FparGenerator:
 
-    def __init__(self):
-        """Used to create all of the FPAR resources available with US Core."""
-        self.Organization = generateorganization.GenerateOrganization().Organization
-        self.Patient = generatepatient.GeneratePatient(Organization=self.Organization).Patient
-        self.Practitioner = generatepractitioner.GeneratePractitioner(Organization=self.Organization).Practitioner
+    def __init__(self, patient_key=0, seed=None, visit_time=None, graph=None, visits=None, Organization=None, Location=None, Practitioner=None, zipcode_row=None, identity=None):
+        """
+        Used to create all of the FPAR resources available with US Core.
+
+        :param patient_key: position of the patient within the run. Used as the key within the run journal.
+        :param seed: run seed. When given, the patient graph is reproducible from (seed, patient_key).
+        :param visit_time: datetime64 local visit time from TimestampService.clinic_times. Observations get effective times spread over the visit. Default is now.
+        :param graph: scheduler.ResourceGraph object. When given, the patient's resources are generated first and then uploaded layer by layer with each layer posted concurrently. Default posts every resource as it is generated.
+        :param visits: sorted datetime64 local visit times from TimestampService.timelines. When given, the patient gets an Encounter per visit with its own vitals and labs linked to it, and visit_time is ignored.
+        :param Organization: clinic OrganizationRecord of a ClinicNetwork. Default generates the patient's own Organization.
+        :param Location: clinic Location of a ClinicNetwork used for the patient's Encounters. Default generates the patient's own Location.
+        :param Practitioner: PractitionerRecord of the patient's panel, see ClinicNetwork.add_panels. Default generates the patient's own Practitioner.
+        :param zipcode_row: home zipcode of the patient, see ClinicNetwork.sample_patients
+        :param identity: identity.Identity with the patient's unique MRN and name, see IdentitySpace.batch
+        """
+        self.patient_key = patient_key
+        if seed is not None:
+            self._seed_patient(seed, patient_key)
+        generatebase.GenerateBase.patient_key = patient_key
+        generatebase.GenerateBase.graph = graph
+        if Organization is None:
+            self.Organization = generateorganization.GenerateOrganization().Organization
+        else:
+            self.Organization = Organization
+        self.Patient = generatepatient.GeneratePatient(Organization=self.Organization, zipcode_row=zipcode_row, identity=identity).Patient
+        if Practitioner is None:
+            self.Practitioner = generatepractitioner.GeneratePractitioner(Organization=self.Organization).Practitioner
+        else:
+            self.Practitioner = Practitioner
         self.Condition = generatecondition.GenerateCondition(Patient=self.Patient).Condition
-        vitals_dict = generateobservationdict.GenerateObservationDict(Patient=self.Patient)
-        generateobservation.GenerateObservation(observation_dict=vitals_dict.observation_dict, Patient=self.Patient, Practitioner=self.Practitioner)
-        labs_dict = generatefparlabs.GenerateFparLabs()
-        generateobservation.GenerateObservation(observation_dict=labs_dict.lab_dict, Patient=self.Patient, Practitioner=self.Practitioner)
+        self.visits = []
+        if visits is None:
+            self.observation_dict, self.lab_dict, self.vitals_dt, self.labs_dt = self._generate_visit(visit_time)
+        else:
+            if Location is None:
+                self.Location = generatelocation.GenerateLocation().Location
+            else:
+                self.Location = Location
+            for visit, start in enumerate(visits):
+                Encounter = generateencounter.GenerateEncounter(Patient=self.Patient, Practitioner=self.Practitioner, Location=self.Location, Condition=self.Condition, start=start, visit=visit).Encounter
+                self.visits.append((Encounter,) + self._generate_visit(start, Encounter=Encounter, visit=visit))
+            self.observation_dict, self.lab_dict, self.vitals_dt, self.labs_dt = self.visits[-1][1:]
+        if graph is not None:
+            generatebase.GenerateBase.graph = None
+            graph.run()
+
+    def _generate_visit(self, visit_time, Encounter=None, visit=None):
+        """
+        Generates the vitals and labs taken at one visit.
+
+        :param visit_time: datetime64 local visit time. None uses the time of generation.
+        :param Encounter: records.EncounterRecord the observations are linked to
+        :param visit: position of the visit within the patient's timeline
+        :returns: tuple of (observation_dict, lab_dict, vitals effective times, labs effective times)
+        """
+        observation_dict = generateobservationdict.GenerateObservationDict(Patient=self.Patient).observation_dict
+        lab_dict = generatefparlabs.GenerateFparLabs().lab_dict
+        vitals_dt = labs_dt = None
+        if visit_time is not None:
+            effective_times = timestamps.DEFAULT.visit_offsets(visit_time, len(observation_dict)+len(lab_dict))
+            vitals_dt = list(effective_times[:len(observation_dict)])
+            labs_dt = list(effective_times[len(observation_dict):])
+        generateobservation.GenerateObservation(observation_dict=observation_dict, dt=vitals_dt, Patient=self.Patient, Practitioner=self.Practitioner, Encounter=Encounter, visit=visit)
+        generateobservation.GenerateObservation(observation_dict=lab_dict, dt=labs_dt, Patient=self.Patient, Practitioner=self.Practitioner, Encounter=Encounter, visit=visit)
+        return observation_dict, lab_dict, vitals_dt, labs_dt
+
+    def record_cohort(self, journal):
+        """Records the patient's ids and searchable demographics in the run journal once the graph is uploaded."""
+        journal.record_patient(self.patient_key, self.Patient.id, self.Organization.id, self.Practitioner.id, self.Patient.family, self.Patient.given, self.Patient.gender, self.Patient.birthdate, self.Patient.zipcode)
+
+    def export_columns(self, exporter):
+        """Adds the patient's generated values to a columnarexport.ColumnarExporter."""
+        if not self.visits:
+            exporter.add_patient(self.patient_key, self.Patient, self.Condition, self.Practitioner, self.observation_dict, self.lab_dict, observation_times=self.vitals_dt, lab_times=self.labs_dt)
+            return
+        exporter.add_patient(self.patient_key, self.Patient, self.Condition, self.Practitioner, None, None)
+        for visit, (Encounter, observation_dict, lab_dict, vitals_dt, labs_dt) in enumerate(self.visits):
+            exporter.add_visit(self.patient_key, visit, observation_dict, lab_dict, observation_times=vitals_dt, lab_times=labs_dt, Encounter=Encounter)
+
+    @staticmethod
+    def _seed_patient(seed, patient_key):
+        """Seeds random and numpy so that a patient graph can be regenerated when a run is resumed."""
+        random.seed(f'{seed}-{patient_key}')
+        np.random.seed((seed * 1000003 + patient_key) % 2**32)
+
+    @staticmethod
+    def _visit_times(seed, batch_start, batch_size, days=365):
+        """
+        Generates the visit times of a batch of patients in one vectorized call. Seeded per batch so resumed runs get the same times.
+
+        :param seed: run seed
+        :param batch_start: patient_key of the first patient in the batch
+        :param batch_size: number of patients in the batch
+        :param days: visits are spread over this many days before today
+        :returns: numpy datetime64 array of local visit times
+        """
+        random_state = np.random.RandomState((seed * 7919 + batch_start) % 2**32)
+        today = datetime.date.today()
+        return timestamps.DEFAULT.clinic_times(batch_size, today - datetime.timedelta(days=days), today, random_state=random_state)
+
+    @staticmethod
+    def _visit_timelines(seed, batch_start, batch_size, years, visits_per_year):
+        """
+        Generates the visit timelines of a batch of patients in one vectorized call. Visit counts are Poisson distributed with at least one visit per patient. Seeded per batch so resumed runs get the same timelines.
+
+        :param seed: run seed
+        :param batch_start: patient_key of the first patient in the batch
+        :param batch_size: number of patients in the batch
+        :param years: length of the timelines in years before today
+        :param visits_per_year: mean number of visits per patient-year
+        :returns: tuple of (offsets, times), see TimestampService.timelines
+        """
+        random_state = np.random.RandomState((seed * 7919 + batch_start) % 2**32)
+        counts = np.maximum(random_state.poisson(visits_per_year*years, batch_size), 1)
+        today = datetime.date.today()
+        return timestamps.DEFAULT.timelines(counts, today - datetime.timedelta(days=round(365.25*years)), today, random_state=random_state)
 
 def main():
     """argsparse function that addes the ability to create -n sets of fpar resources"""
     parser = argparse.ArgumentParser()
     parser.add_argument('-n','--number', help='Number of fpar patients to create.', type=int, default=1)
+    parser.add_argument('-s','--seed', help='Run seed. Stored in the journal so a resumed run regenerates the same patients.', type=int, default=None)
+    parser.add_argument('-j','--journal', help='SQLite journal that records every created resource.', default=None)
+    parser.add_argument('--resume', help='Skips patients completed in --journal and finishes partially uploaded ones.', action='store_true')
+    parser.add_argument('--processes', help='Generator worker processes. The reference tables are loaded once and shared with every worker.', type=int, default=1)
+    parser.add_argument('-p','--parallel', help='Maximum concurrent uploads within a patient. 1 posts every resource sequentially.', type=int, default=8)
+    parser.add_argument('--max-inflight', help='Upper bound of the adaptive in-flight request limit.', type=int, default=64)
+    parser.add_argument('--max-rps', help='Hard cap on requests per second against the server.', type=float, default=None)
+    parser.add_argument('--target-p95', help='p95 latency in seconds the adaptive limiter treats as healthy.', type=float, default=1.0)
+    parser.add_argument('-o','--output', help='Writes resources to compressed NDJSON files in this directory instead of posting them.', default=None)
+    parser.add_argument('--compression', help='Compression of --output files.', choices=['gzip','zstd','none'], default='gzip')
+    parser.add_argument('--max-file-mb', help='Uncompressed MB after which an --output file is rolled over.', type=int, default=256)
+    parser.add_argument('--export', help='Writes patients, conditions, observations and labs as Parquet tables to this directory.', default=None)
+    parser.add_argument('--export-only', help='Only writes the --export tables. Nothing is posted.', action='store_true')
+    parser.add_argument('--years', help='Longitudinal mode: every patient gets a timeline of visits over this many years, each with an Encounter and its own vitals and labs.', type=float, default=None)
+    parser.add_argument('--visits-per-year', help='Mean visits per patient-year of --years timelines.', type=float, default=2.0)
+    parser.add_argument('--clinics', help='Generates a network of this many clinics from zipcodes.csv and assigns every patient to the clinic nearest to their home zipcode.', type=int, default=None)
+    parser.add_argument('--panel-size', help='Staffs every --clinics clinic with a pool of practitioners of this mean panel size instead of one practitioner per patient.', type=float, default=None)
+    parser.add_argument('--panel-shape', help='Gamma shape of the --panel-size distribution. Higher is more uniform.', type=float, default=4.0)
+    parser.add_argument('--profile', help='Profiles the run and writes cProfile, per generator and per stage reports to this directory.', default=None)
+    parser.add_argument('--profile-memory', help='Adds tracemalloc snapshots of the top allocators of each stage to --profile. Slow.', action='store_true')
+    parser.add_argument('--profile-sample-ms', help='Adds folded stacks of every thread sampled at this interval to --profile, for flamegraph.pl or speedscope.', type=float, default=None)
+    parser.add_argument('--endpoints', help='Uploads every patient to several servers: comma separated names of generatebase.ENDPOINTS (dev,test,fpar2,...) or name=url pairs.', default=None)
+    parser.add_argument('-v','--verbose', help='-v logs every finished patient, -vv every uploaded or written resource with its latency.', action='count', default=0)
+    parser.add_argument('-q','--quiet', help='Logs warnings and errors only.', action='store_true')
+    parser.add_argument('--log-json', help='Appends every logged event as a JSON line to this file.', default=None)
+    parser.add_argument('--upload-mode', help='conditional: POST with If-None-Exist on the resource identifier. put: PUT to an id derived from the identifier.', choices=['conditional','put'], default='conditional')
+    subparsers = parser.add_subparsers(dest='command')
+    load_parser = subparsers.add_parser('load', help='Open-loop load test: writes pre-generated FPAR resources on a fixed or ramped arrival schedule.')
+    load_parser.add_argument('-r','--rate', help='Target requests per second.', type=float, required=True)
+    load_parser.add_argument('-d','--duration', help='Length of the run in seconds.', type=float, default=60)
+    load_parser.add_argument('--ramp-from', help='Starting requests per second of a linear ramp to --rate.', type=float, default=None)
+    load_parser.add_argument('--ramp-seconds', help='Length of the ramp in seconds.', type=float, default=0)
+    load_parser.add_argument('-w','--workers', help='Sender threads.', type=int, default=64)
+    load_parser.add_argument('--patients', help='Number of pre-generated patient graphs, cycled during the run.', type=int, default=50)
+    workload_parser = subparsers.add_parser('workload', help='Mixed read/write workload over the cohort recorded in --journal.')
+    workload_parser.add_argument('--mix', help='Relative weights, i.e. patient_name=3,patient_birthdate=2,observation=4,condition=2,write=1', default=None)
+    workload_parser.add_argument('-c','--concurrency', help='Concurrent clients.', type=int, default=16)
+    workload_parser.add_argument('-d','--duration', help='Length of the run in seconds.', type=float, default=60)
+    summary_parser = subparsers.add_parser('summary', help='FPAR summary tables of --output NDJSON or --export Parquet files.')
+    summary_parser.add_argument('input', help='Output directory of a previous run.')
+    summary_parser.add_argument('--chunk-size', help='Rows read per chunk.', type=int, default=100000)
+    topup_parser = subparsers.add_parser('topup', help='Adds a new visit with vitals, labs and at times a Condition to patients of the cohort recorded in --journal that already exist on the server.')
+    topup_parser.add_argument('--patients', help='Number of patients topped up. Default is --fraction of the cohort.', type=int, default=None)
+    topup_parser.add_argument('--fraction', help='Share of the cohort topped up.', type=float, default=0.1)
+    topup_parser.add_argument('--days', help='New visits are spread over this many days before today.', type=int, default=1)
+    topup_parser.add_argument('--condition-rate', help='Share of the new visits that add a Condition.', type=float, default=0.2)
+    check_parser = subparsers.add_parser('check', help='Referential integrity of --output NDJSON files: every reference must resolve to a resource of the output.')
+    check_parser.add_argument('input', help='Output directory of a previous run.')
+    check_parser.add_argument('-w','--workers', help='Worker processes. Default is the number of CPUs.', type=int, default=None)
+    check_parser.add_argument('--chunk-size', help='References looked up per batch.', type=int, default=100000)
+    check_parser.add_argument('--samples', help='Dangling references listed as examples.', type=int, default=20)
+    ingest_parser = subparsers.add_parser('ingest', help='Converts patient, condition and vitals/labs CSV tables to FHIR and writes them to --output or uploads them.')
+    ingest_parser.add_argument('--patients', help='Patients CSV. Repeat for several files.', action='append', default=None)
+    ingest_parser.add_argument('--conditions', help='Conditions CSV. Repeat for several files.', action='append', default=None)
+    ingest_parser.add_argument('--observations', help='Vitals or labs CSV. Repeat for several files.', action='append', default=None)
+    ingest_parser.add_argument('--columns', help='CSV column names that differ from csvingest.COLUMNS, i.e. patient_id=PAT_ID,family=LAST_NAME', default=None)
+    ingest_parser.add_argument('--organization', help='Name of a managing Organization created for the ingested patients.', default=None)
+    ingest_parser.add_argument('--chunk-size', help='CSV rows read per chunk.', type=int, default=100000)
+    verify_parser = subparsers.add_parser('verify', help='Pages through the server and checks what the run of --journal, or of -s and -n without journal, uploaded.')
+    verify_parser.add_argument('--types', help='Comma separated resource types paged through.', default=','.join(verify.RESOURCE_TYPES))
+    verify_parser.add_argument('-c','--concurrency', help='Concurrent requests.', type=int, default=16)
+    verify_parser.add_argument('--page-size', help='Resources per search page.', type=int, default=500)
+    verify_parser.add_argument('--samples', help='Resources read back and compared, or patients searched by identifier without --journal.', type=int, default=100)
+    verify_parser.add_argument('--sample-seed', help='Seed of the sample.', type=int, default=None)
     args = parser.parse_args()
-    for i in range(int(args.number)):
-        FparGenerator()
-        print(f'\n--- FINISHED {i+1} of {args.number} ---\n')
+    for name in PATH_ARGUMENTS:
+        value = getattr(args, name, None)
+        if isinstance(value, str):
+            setattr(args, name, os.path.join(CALLER_CWD, value))
+        elif isinstance(value, list):
+            setattr(args, name, [os.path.join(CALLER_CWD, path) for path in value])
+    runlog.configure(verbosity=-1 if args.quiet else args.verbose, json_path=args.log_json)
+
+    if args.command == 'load':
+        loaddriver.main(args)
+        return
+    if args.command == 'workload':
+        if args.journal is None:
+            parser.error('workload requires --journal')
+        workload.main(args)
+        return
+    if args.command == 'topup':
+        if args.journal is None:
+            parser.error('topup requires --journal')
+        if args.output is not None or args.endpoints is not None:
+            parser.error('topup uploads to the server of the cohort and cannot be combined with --output or --endpoints')
+        topup.main(args)
+        return
+    if args.command == 'summary':
+        fparsummary.main(args)
+        return
+    if args.command == 'check':
+        integritycheck.main(args)
+        return
+    if args.command == 'ingest':
+        if args.journal is not None or args.endpoints is not None or args.export is not None:
+            parser.error('ingest cannot be combined with --journal, --endpoints or --export')
+        if args.columns is not None:
+            try:
+                csvingest.parse_columns(args.columns)
+            except ValueError as error:
+                parser.error(str(error))
+        csvingest.main(args)
+        return
+    if args.command == 'verify':
+        if args.journal is None and args.seed is None:
+            parser.error('verify requires --journal, or -s and -n of the run')
+        if args.endpoints is not None or args.output is not None:
+            parser.error('verify reads back from the server of the run and cannot be combined with --endpoints or --output')
+        verify.main(args)
+        return
+
+    if args.resume and args.journal is None:
+        parser.error('--resume requires --journal')
+    if args.output is not None and args.journal is not None:
+        parser.error('--output writes offline and cannot be combined with --journal')
+    if args.export_only and args.export is None:
+        parser.error('--export-only requires --export')
+    if args.export_only and (args.output is not None or args.journal is not None):
+        parser.error('--export-only cannot be combined with --output or --journal')
+    if (args.profile_memory or args.profile_sample_ms) and args.profile is None:
+        parser.error('--profile-memory and --profile-sample-ms require --profile')
+    if args.panel_size is not None and not args.clinics:
+        parser.error('--panel-size requires --clinics')
+    if args.endpoints is not None and (args.output is not None or args.journal is not None or args.export_only):
+        parser.error('--endpoints cannot be combined with --output, --journal or --export-only')
+    if args.endpoints is not None:
+        try:
+            args.endpoints = fanout.parse_endpoints(args.endpoints)
+        except ValueError as error:
+            parser.error(str(error))
+
+    seed = args.seed
+    if args.journal is not None:
+        with runjournal.RunJournal(args.journal) as journal:
+            stored_seed = journal.get_setting('seed')
+            if args.resume and stored_seed is not None:
+                seed = int(stored_seed)
+            if seed is None:
+                seed = random.randrange(2**31)
+            journal.set_setting('seed', seed)
+    if seed is None:
+        seed = random.randrange(2**31)
+
+    if args.processes <= 1:
+        generate_patients(args, seed, 0, int(args.number))
+        return
+    if args.clinics:
+        # the parent creates the clinic network once; workers find it by its identifiers
+        generate_patients(args, seed, 0, 0)
+    shared = referencedata.ReferenceData.load().share()
+    runlog.event(log, 'sharing', 'SHARING %s with %d workers', shared, args.processes, workers=args.processes)
+    context = multiprocessing.get_context('spawn')
+    bounds = np.linspace(0, int(args.number), args.processes+1).astype(int)
+    log_queue = runlog.worker_queue()
+    workers = [context.Process(target=_worker, args=(shared.handle(), args, seed, bounds[k], bounds[k+1], k, log_queue), name=f'worker{k}') for k in range(args.processes)]
+    try:
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    finally:
+        shared.close()
+    failed = [k for k, worker in enumerate(workers) if worker.exitcode != 0]
+    if failed:
+        raise RuntimeError(f'workers {failed} failed')
+
+def generate_patients(args, seed, start, stop, worker=None):
+    """
+    Generates the patients start..stop-1 of a run in this process.
+
+    :param args: parsed fpargenerator arguments
+    :param seed: run seed
+    :param start: first patient_key
+    :param stop: patient_key after the last patient
+    :param worker: index of the --processes worker. --output, --export and --profile files of a worker go to a worker<k> subdirectory. Workers do not write the --clinics network again.
+    """
+    subdirectory = f'worker{worker}' if worker is not None else ''
+    profiler = None
+    if args.profile is not None:
+        profiler = profiling.RunProfiler(os.path.join(args.profile, subdirectory), memory=args.profile_memory, sample_interval=args.profile_sample_ms/1000 if args.profile_sample_ms else None)
+        profiler.start()
+    stage = profiler.stage if profiler is not None else lambda name: contextlib.nullcontext()
+    workers = max(args.processes, 1)
+    generatebase.GenerateBase.run_seed = seed
+    generatebase.GenerateBase.upload_mode = args.upload_mode
+    generatebase.GenerateBase.use_limiter(ratecontroller.AdaptiveLimiter(max_limit=max(args.max_inflight//workers, 1), target_p95=args.target_p95, max_rps=args.max_rps/workers if args.max_rps else None))
+
+    journal = None
+    if args.journal is not None:
+        journal = runjournal.RunJournal(args.journal)
+        generatebase.GenerateBase.journal = journal
+    writer = None
+    if args.output is not None:
+        compression = None if args.compression == 'none' else args.compression
+        writer = ndjsonwriter.NdjsonWriter(os.path.join(args.output, subdirectory), compression=compression, max_bytes=args.max_file_mb*1024**2)
+        generatebase.GenerateBase.writer = writer
+    elif args.export_only:
+        writer = columnarexport.DiscardWriter()
+        generatebase.GenerateBase.writer = writer
+    exporter = columnarexport.ColumnarExporter(os.path.join(args.export, subdirectory)) if args.export is not None and stop > start else None
+    publisher = None
+    if args.endpoints is not None:
+        publisher = fanout.FanoutPublisher(args.endpoints, upload_mode=args.upload_mode, parallel=args.parallel,
+                                           max_inflight=max(args.max_inflight//workers, 1), target_p95=args.target_p95, max_rps=args.max_rps/workers if args.max_rps else None)
+
+    completed = journal.completed_patients() if args.resume else set()
+    progress = runlog.Progress(stop - start - len([k for k in completed if start <= k < stop]), name=subdirectory or None)
+    executor = ThreadPoolExecutor(max_workers=args.parallel) if args.parallel > 1 and writer is None and publisher is None else None
+    visit_batch = None
+    network = None
+    with stage('reference data'):
+        identities = identity.IdentitySpace(seed)
+    try:
+        if args.clinics:
+            with stage('clinic network'):
+                network = clinicnetwork.ClinicNetwork(args.clinics, seed)
+                if args.panel_size is not None:
+                    network.add_panels(int(args.number), panel_size=args.panel_size, panel_shape=args.panel_shape)
+                if publisher is not None:
+                    graph = fanout.FanoutGraph(publisher, clinicnetwork.NETWORK_KEY, shared=True)
+                else:
+                    graph = scheduler.ResourceGraph(executor=executor) if executor is not None else None
+                network.commit(graph=graph, write=worker is None)
+                runlog.event(log, 'committed', 'COMMITTED %s', network, clinics=args.clinics)
+        with stage('patients'):
+            for i in range(start, stop):
+                if i // VISIT_BATCH_SIZE != visit_batch:
+                    visit_batch = i // VISIT_BATCH_SIZE
+                    batch_identities = identities.batch(visit_batch*VISIT_BATCH_SIZE, VISIT_BATCH_SIZE)
+                    if args.years is None:
+                        visit_times = FparGenerator._visit_times(seed, visit_batch*VISIT_BATCH_SIZE, VISIT_BATCH_SIZE)
+                    else:
+                        visit_offsets, visit_times = FparGenerator._visit_timelines(seed, visit_batch*VISIT_BATCH_SIZE, VISIT_BATCH_SIZE, args.years, args.visits_per_year)
+                    if network is not None:
+                        zipcode_rows, clinics, practitioners = network.sample_patients(seed, visit_batch*VISIT_BATCH_SIZE, VISIT_BATCH_SIZE)
+                if i in completed:
+                    continue
+                patient_start = time.monotonic()
+                if journal is not None:
+                    journal.begin(i)
+                if publisher is not None:
+                    graph = fanout.FanoutGraph(publisher, i)
+                else:
+                    graph = scheduler.ResourceGraph(executor=executor) if executor is not None else None
+                j = i % VISIT_BATCH_SIZE
+                kwargs = {'identity': batch_identities[j]}
+                if network is not None:
+                    kwargs.update(Organization=network.Organizations[clinics[j]], Location=network.Locations[clinics[j]], zipcode_row=zipcode_rows[j])
+                    if practitioners is not None:
+                        kwargs['Practitioner'] = network.Practitioners[practitioners[j]]
+                if args.years is None:
+                    fpar = FparGenerator(patient_key=i, seed=seed, visit_time=visit_times[j], graph=graph, **kwargs)
+                else:
+                    fpar = FparGenerator(patient_key=i, seed=seed, graph=graph, visits=visit_times[visit_offsets[j]:visit_offsets[j+1]], **kwargs)
+                if journal is not None:
+                    fpar.record_cohort(journal)
+                    journal.complete(i)
+                if exporter is not None:
+                    fpar.export_columns(exporter)
+                runlog.event(runlog.PATIENTS, 'patient', 'FINISHED patient %d of %d', i+1, args.number, patient_key=i, seconds=round(time.monotonic()-patient_start, 4))
+                progress.update()
+    finally:
+        with stage('close'):
+            if executor is not None:
+                executor.shutdown()
+            if publisher is not None:
+                runlog.event(log, 'published', 'PUBLISHED to %d endpoints', len(publisher.endpoints), endpoints=len(publisher.endpoints))
+                loaddriver.LoadDriver.print_report(publisher.close())
+            if writer is not None:
+                generatebase.GenerateBase.writer = None
+                if args.output is not None:
+                    runlog.event(log, 'wrote', 'WROTE %s to %s', writer.close(), writer.directory, directory=writer.directory)
+            if exporter is not None:
+                runlog.event(log, 'exported', 'EXPORTED %s to %s', exporter.close(), exporter.directory, directory=exporter.directory)
+            if journal is not None:
+                generatebase.GenerateBase.journal = None
+                journal.close()
+        if profiler is not None:
+            runlog.event(log, 'profiled', 'PROFILED to %s', profiler.stop())
+
+def _worker(handle, args, seed, start, stop, worker, log_queue):
+    """Entry point of a --processes worker. Attaches to the parent's shared reference data instead of loading its own copy and logs through the parent's log queue."""
+    runlog.configure_worker(*log_queue)
+    referencedata.install(referencedata.ReferenceData.attach(handle))
+    generate_patients(args, seed, start, stop, worker=worker)
 
 if __name__ == '__main__':
     main()
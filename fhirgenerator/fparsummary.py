@@ -0,0 +1,224 @@
+import ndjsonwriter
+import observationtemplates
+
+import pandas as pd
+import numpy as np
+import datetime
+import glob
+import os
+os.chdir(os.path.dirname(os.path.realpath(__file__)))
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.json as pj
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pc = pj = pq = None
+
+AGE_BINS = [0, 15, 18, 20, 25, 30, 35, 40, 45]
+AGE_LABELS = ['<15', '15-17', '18-19', '20-24', '25-29', '30-34', '35-39', '40-44', '45+']
+NO_BIRTHDATE = 'no birthdate'
+GENDERS = ['female', 'male', 'unknown']
+CATEGORIES = ['contraceptive_intake', 'contraceptive_exit', 'insurance', 'payer']
+POSITIVE = ['Positive', 'Detected', 'Reactive']
+# JSON bytes per resource line, to size the pyarrow read blocks from chunk_size
+BYTES_PER_ROW = 1024
+
+if pa is not None:
+    _CODEABLE = pa.struct([('coding', pa.list_(pa.struct([('code', pa.string()), ('display', pa.string())])))])
+    PATIENT_SCHEMA = pa.schema([('birthDate', pa.string()), ('gender', pa.string())])
+    OBSERVATION_SCHEMA = pa.schema([('code', _CODEABLE), ('valueCodeableConcept', _CODEABLE), ('valueString', pa.string())])
+
+
+class FparSummary():
+    def __init__(self, chunk_size=100000, as_of=None):
+        """
+        Streaming FPAR summary of generated output. Patients and Observations are read in chunks of chunk_size rows
+        and reduced to counts with vectorized group-bys, so memory depends on the number of distinct values and not on
+        the size of the cohort.
+
+        Tables:
+            - age: patients by FPAR age group and gender. Patients without birthDate are counted in a 'no birthdate' row.
+            - contraceptive_intake, contraceptive_exit, insurance, payer: patients by answer
+            - labs: tests and positive results by lab LOINC code
+
+        :param chunk_size: rows per chunk
+        :param as_of: date ages are computed at. Default is today.
+        """
+        self.chunk_size = chunk_size
+        self.as_of = np.datetime64(as_of or datetime.date.today(), 'D')
+        self.codes = {observationtemplates.CATALOGUE[name].code: name for name in CATEGORIES}
+        self.patients = 0
+        self.observations = 0
+        self._age = np.zeros(len(GENDERS)*(len(AGE_LABELS)+1), dtype=np.int64)
+        self._categories = {name: {} for name in CATEGORIES}
+        self._labs = {}
+
+    def __str__(self):
+        return f'FparSummary:{self.patients} patients; {self.observations} observations'
+
+    @staticmethod
+    def __repr__():
+        return 'FparSummary()'
+
+    @staticmethod
+    def _ages(birthdate, as_of):
+        """Vectorized age in whole years of a datetime64[D] array at as_of."""
+        years = birthdate.astype('datetime64[Y]').astype(np.int64)
+        months = birthdate.astype('datetime64[M]').astype(np.int64) % 12
+        days = (birthdate - birthdate.astype('datetime64[M]')).astype(np.int64)
+        as_of_month = as_of.astype('datetime64[M]').astype(np.int64) % 12
+        as_of_day = (as_of - as_of.astype('datetime64[M]')).astype(np.int64)
+        before_birthday = (months > as_of_month) | ((months == as_of_month) & (days > as_of_day))
+        return as_of.astype('datetime64[Y]').astype(np.int64) - years - before_birthday
+
+    def add_patients(self, birthdate, gender):
+        """
+        Adds a chunk of patients.
+
+        :param birthdate: array of birth dates
+        :param gender: array of FHIR genders
+        """
+        birthdate = np.asarray(birthdate, dtype='datetime64[D]')
+        gender = np.asarray(gender, dtype=object)
+        known = ~np.isnat(birthdate)
+        buckets = np.full(len(birthdate), len(AGE_LABELS))
+        buckets[known] = np.clip(np.digitize(self._ages(birthdate[known], self.as_of), AGE_BINS) - 1, 0, None)
+        genders = pd.Categorical(gender, categories=GENDERS).codes
+        genders = np.where(genders < 0, GENDERS.index('unknown'), genders)
+        self._age += np.bincount(genders*(len(AGE_LABELS)+1) + buckets, minlength=len(self._age))
+        self.patients += len(birthdate)
+
+    def add_observations(self, chunk):
+        """
+        Adds a chunk of observations.
+
+        :param chunk: DataFrame with columns code, display, value_display (codeable values) and value (lab value strings)
+        """
+        self.observations += len(chunk)
+        categorical = chunk[chunk.code.isin(self.codes)]
+        if len(categorical):
+            counts = categorical.groupby([categorical.code.map(self.codes), categorical.value_display.fillna('None')]).size()
+            for (name, answer), count in counts.items():
+                self._categories[name][answer] = self._categories[name].get(answer, 0) + int(count)
+        labs = chunk[chunk.value.notna()]
+        if len(labs):
+            counts = labs.assign(positive=labs.value.isin(POSITIVE)).groupby(['code', 'display']).positive.agg(['size', 'sum'])
+            for key, (tests, positive) in zip(counts.index, counts.values):
+                total = self._labs.setdefault(key, [0, 0])
+                total[0] += int(tests)
+                total[1] += int(positive)
+
+    def _arrow_frames(self, path, schema):
+        """
+        Chunks of an NDJSON file parsed by pyarrow's multithreaded JSON reader. Only the fields of schema are parsed.
+
+        :returns: generator of pyarrow RecordBatches
+        """
+        read_options = pj.ReadOptions(block_size=min(self.chunk_size*BYTES_PER_ROW, 2**30))
+        parse_options = pj.ParseOptions(explicit_schema=schema, unexpected_field_behavior='ignore')
+        with ndjsonwriter.open_ndjson(path) as f:
+            yield from pj.open_json(f, read_options=read_options, parse_options=parse_options)
+
+    @staticmethod
+    def _first_coding(codeable, field):
+        """Field of the first coding of a CodeableConcept column."""
+        return pc.struct_field(pc.list_element(pc.struct_field(codeable, 'coding'), 0), field)
+
+    def _read_ndjson_arrow(self, directory):
+        for path in sorted(glob.glob(os.path.join(directory, 'Patient.*.ndjson*'))):
+            for batch in self._arrow_frames(path, PATIENT_SCHEMA):
+                self.add_patients(batch.column('birthDate').to_numpy(zero_copy_only=False).astype('datetime64[D]'), batch.column('gender').to_numpy(zero_copy_only=False))
+        for path in sorted(glob.glob(os.path.join(directory, 'Observation.*.ndjson*'))):
+            for batch in self._arrow_frames(path, OBSERVATION_SCHEMA):
+                self.add_observations(pd.DataFrame({
+                    'code': self._first_coding(batch.column('code'), 'code').to_pandas(),
+                    'display': self._first_coding(batch.column('code'), 'display').to_pandas(),
+                    'value_display': self._first_coding(batch.column('valueCodeableConcept'), 'display').to_pandas(),
+                    'value': batch.column('valueString').to_pandas(),
+                    }))
+
+    def _pandas_frames(self, path):
+        with ndjsonwriter.open_ndjson(path) as f:
+            yield from pd.read_json(f, lines=True, chunksize=self.chunk_size, dtype=False, convert_dates=False)
+
+    @staticmethod
+    def _column(frame, name):
+        return frame[name] if name in frame.columns else pd.Series(None, index=frame.index, dtype=object)
+
+    def _read_ndjson_pandas(self, directory):
+        for path in sorted(glob.glob(os.path.join(directory, 'Patient.*.ndjson*'))):
+            for frame in self._pandas_frames(path):
+                self.add_patients(pd.to_datetime(self._column(frame, 'birthDate'), errors='coerce').to_numpy(dtype='datetime64[D]'), self._column(frame, 'gender').to_numpy())
+        for path in sorted(glob.glob(os.path.join(directory, 'Observation.*.ndjson*'))):
+            for frame in self._pandas_frames(path):
+                coding = frame.code.str['coding'].str[0]
+                value = self._column(frame, 'valueCodeableConcept').str['coding'].str[0]
+                self.add_observations(pd.DataFrame({'code': coding.str['code'], 'display': coding.str['display'],
+                                                    'value_display': value.str['display'], 'value': self._column(frame, 'valueString')}))
+
+    def read_ndjson(self, directory):
+        """
+        Adds the Patient and Observation files of an NdjsonWriter output directory. With pyarrow, chunks are parsed by its
+        JSON reader into columns; otherwise by pandas' line reader. Either way the fields are pulled out with column
+        operations.
+        """
+        if pj is not None:
+            self._read_ndjson_arrow(directory)
+        else:
+            self._read_ndjson_pandas(directory)
+        return self
+
+    def read_parquet(self, directory):
+        """Adds the patients, observations and labs tables of a ColumnarExporter output directory."""
+        if pq is None:
+            raise ImportError('reading parquet requires the pyarrow package')
+        patients = pq.ParquetFile(os.path.join(directory, 'patients.parquet'))
+        for batch in patients.iter_batches(batch_size=self.chunk_size, columns=['birthdate', 'gender']):
+            self.add_patients(batch.column('birthdate').to_numpy(zero_copy_only=False), batch.column('gender').to_numpy(zero_copy_only=False))
+        observations = pq.ParquetFile(os.path.join(directory, 'observations.parquet'))
+        for batch in observations.iter_batches(batch_size=self.chunk_size, columns=['code', 'display', 'value_display']):
+            self.add_observations(batch.to_pandas().assign(value=None))
+        labs = pq.ParquetFile(os.path.join(directory, 'labs.parquet'))
+        for batch in labs.iter_batches(batch_size=self.chunk_size, columns=['code', 'display', 'value']):
+            self.add_observations(batch.to_pandas().assign(value_display=None))
+        return self
+
+    def read(self, directory):
+        """Adds an output directory and its worker subdirectories, detecting whether each holds Parquet tables or NDJSON files."""
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            if 'patients.parquet' in files:
+                self.read_parquet(root)
+            elif 'manifest.json' in files:
+                self.read_ndjson(root)
+        return self
+
+    def tables(self):
+        """
+        Builds the summary tables.
+
+        :returns: dictionary of table name: DataFrame
+        """
+        age = pd.DataFrame(self._age.reshape(len(GENDERS), len(AGE_LABELS)+1).T, index=pd.Index(AGE_LABELS + [NO_BIRTHDATE], name='age'), columns=GENDERS)
+        age['total'] = age.sum(axis=1)
+        tables = {'age': age}
+        for name in CATEGORIES:
+            counts = pd.Series(self._categories[name], dtype=np.int64).sort_index().sort_values(ascending=False, kind='stable')
+            tables[name] = pd.DataFrame({'count': counts, 'percent': (100*counts/max(counts.sum(), 1)).round(1)}).rename_axis(name)
+        labs = pd.DataFrame([(code, display, tests, positive) for (code, display), (tests, positive) in sorted(self._labs.items())], columns=['code', 'display', 'tests', 'positive']).set_index(['code', 'display'])
+        tables['labs'] = labs.assign(positivity=(100*labs.positive/labs.tests.clip(lower=1)).round(1))
+        return tables
+
+    def print_tables(self):
+        """Prints every summary table."""
+        print(self)
+        for name, table in self.tables().items():
+            print(f'\n--- {name.upper()} ---\n')
+            print(table.to_string())
+
+
+def main(args):
+    """Runs the summary subcommand of fpargenerator."""
+    FparSummary(chunk_size=args.chunk_size).read(args.input).print_tables()
@@ -2,13 +2,19 @@ import fhirclient.models.codeableconcept as cc
 import fhirclient.models.coding as c
 import fhirclient.models.fhirdate as fd
 import fhirclient.models.fhirreference as fr
+import fhirclient.models.identifier as ident
 import fhirclient.models.period as period
 import fhirclient.models.quantity as q
 from fhirclient import client
 from fhirclient import server
 from fhirclient import auth
+import flyweight
+import ratecontroller
+import records
+import referencedata
+import runlog
+import timestamps
 
-from pytz import timezone
 import json
 import pandas as pd
 import numpy as np
@@ -16,11 +22,48 @@ import random
 import requests
 import re
 import datetime
+import time
+import uuid
 import os
 os.chdir(os.path.dirname(os.path.realpath(__file__)))
 
+ENDPOINTS = {
+    'dev': 'https://api-v5-dstu2.hspconsortium.org/opafpardev/open/',
+    'test': 'https://api-v5-dstu2.hspconsortium.org/fparTEST/open/',
+    'fpar2': 'https://api-v5-dstu2-test.hspconsortium.org/fpar2/open/',
+    'fpardstu2': 'https://api-v5-dstu2.hspconsortium.org/fpardstu2/open/',
+    'patients': 'https://api-v5-dstu2.hspconsortium.org/FPARPatients/open/',
+    'hapi': 'http://hapi.fhir.org/baseDstu2/',
+    }
+
+def pooled_session(pool_maxsize):
+    """
+    requests.Session that keeps up to pool_maxsize connections open, so concurrent requests reuse them.
+
+    :param pool_maxsize: most concurrent requests, i.e. the max_limit of the limiter
+    :returns: requests.Session object
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
 class GenerateBase():
     """Base class used to share common methods used within other generate classes"""
+    journal = None
+    graph = None
+    writer = None
+    patient_key = None
+    run_seed = None
+    upload_mode = 'conditional'
+    server_url = ENDPOINTS['dev']
+    validate_url = ENDPOINTS['hapi']
+    limiter = ratecontroller.AdaptiveLimiter()
+    session = pooled_session(limiter.max_limit)
+    identifier_system = 'urn:ietf:rfc:3986'
+    identifier_namespace = uuid.UUID('5b0b7f0e-2f4e-4a51-9a36-5f1b7c0d2e61')
+
     @staticmethod
     def _generate_vitals():
         """
@@ -69,45 +112,25 @@ class GenerateBase():
             raise ValueError('sex error')
         return height, weight
 
-    @staticmethod
-    def _get_smoking_loinc():
-        """
-        Uses a get request from LOINC to obtain a list of smoking statuses and returns a random one.
-
-        :returns smoke_loinc, smoke_description
-        """
-        df = pd.read_html('https://s.details.loinc.org/LOINC/72166-2.html?sections=Comprehensive')[5]
-        df.columns = df.iloc[3,:]
-        df = df.iloc[4:,[3,5]]
-        df.columns = ['description','loinc']
-        smoke_description = random.choice(df.description.tolist())
-        smoke_loinc = df[df.description==smoke_description].loinc.values[0]
-        return smoke_loinc, smoke_description
-
     @staticmethod
     def _create_FHIRReference(resource):
         """
-        Used to create a FHIR reference object based on a FHIRClient.models object
+        Used to create a FHIR reference object based on a FHIRClient.models object. References to resources that already have an id are interned and shared; references to resources waiting in the upload graph are resolved when serialized.
 
-        :param resource: FHIRClient.models class object (i.e. Patient())
+        :param resource: record or FHIRClient.models class object (i.e. Patient())
         :returns: FHIRReference object
         """
-        FHIRReference = fr.FHIRReference()
-        FHIRReference.reference = f'{resource.resource_name}/{resource.id}'
-        return FHIRReference
+        return records.reference(resource)
 
     @staticmethod
     def _create_FHIRDate(date):
         """
-        Creates a FHIRDate object
+        Creates a FHIRDate object in US/Eastern with its ISO string pre-rendered by the timestamp service.
 
-        :param date: datetime object used to set the date in the FHIRDate object
+        :param date: datetime object or ISO string used to set the date in the FHIRDate object
         :returns: FHIRDate object
         """
-        eastern = timezone('US/Eastern')
-        FHIRDate = fd.FHIRDate()
-        FHIRDate.date = date.astimezone(eastern)
-        return FHIRDate
+        return timestamps.DEFAULT.fhir_date(date)
 
     def _create_FHIRPeriod(self,start=None,end=None):
         """
@@ -128,36 +151,130 @@ class GenerateBase():
         return Period
 
 
-    def _extract_id(self):
+    def _extract_id(self, response=None):
         """
-        Uses regex to parse out the id from the server response to posting. Current logic will not work with bundles.
+        Parses out the id from the server response to posting. Servers either return the resource itself (i.e. a conditional create that matched an existing resource) or an OperationOutcome whose diagnostics are parsed with regex. Current logic will not work with bundles.
 
         :param self:
+        :param response: json response. Default is self.response
         :returns: resource id type string
         """
-        regex = re.compile(r'[a-z]\/(\d+)\/',re.IGNORECASE)
-        id = regex.search(self.response['issue'][0]['diagnostics']).group(1)
+        if response is None:
+            response = self.response
+        if response.get('resourceType') not in (None, 'OperationOutcome') and 'id' in response:
+            return response['id']
+        regex = re.compile(r'[a-z]\/([a-z0-9\-\.]+)\/_history',re.IGNORECASE)
+        id = regex.search(response['issue'][0]['diagnostics']).group(1)
         return id
 
+    def _create_identifier(self, key):
+        """
+        Creates the business identifier of a resource. The value is a uuid derived from the run seed, the patient position and the resource key so a rerun of the same seed produces the same identifiers. Falls back to a random uuid outside of a seeded run.
+
+        :param self:
+        :param key: key of the resource within the patient graph
+        :returns: Identifier FHIR object
+        """
+        Identifier = ident.Identifier()
+        Identifier.system = self.identifier_system
+        Identifier.value = self._identifier_value(key)
+        return Identifier
+
+    def _identifier_value(self, key):
+        """Value of the business identifier of _create_identifier()."""
+        if self.run_seed is None:
+            return f'urn:uuid:{uuid.uuid4()}'
+        return self.identifier_value(self.run_seed, self.patient_key, key)
+
+    @classmethod
+    def identifier_value(cls, seed, patient_key, key):
+        """Identifier value of the resource key of a patient of a seeded run. Used to find the resources of a run again."""
+        return f'urn:uuid:{uuid.uuid5(cls.identifier_namespace, f"{seed}/{patient_key}/{key}")}'
+
+    @staticmethod
+    def _id_from_identifier(Identifier):
+        """Deterministic server id used when uploading with PUT. Starts with a letter as HAPI rejects purely numeric client ids."""
+        return GenerateBase._id_from_value(Identifier.value)
+
+    @staticmethod
+    def _id_from_value(value):
+        """_id_from_identifier() of an identifier value."""
+        return 'g' + value.rsplit(':', 1)[-1].replace('-', '')
+
+    def _commit_resource(self, resource, key=None, validate=True, depends=()):
+        """
+        Validates and posts a resource and records its id in the run journal. Resources already recorded in the journal for the current patient are not posted again. When an upload graph is active (GenerateBase.graph) the resource is added to the graph and uploaded by ResourceGraph.run() instead. When an output writer is active (GenerateBase.writer) the resource gets its deterministic id and is written offline without touching a server.
+
+        :param self:
+        :param resource: FHIR resource to be posted
+        :param key: key of the resource within the patient graph. Default is resource.resource_name
+        :param validate: validates the resource before posting
+        :param depends: resources referenced by this resource
+        :returns: resource id type string, None if the upload is deferred to the graph
+        """
+        if key is None:
+            key = resource.resource_name
+        if self.writer is not None and self.writer.discards:
+            # --export-only: the exporter only needs the id; no Identifier or FHIR resource is built
+            resource.id = self._id_from_value(self._identifier_value(key))
+            return resource.id
+        resource.identifier = [self._create_identifier(key)]
+        if self.writer is not None:
+            resource.id = self._id_from_identifier(resource.identifier[0])
+            self.writer.write(resource)
+            runlog.resource(resource.resource_name, resource.id, key, self.patient_key)
+            return resource.id
+        if self.upload_mode == 'put':
+            resource.id = self._id_from_identifier(resource.identifier[0])
+        if self.journal is not None:
+            id = self.journal.lookup(self.patient_key, key)
+            if id is not None:
+                resource.id = id
+                return id
+        if self.graph is not None:
+            self.graph.add(self, resource, key, depends, validate)
+            return None
+        return self._upload_resource(resource, key, validate)
+
+    def _upload_resource(self, resource, key, validate=True):
+        """
+        Validates, posts and journals a single resource. Safe to call from several threads.
+
+        :param self:
+        :param resource: record or FHIR resource to be posted. Records are converted to FHIR here and the FHIR object is dropped after posting.
+        :param key: key of the resource within the patient graph
+        :param validate: validates the resource before posting
+        :returns: resource id type string
+        """
+        Resource = resource.to_fhir() if isinstance(resource, records.Record) else resource
+        if validate:
+            self._validate(Resource)
+        start = time.monotonic()
+        response = self.post_resource(Resource)
+        seconds = time.monotonic() - start
+        self.response = response
+        if self.upload_mode != 'put':
+            resource.id = self._extract_id(response)
+        if self.journal is not None:
+            self.journal.record(self.patient_key, key, resource.resource_name, resource.id)
+        runlog.resource(resource.resource_name, resource.id, key, self.patient_key, seconds)
+        return resource.id
+
     @staticmethod
     def _create_FHIRCoding(code, system=None, display=None):
         """
-        Creates and returns a FHIRCoding object.
+        Returns an interned FHIRCoding object. Identical codings share a single frozen object.
 
         :param code: code from standard System
         :param system: coding System
         :param display: how the resource should be displayed
         :returns: Coding FHIR object
         """
-        Coding = c.Coding()
-        Coding.code = code
-        Coding.system = system
-        Coding.display = display
-        return Coding
+        return flyweight.coding(code, system, display)
 
     def _create_FHIRCodeableConcept(self,code, system=None ,display=None):
         """
-        Creates and returns a FHIRCodeableConcept object. References self._create_FHIRCoding()
+        Returns an interned FHIRCodeableConcept object. Identical concepts share a single frozen object.
 
         :param self:
         :param code: code from standard System
@@ -165,51 +282,72 @@ class GenerateBase():
         :param display: how the resource should be displayed
         :returns: CodeableConcept FHIR object
         """
-        CodeableConcept = cc.CodeableConcept()
-        Coding = self._create_FHIRCoding(code,system,display)
-        CodeableConcept.coding = [Coding]
-        return CodeableConcept
+        return flyweight.codeable_concept(code, system, display)
 
-    @staticmethod
-    def _validate(resource):
+    @classmethod
+    def use_limiter(cls, limiter):
+        """
+        Replaces the adaptive limiter and the shared session with one whose pool holds limiter.max_limit connections.
+
+        :param limiter: ratecontroller.AdaptiveLimiter object
+        """
+        cls.session.close()
+        cls.limiter = limiter
+        cls.session = pooled_session(limiter.max_limit)
+
+    @classmethod
+    def _send(cls, method, url, **kwargs):
+        """
+        Sends a request to a FHIR server. All server I/O goes through the shared session and the adaptive limiter.
+
+        :param method: http method
+        :param url: request url
+        :returns: requests.Response object
+        """
+        return cls.limiter.request(cls.session, method, url, **kwargs)
+
+    @classmethod
+    def _validate(cls, resource):
         """
         Posts a request to hardcoded server to validate a resource. Will print errors/issues.
 
         :param resource: FHIR resource to be validated.
         :returns: None
         """
-        returned = requests.post(f'http://hapi.fhir.org/baseDstu2/{resource.resource_name}/$validate?profile=http://fhir.org/guideasdfasdfs/argonaut/StructureDefinition/argo-condition', data=json.dumps(resource.as_json()))
-        """
-        Other Servers:
-            - https://api-v5-dstu2-test.hspconsortium.org/fpar2/open/
-            - http://hapi.fhir.org/baseDstu2/
-            - https://api-v5-dstu2.hspconsortium.org/fpardstu2/open/
-            - http://hapi.fhir.org/baseDstu2
-        """
+        returned = cls._send('post', f'{cls.validate_url}{resource.resource_name}/$validate?profile=http://fhir.org/guideasdfasdfs/argonaut/StructureDefinition/argo-condition', data=json.dumps(resource.as_json()))
         # print(returned.text)
         # for issue in returned.json()['issue']:
         #     print(issue['diagnostics'])
 
-    @staticmethod
-    def post_resource(resource):
+    @classmethod
+    def post_resource(cls, resource, retries=3):
         """
         DSTU2 errors with resource.create(). This function is the DSTU2 version of posting resources.
 
+        Resources that carry an identifier are uploaded idempotently: either as a conditional create (If-None-Exist) or, when upload_mode is 'put', as an update to their deterministic id. Failed requests are therefore safe to retry.
+
         :param resource: FHIR resource object that is to be validated
+        :param retries: number of retries on connection errors, 429 and 5xx responses
         :returns: json response
         """
-        response = requests.post(f'https://api-v5-dstu2.hspconsortium.org/opafpardev/open/{resource.resource_name}',data=json.dumps(resource.as_json()))
-        """
-        Other Servers:
-            - https://api-v5-dstu2-test.hspconsortium.org/fpar2/open/
-            - http://hapi.fhir.org/baseDstu2/
-            - https://api-v5-dstu2.hspconsortium.org/fpardstu2/open/
-            - https://api-v5-dstu2.hspconsortium.org/opafpardev/open/
-            - https://api-v5-dstu2.hspconsortium.org/FPARPatients/open/
-            - https://api-v5-dstu2.hspconsortium.org/fparTEST/open/
-            - https://api-v5-dstu2.hspconsortium.org/opafpardev/open/
-
-        """
+        url = f'{cls.server_url}{resource.resource_name}'
+        data = json.dumps(resource.as_json())
+        headers = {'Content-Type': 'application/json+fhir'}
+        method = 'post'
+        if cls.upload_mode == 'put' and resource.id is not None:
+            url = f'{url}/{resource.id}'
+            method = 'put'
+        elif resource.identifier:
+            headers['If-None-Exist'] = f'identifier={resource.identifier[0].system}|{resource.identifier[0].value}'
+        for attempt in range(retries+1):
+            try:
+                response = cls._send(method, url, data=data, headers=headers)
+                if (response.status_code < 500 and response.status_code != 429) or attempt == retries:
+                    break
+            except requests.exceptions.ConnectionError:
+                if attempt == retries:
+                    raise
+            time.sleep(2**attempt)
         return response.json()
 
     @staticmethod
@@ -275,18 +413,9 @@ class GenerateBase():
 
         :returns: name_last, [name_first], gender
         """
-        name_first_dict = {}
-        df = pd.read_excel('../demographic_files/common_name_first.xlsx')
-        name_first_dict['male'] = df.men.tolist()
-        name_first_dict['female'] = df.women.tolist()
-
-        name_last_list = []
-        df = pd.read_excel('../demographic_files/common_name_last.xlsx')
-        name_last_list = df.name_last.tolist()
-
         gender = random.choice(['male','female'])
-        name_first = random.choice(name_first_dict[gender])
-        name_last = random.choice(name_last_list)
+        name_first = referencedata.choice(f'name_first_{gender}')
+        name_last = referencedata.choice('name_last')
 
         return name_last, [name_first], gender
 
@@ -312,59 +441,48 @@ class GenerateBase():
         :param measurement: measurement dictionary
         :returns: Observation FHIR object
         """
-        CodeableConcept = cc.CodeableConcept()
-        Coding = c.Coding()
-        Coding.system = 'http://loinc.org'
-        Coding.code = self.observation_dict[measurement]['value_loinc']
-        Coding.display = self.observation_dict[measurement]['value_display']
-        CodeableConcept.coding = [Coding]
-        Observation.valueCodeableConcept = CodeableConcept
+        Observation.valueCodeableConcept = self._create_FHIRCodeableConcept(self.observation_dict[measurement]['value_loinc'], 'http://loinc.org', self.observation_dict[measurement]['value_display'])
         return Observation
 
-    def _add_value(self,Observation,measurement):
+    @staticmethod
+    def _add_value(Observation,measurement):
         """
         Adds values to an Observation FHIR object. Uses 'type' within dictionary to determine logic.
 
-        :param self:
         :param Observation: Observation FHIR object.
         :param measurement: Specific observation measurement. References a dictionary.
         :returns: Observation FHIR object.
         """
-        if measurement['type'] == 'quantity':
-            Observation.valueCodeableConcept = self._create_FHIRCodeableConcept(code=measurement['code'], system=measurement['system'], display=measurement['display'])
-        elif measurement['type'] == 'codeable':
-            Quantity = q.Quantity()
-            Quantity.value = self.observation_dict[measurement]['value']
-            Quantity.unit = self.observation_dict[measurement]['unit']
-            Observation.valueQuantity = Quantity
-        elif measurement['type'] == 'valuestring':
-            Observation.valueString = measurement['value']
-        return Observation
+        return records.add_value(Observation, measurement)
 
     @staticmethod
-    def _generate_vitals():
+    def _generate_vitals(random_state=None):
         """
         Generates a set of vitals using a normal distribution times 10
 
+        :param random_state: numpy RandomState. Default is the global numpy state of the seeded patient.
         :returns: sbp, dbp, hr
         """
+        random_state = random_state or np.random
         avg_sbp = 120
         avg_dbp  = 80
-        diff = int(np.random.normal(0,1)*10)
+        diff = int(random_state.normal(0,1)*10)
         sbp = avg_sbp + diff
         dbp = avg_dbp + diff
 
         avg_hr = 80
-        diff = int(np.random.normal(0,1)*10)
+        diff = int(random_state.normal(0,1)*10)
         hr = avg_hr + diff
         return sbp, dbp, hr
 
     @staticmethod
-    def _generate_height_weight(sex):
+    def _generate_height_weight(sex, random_state=None):
         """
-        Generates a set of vitals using a normal distribution times 10
+        Generates height and weight roughly inline with US stats.
 
-        :returns: sbp, dbp, hr
+        :param sex: sex of person
+        :param random_state: numpy RandomState. Default is the global numpy and random state of the seeded patient.
+        :returns: height, weight
         """
         avg_height_male = 69.2
         std_height_male = 4
@@ -377,13 +495,14 @@ class GenerateBase():
         std_weight_female = 25
 
         if sex =='unknown':
-            sex = random.choice(['male','female'])
+            sex = random.choice(['male','female']) if random_state is None else ['male','female'][random_state.randint(2)]
+        random_state = random_state or np.random
         if sex == 'male':
-            height = np.random.normal(avg_height_male,std_height_male)
-            weight = np.random.normal(avg_weight_male,std_weight_male)
+            height = random_state.normal(avg_height_male,std_height_male)
+            weight = random_state.normal(avg_weight_male,std_weight_male)
         elif sex == 'female':
-            height = np.random.normal(avg_height_female,std_height_female)
-            weight = np.random.normal(avg_weight_female,std_weight_female)
+            height = random_state.normal(avg_height_female,std_height_female)
+            weight = random_state.normal(avg_weight_female,std_weight_female)
         else:
             raise ValueError('sex error')
         return height, weight
@@ -391,34 +510,21 @@ class GenerateBase():
     @staticmethod
     def _get_smoking_loinc():
         """
-        Uses a get request from LOINC to obtain a list of smoking statuses and returns a random one.
+        Picks a random smoking status from the US Core smoking status valueset (see referencedata).
 
         :returns: smoke_loinc, smoke_description
         """
-        df = pd.read_html('http://hl7.org/fhir/us/core/stu1/ValueSet-us-core-observation-ccdasmokingstatus.html')[1]
-        headers = df.iloc[0,:2].tolist()
-        df = df.iloc[1:,:2]
-        df.columns = headers
-        smoke_description = random.choice(df.Display.tolist())
-        smoke_loinc = df[df.Display==smoke_description].Code.values[0]
-        return smoke_loinc, smoke_description
+        return referencedata.choice('smoke_loinc', 'smoke_description')
 
     def _get_household_income(self):
-        """Requests values of household income and selects one at random."""
-        df = pd.read_html('https://r.details.loinc.org/LOINC/77244-2.html?sections=Comprehensive')[4]
-        df = df.iloc[4:,[3,5]]
-        df.columns = ['income_range','answer_id']
-        self.income_range = random.choice(df.income_range.tolist())
-        self.income_loinc = df[df.income_range == self.income_range].answer_id.values[0]
+        """Selects a household income answer of LOINC 77244-2 at random."""
+        self.income_range, self.income_loinc = referencedata.choice('income_range', 'income_loinc')
 
     def _get_pregnancy_status(self):
         """Currently hardcoded to give Not Pregnant"""
-        df = pd.read_html('https://s.details.loinc.org/LOINC/82810-3.html')[5]
-        df = df.iloc[4:,[3,5]]
-        df.columns = ['pregnancy_display','pregnancy_id']
-        df.iloc[2,0] = 'Unknown'
-        self.pregnancy_display = df[df.pregnancy_display == 'Not pregnant'].pregnancy_display.values[0]
-        self.pregnancy_loinc = df[df.pregnancy_display == self.pregnancy_display].pregnancy_id.values[0]
+        data = referencedata.get()
+        i = np.flatnonzero(data['pregnancy_display'] == 'Not pregnant')[0]
+        self.pregnancy_display, self.pregnancy_loinc = data['pregnancy_display'][i].item(), data['pregnancy_loinc'][i].item()
 
     def _generate_gravidity_and_parity(self,patient):
         """Generates a gravidity and parity between 0 and 6"""
@@ -434,12 +540,9 @@ class GenerateBase():
     @staticmethod
     def _get_fpar_random_value(item_name):
         """
-        Used in generating fpar observations. Hardcoded to look at valuesets within file and picks at random.
+        Used in generating fpar observations. Picks at random from the valueset.xlsx values of an item (see referencedata).
 
         :param item_name: Observation name which is determined by listing in hardcoded file.
         :returns: random value from valueset
         """
-        df = pd.read_excel('../demographic_files/valueset.xlsx',sheet_name='Sheet1')
-        df = df.fillna('N/A')
-        item_value = df[df.item == item_name].valueset.tolist()
-        return random.choice(item_value)
+        return referencedata.choice('fpar_value', mask=referencedata.get()['fpar_item'] == item_name)
@@ -1,22 +1,22 @@
 import generatebase
 import generatepatient
-
-import fhirclient.models.codeableconcept as cc
-import fhirclient.models.coding as c
-import fhirclient.models.condition as cond
+import records
+import referencedata
 
 import random
-import pandas as pd
+import numpy as np
 import os
 os.chdir(os.path.dirname(os.path.realpath(__file__)))
 
 
 class GenerateCondition(generatebase.GenerateBase):
-    def __init__(self, Patient=None):
+    def __init__(self, Patient=None, key=None):
         """
-        Uses fhirclient.models to create, validate, and post a Condition FHIR resource.
+        Creates, validates, and posts a Condition resource.
 
-        :returns: GenerateCondition object which has Condition object as an attribute.
+        :param Patient: PatientRecord. Default generates one.
+        :param key: key of the resource within the patient graph. Default is 'Condition'.
+        :returns: GenerateCondition object which has a ConditionRecord as the Condition attribute.
         """
 
         if Patient == None:
@@ -26,37 +26,24 @@ class GenerateCondition(generatebase.GenerateBase):
 
         self._generate_icd_code()
 
-        Condition = cond.Condition()
-        Condition.clinicalStatus = 'active'
-        Condition.verificationStatus = 'confirmed'
-        # Condition.verificationStatus = 'active'
-        # Condition.category = self._create_FHIRCodeableConcept(code='problem', system='urn:oid:2.16.840.1.113883.4.642.3.153', display='Problem List Item')
-
-        Condition.code = self._create_FHIRCodeableConcept(code=self.icd_code,system='urn:oid:2.16.840.1.113883.6.3',display=self.icd_description)
-        Condition.patient = self._create_FHIRReference(self.Patient)
-
-        self._validate(Condition)
-        self.response = self.post_resource(Condition)
-        Condition.id = self._extract_id()
+        Condition = records.ConditionRecord(self.icd_code, self.icd_description, self.Patient)
+        self._commit_resource(Condition, key=key, depends=[self.Patient])
         self.Condition = Condition
-        self.Condition.Patient = self.Patient
-        print(self)
 
     def __str__(self):
-        return f'{self.Condition.__class__.__name__}:{self.icd_description}; id: {self.Condition.id}'
+        return f'{self.Condition.resource_name}:{self.icd_description}; id: {self.Condition.id}'
 
     @staticmethod
     def __repr__():
         return 'GenerateCondition()'
 
     def _generate_icd_code(self):
-        """Generates an icd code at random from a hardcoded file."""
-        df = pd.read_excel('../demographic_files/common_obgyn_visits_parsed.xlsx',sheet_name='for OPA')
-        icd_list = []
-        for row in df.iterrows():
-            icd_list += row[1][0]*[row[1][1]]
-        self.icd_code = random.choice(icd_list)
-        self.icd_description = df[df.code==self.icd_code].description.values[0]
+        """Generates an icd code at random, weighted by the visit factors of common_obgyn_visits_parsed.xlsx (see referencedata)."""
+        data = referencedata.get()
+        cum_weight = data['icd_cum_weight']
+        i = int(np.searchsorted(cum_weight, random.randrange(cum_weight[-1]), side='right'))
+        self.icd_code = data['icd_code'][i].item()
+        self.icd_description = data['icd_description'][i].item()
 
 if __name__ == '__main__':
 	GenerateCondition()
@@ -3,96 +3,79 @@ import generatepatient
 import generatelocation
 import generatecondition
 import generatepractitioner
-
-import fhirclient.models.codeableconcept as cc
-import fhirclient.models.coding as c
-import fhirclient.models.encounter as enc
-import fhirclient.models.fhirdate as fd
-import fhirclient.models.fhirreference as fr
-import fhirclient.models.humanname as hn
-import fhirclient.models.location as l
-import fhirclient.models.patient as p
-import fhirclient.models.period as period
-import fhirclient.models.practitioner as pr
+import records
+import timestamps
 
 import datetime
+import numpy as np
 import os
 os.chdir(os.path.dirname(os.path.realpath(__file__)))
 
 class GenerateEncounter(generatebase.GenerateBase):
 
 
-    def __init__(self, Patient=None, Provider=None, Location=None, Condition=None, Period=None, status='in-progress', fhir_class='outpatient'):
-        """Uses fhirclient.models to create encounter resource"""
-
+    def __init__(self, Patient=None, Practitioner=None, Location=None, Condition=None, start=None, minutes=60, status='finished', fhir_class='outpatient', visit=None):
+        """
+        Creates, validates, and posts a DSTU2 Encounter resource for a visit of the patient.
+
+        :param Patient: PatientRecord. Default generates one.
+        :param Practitioner: PractitionerRecord. Default generates one.
+        :param Location: Location FHIR object. Default generates one.
+        :param Condition: ConditionRecord of the patient. Referenced as the indication of the visit. Default generates one.
+        :param start: datetime64 local visit time (from TimestampService.timelines) or datetime object. Default is now.
+        :param minutes: length of the visit in minutes
+        :param status: DSTU2 encounter state
+        :param fhir_class: DSTU2 encounter class
+        :param visit: position of the visit within the patient's timeline. Part of the resource key so every visit gets its own identifier.
+        :returns: GenerateEncounter object which has an EncounterRecord as the Encounter attribute.
+        """
         if Patient is not None and Condition is not None:
-            if Patient.id != Condition.Patient.id:
-                raise ValueError('Patient.id must equal Conditition.Patient.id.')
+            if Patient is not Condition.patient:
+                raise ValueError('Condition.patient must be Patient.')
             self.Patient = Patient
             self.Condition = Condition
         elif Condition is None and Patient is None:
             self.Condition = generatecondition.GenerateCondition().Condition
-            self.Patient = self.Condition.Patient
+            self.Patient = self.Condition.patient
         elif Condition is not None and Patient is None:
             self.Condition = Condition
-            self.Patient = self.Condition.Patient
-        elif Condition is None and Patient is not None:
+            self.Patient = self.Condition.patient
+        else:
             self.Patient = Patient
             self.Condition = generatecondition.GenerateCondition(Patient=self.Patient).Condition
-        else:
-            raise ValueError('Error with Patient and Condition values')
 
-        if Location == None:
+        if Location is None:
             self.Location = generatelocation.GenerateLocation().Location
         else:
             self.Location = Location
 
-        if Period == None:
-            self.Period = self._create_FHIRPeriod()
-        else:
-            self.Period = Period
-
-        if Provider == None:
+        if Practitioner is None:
             self.Practitioner = generatepractitioner.GeneratePractitioner().Practitioner
         else:
-            self.Practitioner = Provider
+            self.Practitioner = Practitioner
+
+        if start is None:
+            start = datetime.datetime.now()
+        if isinstance(start, datetime.datetime):
+            start = np.datetime64(start.astimezone(timestamps.DEFAULT.tz).replace(tzinfo=None), 's')
+        start = np.datetime64(start, 's')
+        self.start, self.end = (str(t) for t in timestamps.DEFAULT.render_many([start, start + np.timedelta64(minutes*60, 's')]))
 
         self.status = status
         self.fhir_class = fhir_class
+        self.visit = visit
 
-        Encounter = enc.Encounter()
-        Coding = c.Coding()
-        Coding.code = self.fhir_class
-        Encounter.class_fhir = Coding
-
-        Encounter.status = self.status
-
-        EncounterLocation = enc.EncounterLocation()
-        EncounterLocation.location = self._create_FHIRReference(self.Location)
-        Encounter.location = [EncounterLocation]
-
-        Encounter.subject = self._create_FHIRReference(self.Patient)
-
-        EncounterDiagnosis = enc.EncounterDiagnosis()
-        EncounterDiagnosis.condition = self._create_FHIRReference(self.Condition)
-        Encounter.diagnosis = [EncounterDiagnosis]
-
-        EncounterParticipant = enc.EncounterParticipant()
-        EncounterParticipant.individual = self._create_FHIRReference(self.Practitioner)
-        Encounter.participant = [EncounterParticipant]
-
-        Encounter.period = self.Period
+        Encounter = records.EncounterRecord(self.Patient, self.Practitioner, self.Condition, self.Location, self.start, self.end, status=self.status, class_code=self.fhir_class)
+        key = 'Encounter' if visit is None else f'Visit{visit}/Encounter'
+        self._commit_resource(Encounter, key=key, depends=[self.Patient, self.Practitioner, self.Condition, self.Location])
+        self.Encounter = Encounter
 
-        # self._validate(Encounter)
-        self.response = Encounter.create(server=self.connect2server().server)
-        Encounter.id = self._extract_id()
+    def __str__(self):
+        return f'{self.Encounter.resource_name}:{self.start}; id: {self.Encounter.id}'
 
-        self.Encounter = Encounter
-        self.Encounter.Patient = self.Patient
-        self.Encounter.Condition = self.Condition
-        self.Encounter.Location = self.Location
-        self.Encounter.Period = self.Period
-        self.Encounter.Practitioner = self.Practitioner
+    @staticmethod
+    def __repr__():
+        return 'GenerateEncounter()'
 
 if __name__ == '__main__':
     GenerateEncounter()
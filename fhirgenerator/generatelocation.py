@@ -16,12 +16,35 @@ class GenerateLocation(generatebase.GenerateBase):
     location_longitude = -79.960779
     location_latitude = 40.437123
 
-    def __init__(self):
+    def __init__(self, name=None, line=None, city=None, postal_code=None, state=None, latitude=None, longitude=None, Organization=None, key=None):
         """
-        Uses fhirclient.models to create and post location resource. Currently, using class variables.
+        Uses fhirclient.models to create and post location resource. Values that are not given default to the class variables.
 
+        :param name: location name
+        :param line: list of address lines
+        :param city: address city
+        :param postal_code: address zipcode
+        :param state: address state
+        :param latitude: position latitude
+        :param longitude: position longitude
+        :param Organization: OrganizationRecord managing the location
+        :param key: key of the resource within the patient graph. Default is 'Location'.
         :returns: GenerateLocation object that has Location object as an attribute.
         """
+        if name is not None:
+            self.location_name = name
+        if line is not None:
+            self.location_line = line
+        if city is not None:
+            self.location_city = city
+        if postal_code is not None:
+            self.location_postalCode = postal_code
+        if state is not None:
+            self.location_state = state
+        if latitude is not None:
+            self.location_latitude = latitude
+        if longitude is not None:
+            self.location_longitude = longitude
         Location = l.Location()
         LocationPosition = l.LocationPosition()
         Address = a.Address()
@@ -35,11 +58,12 @@ class GenerateLocation(generatebase.GenerateBase):
         LocationPosition.latitude = self.location_latitude
         LocationPosition.longitude = self.location_longitude
         Location.position = LocationPosition
-        # self._validate(Location)
-        self.response = self.post_resource(Location)
-        Location.id = self._extract_id()
+        depends = ()
+        if Organization is not None:
+            Location.managingOrganization = self._create_FHIRReference(Organization)
+            depends = [Organization]
+        self._commit_resource(Location, key=key, validate=False, depends=depends)
         self.Location = Location
-        print(self)
 
     def __str__(self):
         return f'{self.Location.__class__.__name__}:{self.location_name}; id: {self.Location.id}'
@@ -4,28 +4,31 @@ import generatepractitioner
 import generateencounter
 import generateobservationdict
 import generatefparlabs
-
-import fhirclient.models.codeableconcept as cc
-import fhirclient.models.coding as c
-import fhirclient.models.observation as o
-import fhirclient.models.patient as p
+import records
+import timestamps
 
 import datetime
+import itertools
 import os
 os.chdir(os.path.dirname(os.path.realpath(__file__)))
 
 class GenerateObservation(generatebase.GenerateBase):
 
-    def __init__(self,observation_dict,dt=datetime.datetime.now(),Patient=None, Practitioner=None):
+    def __init__(self,observation_dict,dt=None,Patient=None, Practitioner=None, Encounter=None, visit=None, key_prefix=None):
         """
-        Creates, validates, and posts an Observation FHIR _generate_patient_fhir_object.
+        Creates, validates, and posts an Observation resource per observation_dict entry. The Observation attribute is the last ObservationRecord.
 
         :param observation_dict: dictionary of observations
-        :param dt: datetime of observation. Default is now.
-        :param Patient: Patient FHIR object.
-        :param Practitioner: Practioner FHIR object.
+        :param dt: datetime of observation, or a list of datetimes/ISO strings with one effective time per observation. Default is now.
+        :param Patient: PatientRecord or Patient FHIR object.
+        :param Practitioner: PractitionerRecord or Practioner FHIR object. Default is the practitioner of Encounter, or a new one without an Encounter.
+        :param Encounter: EncounterRecord of the visit the observations were taken at. Default links no encounter.
+        :param visit: position of the visit within the patient's timeline. Part of the resource keys so every visit gets its own identifiers.
+        :param key_prefix: prefix of the resource keys, i.e. 'TopUp3/'. Default is derived from visit.
         :returns: GenerateObservation object that has Observation as an attribute.
         """
+        if dt is None:
+            dt = datetime.datetime.now()
         self.dt = dt
 
         if Patient is None:
@@ -33,7 +36,9 @@ class GenerateObservation(generatebase.GenerateBase):
         else:
             self.Patient = Patient
 
-        if Practitioner is None:
+        if Practitioner is None and Encounter is not None:
+            self.Practitioner = Encounter.practitioner
+        elif Practitioner is None:
             self.Practitioner = generatepractitioner.GeneratePractitioner().Practitioner
         else:
             self.Practitioner = Practitioner
@@ -82,31 +87,33 @@ class GenerateObservation(generatebase.GenerateBase):
         #     raise ValueError('Error with Patient, Encounter, and Practitioner values.')
         # self.Patient = generatepatient.GeneratePatient().Patient
 
+        self.Encounter = Encounter
+        self.visit = visit
         self.observation_dict = observation_dict
 
         if not isinstance(self.observation_dict,dict):
             raise ValueError('observation_dict needs to be a dictionary of observations')
 
-        for obs,value in self.observation_dict.items():
-            self.obs = obs
-            Observation = o.Observation()
-
-            Observation.code = self._create_FHIRCodeableConcept(code=value['code'], system=value['system'], display=value['display'])
-            Observation.status = 'final'
-            Observation.subject = self._create_FHIRReference(self.Patient)
-            Observation.performer = [self._create_FHIRReference(self.Practitioner)]
-
-            Observation = self._add_value(Observation,value)
-            Observation.effectiveDateTime = self._create_FHIRDate(self.dt)
+        if isinstance(self.dt, datetime.datetime):
+            effectiveDateTimes = itertools.repeat(timestamps.DEFAULT.render(self.dt))
+        else:
+            if len(self.dt) != len(self.observation_dict):
+                raise ValueError('dt needs one effective time per observation')
+            effectiveDateTimes = (dt if isinstance(dt, str) else timestamps.DEFAULT.render(dt) for dt in self.dt)
 
-            self._validate(Observation)
-            self.response = self.post_resource(Observation)
-            Observation.id = self._extract_id()
+        if key_prefix is not None:
+            prefix = key_prefix
+        else:
+            prefix = '' if self.visit is None else f'Visit{self.visit}/'
+        depends = [self.Patient, self.Practitioner] if self.Encounter is None else [self.Patient, self.Practitioner, self.Encounter]
+        for (obs,value),effectiveDateTime in zip(self.observation_dict.items(),effectiveDateTimes):
+            self.obs = obs
+            Observation = records.ObservationRecord(obs, value, effectiveDateTime, self.Patient, self.Practitioner, self.Encounter)
+            self._commit_resource(Observation, key=f'{prefix}Observation/{obs}', depends=depends)
             self.Observation = Observation
-            print(self)
 
     def __str__(self):
-        return f'{self.Observation.__class__.__name__}:{self.obs}; id: {self.Observation.id}'
+        return f'{self.Observation.resource_name}:{self.obs}; id: {self.Observation.id}'
 
     @staticmethod
     def __repr__():
@@ -1,7 +1,5 @@
 import generatebase
-import fhirclient.models.organization as org
-import fhirclient.models.address as a
-import fhirclient.models.contactpoint as cp
+import records
 import os
 os.chdir(os.path.dirname(os.path.realpath(__file__)))
 
@@ -13,33 +11,37 @@ class GenerateOrganization(generatebase.GenerateBase):
     organization_postalCode = '15213'
     organization_state = 'PA'
 
-    def __init__(self):
+    def __init__(self, name=None, phone=None, line=None, city=None, postal_code=None, state=None, key=None):
         """
-        Creates, validates, and posts an Organization FHIR resource. Currently, using class variables.
+        Creates, validates, and posts an Organization resource. Values that are not given default to the class variables. The Organization attribute is an OrganizationRecord; see records.py.
 
+        :param name: organization name
+        :param phone: phone number
+        :param line: list of address lines
+        :param city: address city
+        :param postal_code: address zipcode
+        :param state: address state
+        :param key: key of the resource within the patient graph. Default is 'Organization'.
         :returns: practitioner id created by server
         """
-        Organization = org.Organization()
-        Organization.active = True
-        Organization.name = self.organization_name
-        Address = a.Address()
-        Address.line = self.organization_line
-        Address.city = self.organization_city
-        Address.postalCode = self.organization_postalCode
-        Address.state = self.organization_state
-        Organization.address = [Address]
-        ContactPoint = cp.ContactPoint()
-        ContactPoint.system = 'phone'
-        ContactPoint.value = self.organization_phone
-        Organization.telecom = [ContactPoint]
-        self._validate(Organization)
-        self.response = self.post_resource(Organization)
-        Organization.id = self._extract_id()
+        if name is not None:
+            self.organization_name = name
+        if phone is not None:
+            self.organization_phone = phone
+        if line is not None:
+            self.organization_line = line
+        if city is not None:
+            self.organization_city = city
+        if postal_code is not None:
+            self.organization_postalCode = postal_code
+        if state is not None:
+            self.organization_state = state
+        Organization = records.OrganizationRecord(self.organization_name, self.organization_phone, self.organization_line, self.organization_city, self.organization_postalCode, self.organization_state)
+        self._commit_resource(Organization, key=key)
         self.Organization = Organization
-        print(self)
 
     def __str__(self):
-        return f'{self.Organization.__class__.__name__}:{self.organization_name}; id: {self.Organization.id}'
+        return f'{self.Organization.resource_name}:{self.organization_name}; id: {self.Organization.id}'
 
     @staticmethod
     def __repr__():
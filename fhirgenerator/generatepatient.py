@@ -1,13 +1,7 @@
 import generatebase
 import generateorganization
-import fhirclient.models.address as a
-import fhirclient.models.codeableconcept as cc
-import fhirclient.models.coding as c
-import fhirclient.models.extension as e
-import fhirclient.models.fhirdate as fd
-import fhirclient.models.humanname as hn
-# import fhirclient.models.organization as org
-import fhirclient.models.patient as p
+import records
+import referencedata
 
 import pandas as pd
 import random
@@ -20,66 +14,49 @@ import json
 os.chdir(os.path.dirname(os.path.realpath(__file__)))
 
 class GeneratePatient(generatebase.GenerateBase):
-    def __init__(self,Organization=None):
+    def __init__(self,Organization=None,zipcode_row=None,identity=None):
         """
-        Creates, validates, and posts a Patient FHIR object. Patient characteristics are autogenerated.
+        Creates, validates, and posts a Patient resource. Patient characteristics are autogenerated.
 
-        :returns: GeneratePatient object with a Patient object as an attribute.
+        :param Organization: managing OrganizationRecord. Default generates one.
+        :param zipcode_row: row of the referencedata zipcode tables to use for the address, i.e. drawn by ClinicNetwork.sample_patients. Default picks one at random.
+        :param identity: identity.Identity with the patient's unique MRN and name. Default picks the name at random and creates no MRN.
+
+        :returns: GeneratePatient object with a PatientRecord as the Patient attribute.
         """
         if Organization is None:
             self.Organization = generateorganization.GenerateOrganization().Organization
         else:
             self.Organization = Organization
 
-        name_first_dict,name_last_list,street_list,state_list,zipcode_df = self._generate_patient_data()
         self.gender = random.choice(['male']*4+['female']*94+['unknown']*2) #95% women
-        if self.gender == 'unknown':
-            self.name_first = random.choice(name_first_dict[random.choice(['male','female'])])
+        name_gender = random.choice(['male','female']) if self.gender == 'unknown' else self.gender
+        self.name_middle = self.mrn = None
+        if identity is None:
+            self.name_first = referencedata.choice(f'name_first_{name_gender}').upper()
+            self.name_last = referencedata.choice('name_last')
         else:
-            self.name_first = random.choice(name_first_dict[self.gender])
-        self.name_first = self.name_first.upper()
-        self.name_last = random.choice(name_last_list)
+            self.name_first, self.name_middle, self.name_last = identity.name(name_gender)
+            self.mrn = identity.mrn
         self.bday = self._generate_bday()
         self.address_number = random.randint(1,9999)
-        self.address_street = random.choice(street_list)
-        city_state_zip = random.randint(0,zipcode_df.shape[0])
-        self.city = zipcode_df.loc[city_state_zip].City
-        self.state = zipcode_df.loc[city_state_zip].State
-        self.zipcode = str(zipcode_df.loc[city_state_zip].Zipcode)
+        self.address_street = referencedata.choice('street')
+        if zipcode_row is None:
+            self.zipcode, self.city, self.state = referencedata.choice('zipcode', 'zipcode_city', 'zipcode_state')
+        else:
+            data = referencedata.get()
+            self.zipcode, self.city, self.state = (data[name][zipcode_row].item() for name in ('zipcode', 'zipcode_city', 'zipcode_state'))
         self._get_race_coding()
         self._get_ethnicity_coding()
         self.id = self._generate_patient_fhir_object()
 
     def __str__(self):
-        return f'{self.Patient.__class__.__name__}:{self.name_last},{self.name_first}; id: {self.Patient.id}'
+        return f'{self.Patient.resource_name}:{self.name_last},{self.name_first}; id: {self.Patient.id}'
 
     @staticmethod
     def __repr__():
         return 'GeneratePatient()'
 
-    @staticmethod
-    def _generate_patient_data():
-        """Picks random patient data from multiple sources"""
-        name_first_dict = {}
-        df = pd.read_excel('../demographic_files/common_name_first.xlsx')
-        name_first_dict['male'] = df.men.tolist()
-        name_first_dict['female'] = df.women.tolist()
-
-        name_last_list = []
-        df = pd.read_excel('../demographic_files/common_name_last.xlsx')
-        name_last_list = df.name_last.tolist()
-
-        street_list = ['Second', 'Third', 'First', 'Fourth', 'Park', 'Fifth', 'Main', 'Sixth', 'Oak', 'Seventh', 'Pine', 'Maple', 'Cedar', 'Eighth', 'Elm', 'View', 'Washington', 'Ninth', 'Lake', 'Hill']
-
-        df_list = pd.read_html('https://simple.wikipedia.org/wiki/List_of_U.S._states')
-        df = df_list[0]
-        df.columns = df.iloc[0,:]
-        df = df.iloc[1:,:]
-        state_list = df.Abbreviation.tolist()
-        zipcode_df = pd.read_csv('../demographic_files/zipcodes.csv')
-
-        return name_first_dict,name_last_list,street_list,state_list,zipcode_df
-
     @staticmethod
     def _generate_age():
         """Generates a random age between 13 and 50 using a gamma distribution."""
@@ -103,86 +80,20 @@ class GeneratePatient(generatebase.GenerateBase):
         return bday
 
     def _get_race_coding(self):
-        """Uses FHIR valueset v2 to obtain and randomly choose a race."""
-        df = pd.read_html('http://hl7.org/fhir/ValueSet/v2-0005')[2]
-        df.columns = df.iloc[0,:]
-        df = df.iloc[1:,0:3]
-        self.race_description = random.choice(df.Description.tolist())
-        self.race_code = df[df.Description==self.race_description].Code.values[0]
-        self.race_system = df[df.Description==self.race_description].System.values[0]
+        """Randomly chooses a race from FHIR valueset v2-0005 (see referencedata)."""
+        self.race_description, self.race_code, self.race_system = referencedata.choice('race_description', 'race_code', 'race_system')
 
     def _get_ethnicity_coding(self):
-        """Uses FHIR valueset v3 to obtain and randomly choose an ethnicity"""
+        """Randomly chooses an ethnicity from FHIR valueset v3 Ethnicity (see referencedata)."""
         self.ethnicity_system = 'http://hl7.org/fhir/v3/Ethnicity'
-        df = pd.read_html(self.ethnicity_system)[2]
-        df.columns = df.iloc[0,:]
-        df = df[df.Level=='1']
-        df = df.iloc[0:,1:3]
-        self.ethnicity_description = random.choice(df.Display.tolist())
-        self.ethnicity_code = df[df.Display==self.ethnicity_description].Code.values[0]
+        self.ethnicity_description, self.ethnicity_code = referencedata.choice('ethnicity_description', 'ethnicity_code')
 
     def _generate_patient_fhir_object(self):
-        """Creates a test patient using fhirclient.models."""
-        Patient = p.Patient()
-        HumanName = hn.HumanName()
-        HumanName.family = [self.name_last]
-        HumanName.given = [self.name_first]
-        Patient.name = [HumanName]
-
-        Patient.gender = self.gender
-
-        birthDay = fd.FHIRDate()
-        birthDay.date = self.bday
-        Patient.birthDate = birthDay
-
-        Address = a.Address()
-        Address.country = 'USA'
-        Address.postalCode = self.zipcode
-        Address.state = self.state
-        Address.city = self.city
-        Address.line = [f'{self.address_number} {self.address_street}']
-        Address.use = 'home'
-        Address.type = 'postal'
-        Patient.active = True
-        Patient.address = [Address]
-        PatientCommunication = p.PatientCommunication()
-        PatientCommunication.language = self._create_FHIRCodeableConcept('en-US','urn:ietf:bcp:47','English')
-        # PatientCommunication.language = self._create_FHIRCodeableConcept('en-US','http://hl7.org/fhir/ValueSet/languages','English')
-        PatientCommunication.preferred = True
-        Patient.communication = [PatientCommunication]
-
-        race = e.Extension()
-        race.url = 'http://hl7.org/fhir/us/core/StructureDefinition/us-core-race'
-        us_core = e.Extension()
-        us_core.url = 'ombCategory'
-        us_core.valueCoding = self._create_FHIRCoding(self.race_code,'urn:oid:2.16.840.1.113883.6.238',self.race_description)
-        race_detailed = e.Extension()
-        race_detailed.url = 'detailed'
-        race_detailed.valueCoding = self._create_FHIRCoding(self.race_code,'urn:oid:2.16.840.1.113883.6.238',self.race_description)
-        race_text = e.Extension()
-        race_text.url = 'text'
-        race_text.valueString = self.race_description
-        race.extension = [us_core,race_detailed,race_text]
-
-        ethnicity = e.Extension()
-        ethnicity.url = 'http://hl7.org/fhir/us/core/StructureDefinition/us-core-ethnicity'
-
-        us_core = e.Extension()
-        us_core.url = 'ombCategory'
-        us_core.valueCoding = self._create_FHIRCoding(self.ethnicity_code,'urn:oid:2.16.840.1.113883.6.238',self.ethnicity_description)
-        ethnicity_text = e.Extension()
-        ethnicity_text.url = 'text'
-        ethnicity_text.valueString = self.ethnicity_description
-        ethnicity.extension = [us_core,ethnicity_text]
-
-        Patient.extension = [race,ethnicity]
-        Patient.managingOrganization = self._create_FHIRReference(self.Organization)
-
-        self._validate(Patient)
-        self.response = self.post_resource(Patient)
-        Patient.id = self._extract_id()
+        """Creates the test patient record. It is converted to a fhirclient Patient when posted or written."""
+        Patient = records.PatientRecord(self.name_last, self.name_first, self.gender, self.bday, f'{self.address_number} {self.address_street}', self.city, self.state, self.zipcode,
+                                        self.race_code, self.race_description, self.ethnicity_code, self.ethnicity_description, self.Organization, middle=self.name_middle, mrn=self.mrn)
+        self._commit_resource(Patient, depends=[self.Organization])
         self.Patient = Patient
-        print(self)
 
 if __name__ == '__main__':
     GeneratePatient()
@@ -1,19 +1,18 @@
 import generatebase
 import generateorganization
-import fhirclient.models.codeableconcept as cc
-import fhirclient.models.coding as c
-import fhirclient.models.humanname as hn
-import fhirclient.models.practitioner as pr
+import records
 import random
 import os
 os.chdir(os.path.dirname(os.path.realpath(__file__)))
 
 class GeneratePractitioner(generatebase.GenerateBase):
-    def __init__(self,Organization=None):
+    def __init__(self,Organization=None,Location=None,key=None):
         """
-        Uses fhirclient.models to create and post practitoner resource. Currently, using class variables.
+        Creates and posts a practitioner resource. The Practitioner attribute is a PractitionerRecord; see records.py.
 
-        :param smart: fhirclient.client.FHIRClient object.
+        :param Organization: OrganizationRecord the practitioner works for. Default generates one.
+        :param Location: Location FHIR object the practitioner works at
+        :param key: key of the resource within the patient graph. Default is 'Practitioner'.
         :returns: practitioner id created by server
         """
         if Organization is None:
@@ -21,28 +20,15 @@ class GeneratePractitioner(generatebase.GenerateBase):
         else:
             self.Organization = Organization
 
-        Practitioner = pr.Practitioner()
-        PractitionerQualification = pr.PractitionerQualification()
-        CodeableConcept = cc.CodeableConcept()
-        Coding = c.Coding()
-        Coding.code = random.choice(['MD','DO'])
-        Coding.system = 'https://www.hl7.org/fhir/v2/0360/2.7/index.html'
-        CodeableConcept.coding = [Coding]
-        PractitionerQualification.code = CodeableConcept
-        Practitioner.qualification = [PractitionerQualification]
-        name = hn.HumanName()
-        self.family, self.given, Practitioner.gender = self._generate_person()
-        name.family = [self.family]
-        name.given = [self.given]
-        Practitioner.name = name
-        self._validate(Practitioner)
-        self.response = self.post_resource(Practitioner)
-        Practitioner.id = self._extract_id()
+        qualification = random.choice(['MD','DO'])
+        family, given, gender = self._generate_person()
+        Practitioner = records.PractitionerRecord(family, given, gender, qualification, organization=self.Organization, location=Location)
+        depends = [self.Organization] if Location is None else [self.Organization, Location]
+        self._commit_resource(Practitioner, key=key, depends=depends)
         self.Practitioner = Practitioner
-        print(self)
 
     def __str__(self):
-        return f'{self.Practitioner.__class__.__name__}:{self.family},{self.given[0]}; id: {self.Practitioner.id}'
+        return f'{self.Practitioner.resource_name}:{self.Practitioner.family},{self.Practitioner.given[0]}; id: {self.Practitioner.id}'
 
     @staticmethod
     def __repr__():
@@ -0,0 +1,146 @@
+"""
+Collision-free patient identities. MRNs use records.MRN_SYSTEM. Every patient_key of a run is mapped through keyed Feistel permutations to a unique
+MRN and a unique (first, middle, last) name combination. The permutations are bijections computed on the fly, so no
+lookup table or set of used values is kept whatever the size of the cohort, and every process of a run derives the same
+identities from (seed, patient_key).
+"""
+
+import referencedata
+
+import numpy as np
+import os
+os.chdir(os.path.dirname(os.path.realpath(__file__)))
+
+MRN_DIGITS = 9
+
+
+class FeistelPermutation():
+    def __init__(self, domain, key, rounds=4):
+        """
+        Keyed pseudorandom permutation of range(domain). A balanced Feistel network over the smallest even number of
+        bits covering the domain, with cycle walking for values that fall outside of it. Vectorized over numpy arrays.
+
+        :param domain: size of the permuted range
+        :param key: integer key. Different keys give unrelated permutations.
+        :param rounds: Feistel rounds
+        """
+        self.domain = int(domain)
+        self.half_bits = max((int(domain-1).bit_length()+1)//2, 1)
+        self.half_mask = np.uint64(2**self.half_bits-1)
+        self.round_keys = np.random.RandomState(key % 2**32).randint(0, 2**63, rounds, dtype=np.int64).astype(np.uint64)
+
+    def __str__(self):
+        return f'FeistelPermutation:{self.domain} values; {2*self.half_bits} bits; {len(self.round_keys)} rounds'
+
+    @staticmethod
+    def __repr__():
+        return 'FeistelPermutation(domain,key)'
+
+    @staticmethod
+    def _mix(x):
+        """splitmix64 finalizer used as the round function."""
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return x ^ (x >> np.uint64(31))
+
+    def _encrypt(self, x):
+        shift = np.uint64(self.half_bits)
+        left = x >> shift
+        right = x & self.half_mask
+        with np.errstate(over='ignore'):
+            for round_key in self.round_keys:
+                left, right = right, left ^ (self._mix(right ^ round_key) & self.half_mask)
+        return (left << shift) | right
+
+    def __call__(self, values):
+        """
+        Permutes values.
+
+        :param values: integers in range(domain)
+        :returns: numpy uint64 array of permuted values
+        """
+        values = np.asarray(values, dtype=np.uint64)
+        if values.size and int(values.max()) >= self.domain:
+            raise ValueError(f'values must be below {self.domain}')
+        result = self._encrypt(values)
+        outside = np.flatnonzero(result >= self.domain)
+        while len(outside):
+            # cycle walking: re-encrypt until the value is back in the domain; stays a bijection
+            result[outside] = self._encrypt(result[outside])
+            outside = outside[result[outside] >= self.domain]
+        return result
+
+
+class Identity():
+    """Identity of one patient. The name is picked by gender once the patient's gender is known."""
+    __slots__ = ('mrn', 'female', 'male')
+
+    def __init__(self, mrn, female, male):
+        """
+        :param mrn: medical record number
+        :param female: (first, middle, family) name for a female patient
+        :param male: (first, middle, family) name for a male patient
+        """
+        self.mrn = mrn
+        self.female = female
+        self.male = male
+
+    def __str__(self):
+        return f'Identity:{self.mrn}'
+
+    @staticmethod
+    def __repr__():
+        return 'Identity(mrn,female,male)'
+
+    def name(self, gender):
+        """(first, middle, family) name for a gender ('female' or 'male')."""
+        return self.male if gender == 'male' else self.female
+
+
+class IdentitySpace():
+    def __init__(self, seed):
+        """
+        Identities of a run. A patient's name is the combination (first, middle, last) at the permuted patient_key,
+        with first and middle distinct names of the gender's first name list; the combination space holds
+        len(first)*(len(first)-1)*len(last) patients per gender. Male names that are also female names are dropped, so
+        names never collide across genders either.
+
+        :param seed: run seed. Keys the permutations.
+        """
+        data = referencedata.get()
+        self.seed = seed
+        self.family = data['name_last']
+        female = data['name_first_female']
+        male = data['name_first_male']
+        self.first = {'female': female, 'male': male[~np.isin(np.char.upper(male), np.char.upper(female))]}
+        self.mrns = FeistelPermutation(10**MRN_DIGITS, seed*2 + 1)
+        self.names = {gender: FeistelPermutation(len(first)*(len(first)-1)*len(self.family), seed*2 + k + 2) for k, (gender, first) in enumerate(self.first.items())}
+
+    def __str__(self):
+        return f"IdentitySpace:{min(p.domain for p in self.names.values())} names per gender; {self.mrns.domain} MRNs"
+
+    @staticmethod
+    def __repr__():
+        return 'IdentitySpace(seed)'
+
+    def _names(self, gender, keys):
+        first = self.first[gender]
+        combination = self.names[gender](keys)
+        family = combination % np.uint64(len(self.family))
+        combination //= np.uint64(len(self.family))
+        given = combination // np.uint64(len(first)-1)
+        middle = combination % np.uint64(len(first)-1)
+        middle += middle >= given
+        return zip(np.char.upper(first[given.astype(np.int64)]).tolist(), np.char.upper(first[middle.astype(np.int64)]).tolist(), self.family[family.astype(np.int64)].tolist())
+
+    def batch(self, start, size):
+        """
+        Identities of the patients start..start+size-1, computed in one vectorized pass.
+
+        :param start: first patient_key
+        :param size: number of patients
+        :returns: list of Identity objects
+        """
+        keys = np.arange(start, start+size, dtype=np.uint64)
+        mrns = self.mrns(keys)
+        return [Identity(f'{mrn:0{MRN_DIGITS}d}', female, male) for mrn, female, male in zip(mrns.tolist(), self._names('female', keys), self._names('male', keys))]
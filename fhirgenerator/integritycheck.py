@@ -0,0 +1,212 @@
+"""
+Referential integrity of generated NDJSON output. Every reference of every resource (Observation.subject and performer,
+Condition.patient, Patient.managingOrganization, Encounter.participant, ...) must resolve to a resource of the output.
+
+The check runs in two parallel passes over the files. The first reduces every resource to a 64-bit hash of 'Type/id'
+and builds one sorted numpy array of hashes per resource type; the arrays are saved to .npy files. The second streams
+the references of every file in chunks and looks them up with a vectorized searchsorted against the memory-mapped
+arrays, so memory is 8 bytes per resource and a chunk of references, whatever the number of references. Hash
+collisions could hide a dangling reference; with 64-bit hashes this is below 1 in 10**7 for 100 million resources.
+"""
+
+import ndjsonwriter
+
+import pandas as pd
+import numpy as np
+import multiprocessing
+import collections
+import tempfile
+import hashlib
+import json
+import glob
+import sys
+import re
+import os
+os.chdir(os.path.dirname(os.path.realpath(__file__)))
+
+ID_PATTERN = re.compile(rb'^\{"id":"([^"]+)"')
+
+
+def _hash(keys):
+    """64-bit blake2b hashes of a list of byte strings as a numpy uint64 array."""
+    return np.frombuffer(b''.join(hashlib.blake2b(key, digest_size=8).digest() for key in keys), dtype=np.uint64)
+
+
+def _target(reference):
+    """'Type/id' of a relative or absolute reference without its version, or None for contained and urn: references."""
+    path = reference.split('/_history/')[0].split('/')
+    if len(path) < 2 or reference.startswith(('#', 'urn:')):
+        return None
+    return f'{path[-2]}/{path[-1]}'
+
+
+def _references(value):
+    """All reference strings within a json value."""
+    if isinstance(value, dict):
+        reference = value.get('reference')
+        if isinstance(reference, str):
+            yield reference
+        for item in value.values():
+            if isinstance(item, (dict, list)):
+                yield from _references(item)
+    elif isinstance(value, list):
+        for item in value:
+            yield from _references(item)
+
+
+def _index_file(path):
+    """
+    First pass over one file.
+
+    :returns: tuple of (resource type, uint64 array of 'Type/id' hashes)
+    """
+    resource_type = os.path.basename(path).split('.')[0]
+    keys = []
+    with ndjsonwriter.open_ndjson(path) as f:
+        for line in f:
+            # NdjsonWriter lines start with the id; anything else is parsed
+            match = ID_PATTERN.match(line)
+            resource_id = match.group(1).decode('utf-8') if match else json.loads(line).get('id')
+            keys.append(f'{resource_type}/{resource_id}'.encode('utf-8'))
+    return resource_type, _hash(keys)
+
+
+def _check_file(path, index_directory, chunk_size, samples):
+    """
+    Second pass over one file.
+
+    :returns: tuple of (Counter of (source type, field, target type): references, Counter of dangling references, list of dangling samples)
+    """
+    index = {os.path.basename(name)[:-4]: np.load(name, mmap_mode='r') for name in glob.glob(os.path.join(index_directory, '*.npy'))}
+    totals = collections.Counter()
+    dangling = collections.Counter()
+    examples = []
+    pending = []
+
+    def flush():
+        groups = collections.defaultdict(list)
+        for item in pending:
+            groups[item[1][2]].append(item)
+        for target_type, items in groups.items():
+            ids = index.get(target_type)
+            found = np.zeros(len(items), dtype=bool)
+            if ids is not None and target_type is not None and len(ids):
+                hashes = _hash([target.encode('utf-8') for _, _, target in items])
+                positions = np.minimum(np.searchsorted(ids, hashes), len(ids)-1)
+                found = ids[positions] == hashes
+            for (source, key, target), ok in zip(items, found.tolist()):
+                if not ok:
+                    dangling[key] += 1
+                    if len(examples) < samples:
+                        examples.append((source, key[1], target))
+        pending.clear()
+
+    resource_type = os.path.basename(path).split('.')[0]
+    with ndjsonwriter.open_ndjson(path) as f:
+        for line in f:
+            resource = json.loads(line)
+            source = f"{resource_type}/{resource.get('id')}"
+            for field, value in resource.items():
+                if not isinstance(value, (dict, list)):
+                    continue
+                for reference in _references(value):
+                    target = _target(reference)
+                    key = (resource_type, f'{resource_type}.{field}', target.split('/')[0] if target else None)
+                    totals[key] += 1
+                    pending.append((source, key, target or reference))
+            if len(pending) >= chunk_size:
+                flush()
+    flush()
+    return totals, dangling, examples
+
+
+class IntegrityChecker():
+    def __init__(self, processes=None, chunk_size=100000, samples=20):
+        """
+        Checks that every reference of NdjsonWriter output resolves to a resource of the same output. Files are
+        processed in parallel by a pool of worker processes.
+
+        :param processes: worker processes. Default is the number of CPUs.
+        :param chunk_size: references looked up per vectorized batch
+        :param samples: number of dangling references kept as examples
+        """
+        self.processes = processes or os.cpu_count()
+        self.chunk_size = chunk_size
+        self.samples = samples
+        self.resources = collections.Counter()
+        self.duplicates = collections.Counter()
+        self.references = collections.Counter()
+        self.dangling = collections.Counter()
+        self.examples = []
+
+    def __str__(self):
+        return f'IntegrityChecker:{sum(self.resources.values())} resources; {sum(self.references.values())} references; {sum(self.dangling.values())} dangling'
+
+    @staticmethod
+    def __repr__():
+        return 'IntegrityChecker()'
+
+    @staticmethod
+    def files(directory):
+        """NDJSON files of an output directory and its worker subdirectories. --clinics resources of a --processes run are in the parent directory and referenced from the workers'."""
+        paths = []
+        for root, dirs, names in os.walk(directory):
+            dirs.sort()
+            paths.extend(os.path.join(root, name) for name in sorted(names) if '.ndjson' in name)
+        return paths
+
+    def check(self, directory):
+        """
+        Checks an output directory.
+
+        :param directory: --output directory of a previous run
+        :returns: self
+        """
+        paths = self.files(directory)
+        context = multiprocessing.get_context('spawn')
+        with tempfile.TemporaryDirectory() as index_directory, context.Pool(self.processes) as pool:
+            hashes = collections.defaultdict(list)
+            for resource_type, array in pool.imap_unordered(_index_file, paths):
+                hashes[resource_type].append(array)
+            for resource_type, arrays in hashes.items():
+                ids = np.sort(np.concatenate(arrays))
+                unique = np.concatenate(([True], ids[1:] != ids[:-1])) if len(ids) else np.zeros(0, dtype=bool)
+                self.resources[resource_type] = len(ids)
+                self.duplicates[resource_type] = int(len(ids) - unique.sum())
+                np.save(os.path.join(index_directory, f'{resource_type}.npy'), ids[unique])
+                del ids, unique
+            hashes.clear()
+            for totals, dangling, examples in pool.starmap(_check_file, [(path, index_directory, self.chunk_size, self.samples) for path in paths]):
+                self.references.update(totals)
+                self.dangling.update(dangling)
+                self.examples.extend(examples[:self.samples - len(self.examples)])
+        return self
+
+    def tables(self):
+        """
+        Builds the report tables.
+
+        :returns: dictionary of table name: DataFrame
+        """
+        resources = pd.DataFrame({'count': pd.Series(self.resources, dtype=np.int64), 'duplicate_ids': pd.Series(self.duplicates, dtype=np.int64)}).rename_axis('resource_type')
+        references = pd.DataFrame([(field, target or '?', count, self.dangling.get((source, field, target), 0)) for (source, field, target), count in sorted(self.references.items(), key=str)],
+                                  columns=['field', 'target', 'references', 'dangling']).set_index(['field', 'target'])
+        tables = {'resources': resources, 'references': references}
+        if self.examples:
+            tables['dangling'] = pd.DataFrame(self.examples, columns=['source', 'field', 'reference'])
+        return tables
+
+    def print_tables(self):
+        """Prints every report table."""
+        print(self)
+        for name, table in self.tables().items():
+            print(f'\n--- {name.upper()} ---\n')
+            print(table.to_string())
+
+
+def main(args):
+    """Runs the check subcommand of fpargenerator. Exits with status 1 if any reference dangles or any id is duplicated."""
+    checker = IntegrityChecker(processes=args.workers, chunk_size=args.chunk_size, samples=args.samples).check(args.input)
+    checker.print_tables()
+    if sum(checker.dangling.values()) or sum(checker.duplicates.values()):
+        sys.exit(1)
@@ -0,0 +1,104 @@
+import math
+import threading
+import os
+os.chdir(os.path.dirname(os.path.realpath(__file__)))
+
+class LatencyHistogram():
+    def __init__(self, significant_digits=2, unit=1e-6):
+        """
+        HdrHistogram style log-linear histogram. Values are bucketed with a relative error of 10**-significant_digits
+        so memory stays a few KB regardless of the number of recorded values.
+
+        :param significant_digits: decimal digits of precision kept for every value
+        :param unit: size of one histogram unit in seconds. Default records microseconds.
+        """
+        self.unit = unit
+        self.sub_bucket_bits = math.ceil(math.log2(2*10**significant_digits))
+        self.sub_bucket_count = 2**self.sub_bucket_bits
+        self.sub_bucket_half = self.sub_bucket_count//2
+        self.counts = []
+        self.total = 0
+        self.max = 0
+        self.min = None
+        self.sum = 0
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return f'LatencyHistogram:{self.total} values; p50: {self.percentile(50)*1000:.1f}ms; p99: {self.percentile(99)*1000:.1f}ms'
+
+    @staticmethod
+    def __repr__():
+        return 'LatencyHistogram()'
+
+    def _index(self, value):
+        if value < self.sub_bucket_count:
+            return value
+        shift = value.bit_length() - self.sub_bucket_bits
+        return (shift+1)*self.sub_bucket_half + (value >> shift) - self.sub_bucket_half
+
+    def _highest_value(self, index):
+        """Highest value that falls into a bucket, as reported by HdrHistogram."""
+        if index < self.sub_bucket_count:
+            return index
+        shift = index//self.sub_bucket_half - 1
+        mantissa = index % self.sub_bucket_half + self.sub_bucket_half
+        return ((mantissa+1) << shift) - 1
+
+    def record(self, seconds):
+        """Records one latency in seconds."""
+        value = max(int(seconds/self.unit), 0)
+        index = self._index(value)
+        with self._lock:
+            if index >= len(self.counts):
+                self.counts.extend([0]*(index - len(self.counts) + 1))
+            self.counts[index] += 1
+            self.total += 1
+            self.sum += value
+            self.max = max(self.max, value)
+            self.min = value if self.min is None else min(self.min, value)
+
+    def merge(self, other):
+        """Adds the counts of another histogram with the same precision."""
+        with self._lock:
+            if len(other.counts) > len(self.counts):
+                self.counts.extend([0]*(len(other.counts) - len(self.counts)))
+            for index, count in enumerate(other.counts):
+                self.counts[index] += count
+            self.total += other.total
+            self.sum += other.sum
+            self.max = max(self.max, other.max)
+            if other.min is not None:
+                self.min = other.min if self.min is None else min(self.min, other.min)
+
+    def percentile(self, percentile):
+        """
+        Returns a latency percentile in seconds.
+
+        :param percentile: percentile between 0 and 100
+        :returns: latency in seconds, 0 if nothing was recorded
+        """
+        if self.total == 0:
+            return 0
+        target = max(math.ceil(self.total*percentile/100), 1)
+        running = 0
+        for index, count in enumerate(self.counts):
+            running += count
+            if running >= target:
+                return min(self._highest_value(index), self.max)*self.unit
+        return self.max*self.unit
+
+    def mean(self):
+        """Returns the mean latency in seconds."""
+        return self.sum/self.total*self.unit if self.total else 0
+
+    def summary(self, percentiles=(50, 90, 99, 99.9)):
+        """
+        Summarizes the histogram.
+
+        :param percentiles: percentiles to report
+        :returns: dictionary of count, mean, max and percentiles in milliseconds
+        """
+        summary = {'count':self.total, 'mean_ms':self.mean()*1000, 'max_ms':self.max*self.unit*1000}
+        for percentile in percentiles:
+            summary[f'p{percentile}_ms'] = self.percentile(percentile)*1000
+        return summary
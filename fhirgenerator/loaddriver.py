@@ -0,0 +1,182 @@
+import generatebase
+import latency
+import runlog
+import scheduler
+
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import requests
+import threading
+import json
+import time
+import os
+os.chdir(os.path.dirname(os.path.realpath(__file__)))
+
+log = runlog.getLogger('loaddriver')
+
+class PayloadGraph(scheduler.ResourceGraph):
+    """ResourceGraph that serializes the patient graph in upload order instead of uploading it."""
+    def __init__(self):
+        super().__init__()
+        self.payloads = []
+
+    def run(self):
+        for layer in self.layers():
+            for node in layer:
+                self.payloads.append((node.resource.resource_name, node.resource.id, json.dumps(node.resource.as_json()).encode('utf-8')))
+        self.nodes = []
+        self._nodes_by_resource = {}
+
+
+def arrival_schedule(rate, duration, ramp_from=None, ramp_seconds=0):
+    """
+    Computes the intended send times of an open-loop schedule. The rate ramps linearly from ramp_from to rate over
+    ramp_seconds and then stays constant until duration.
+
+    :param rate: target requests per second
+    :param duration: length of the run in seconds
+    :param ramp_from: starting requests per second. Default is no ramp.
+    :param ramp_seconds: length of the ramp in seconds
+    :returns: numpy array of send times in seconds from the start of the run
+    """
+    if ramp_from is None or ramp_seconds <= 0:
+        return np.arange(int(rate*duration))/rate
+    ramp_seconds = min(ramp_seconds, duration)
+    slope = (rate - ramp_from)/ramp_seconds
+    ramp_count = int(ramp_from*ramp_seconds + slope*ramp_seconds**2/2)
+    # invert N(t) = ramp_from*t + slope*t**2/2 for every arrival within the ramp
+    n = np.arange(ramp_count)
+    if slope == 0:
+        ramp_times = n/ramp_from
+    else:
+        ramp_times = (-ramp_from + np.sqrt(ramp_from**2 + 2*slope*n))/slope
+    steady_times = ramp_seconds + np.arange(int(rate*(duration - ramp_seconds)))/rate
+    return np.concatenate([ramp_times, steady_times])
+
+
+class LoadDriver():
+    def __init__(self, rate, duration, ramp_from=None, ramp_seconds=0, workers=64, patients=50, seed=0):
+        """
+        Open-loop load driver for FHIR servers. FPAR patient graphs are generated and serialized before the clock
+        starts, then resource writes are issued on a fixed (or ramped) arrival schedule whether or not earlier requests
+        have returned. Latency is measured from the intended send time so queueing behind a slow server is not hidden
+        (coordinated omission) and recorded per resource type.
+
+        Writes are PUTs to deterministic ids (see GenerateBase upload_mode 'put') so references between pre-generated
+        resources are valid. Resources are sent in dependency order, but a dependent write may still arrive before the
+        write it references has completed; such failures are counted as errors.
+
+        :param rate: target requests per second
+        :param duration: length of the run in seconds
+        :param ramp_from: starting requests per second of a linear ramp. Default is no ramp.
+        :param ramp_seconds: length of the ramp in seconds
+        :param workers: number of sender threads. Must cover rate * p99 latency to stay open-loop.
+        :param patients: number of pre-generated patient graphs. The payloads are cycled when the schedule needs more.
+        :param seed: run seed of the pre-generated patients
+        """
+        self.rate = rate
+        self.duration = duration
+        self.ramp_from = ramp_from
+        self.ramp_seconds = ramp_seconds
+        self.workers = workers
+        self.patients = patients
+        self.seed = seed
+        self.histograms = {}
+        self.errors = {}
+        self._errors_lock = threading.Lock()
+        self.payloads = []
+        self.late = 0
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def __str__(self):
+        return f'LoadDriver:{self.rate} rps for {self.duration}s; payloads: {len(self.payloads)}'
+
+    @staticmethod
+    def __repr__():
+        return 'LoadDriver(rate,duration)'
+
+    def pregenerate(self):
+        """Generates and serializes the patient graphs. Runs before the schedule starts so generation is never the bottleneck."""
+        import fpargenerator
+        generatebase.GenerateBase.upload_mode = 'put'
+        generatebase.GenerateBase.run_seed = self.seed
+        for i in range(self.patients):
+            graph = PayloadGraph()
+            fpargenerator.FparGenerator(patient_key=i, seed=self.seed, graph=graph)
+            self.payloads.extend(graph.payloads)
+        return self.payloads
+
+    def _send(self, payload, intended):
+        resource_name, id, data = payload
+        url = f'{generatebase.GenerateBase.server_url}{resource_name}/{id}'
+        try:
+            response = self.session.put(url, data=data, headers={'Content-Type': 'application/json+fhir'})
+            failed = response.status_code >= 400
+        except requests.exceptions.RequestException:
+            failed = True
+        self.histograms[resource_name].record(time.monotonic() - intended)
+        if failed:
+            with self._errors_lock:
+                self.errors[resource_name] += 1
+
+    def run(self):
+        """
+        Runs the schedule.
+
+        :returns: report dictionary, see report()
+        """
+        if not self.payloads:
+            self.pregenerate()
+        if not self.payloads:
+            raise ValueError('LoadDriver has no payloads to send, generate at least one patient')
+        for resource_name in {payload[0] for payload in self.payloads}:
+            self.histograms[resource_name] = latency.LatencyHistogram()
+            self.errors[resource_name] = 0
+
+        schedule = arrival_schedule(self.rate, self.duration, self.ramp_from, self.ramp_seconds)
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        start = time.monotonic()
+        for i, offset in enumerate(schedule):
+            intended = start + offset
+            delay = intended - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -0.001:
+                self.late += 1
+            executor.submit(self._send, self.payloads[i % len(self.payloads)], intended)
+        executor.shutdown(wait=True)
+        self.elapsed = time.monotonic() - start
+        return self.report()
+
+    def report(self):
+        """
+        Summarizes the run.
+
+        :returns: dictionary of resource_name: {count, errors, rps, mean/max/percentile latencies in ms}
+        """
+        report = {}
+        total = latency.LatencyHistogram()
+        for resource_name, histogram in sorted(self.histograms.items()):
+            report[resource_name] = dict(histogram.summary(), errors=self.errors[resource_name], rps=histogram.total/self.elapsed)
+            total.merge(histogram)
+        report['all'] = dict(total.summary(), errors=sum(self.errors.values()), rps=total.total/self.elapsed, late_dispatches=self.late)
+        return report
+
+    @staticmethod
+    def print_report(report):
+        """Prints the report as a table."""
+        print(f"{'type':<18}{'count':>8}{'errors':>8}{'rps':>9}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'p99.9 ms':>10}{'max ms':>10}")
+        for resource_name, row in report.items():
+            print(f"{resource_name:<18}{row['count']:>8}{row['errors']:>8}{row['rps']:>9.1f}{row['p50_ms']:>10.1f}{row['p90_ms']:>10.1f}{row['p99_ms']:>10.1f}{row['p99.9_ms']:>10.1f}{row['max_ms']:>10.1f}")
+
+
+def main(args):
+    """Runs the load subcommand of fpargenerator."""
+    driver = LoadDriver(args.rate, args.duration, ramp_from=args.ramp_from, ramp_seconds=args.ramp_seconds, workers=args.workers, patients=args.patients, seed=args.seed or 0)
+    driver.pregenerate()
+    runlog.event(log, 'pregenerated', 'PREGENERATED %d payloads from %d patients', len(driver.payloads), args.patients, payloads=len(driver.payloads), patients=args.patients)
+    LoadDriver.print_report(driver.run())
@@ -0,0 +1,171 @@
+import gzip
+import hashlib
+import io
+import json
+import queue
+import threading
+import os
+os.chdir(os.path.dirname(os.path.realpath(__file__)))
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+EXTENSIONS = {'gzip':'.ndjson.gz', 'zstd':'.ndjson.zst', None:'.ndjson'}
+
+class _HashingFile():
+    """File wrapper that hashes and counts the (compressed) bytes written to disk."""
+    def __init__(self, path):
+        self.f = open(path, 'wb')
+        self.sha256 = hashlib.sha256()
+        self.bytes = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.bytes += len(data)
+        return self.f.write(data)
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class _Part():
+    def __init__(self, directory, resource_type, number, compression, level):
+        """One rolling output file of a resource type."""
+        self.resource_type = resource_type
+        self.name = f'{resource_type}.{number:04d}{EXTENSIONS[compression]}'
+        self.raw = _HashingFile(os.path.join(directory, self.name))
+        if compression == 'gzip':
+            self.stream = gzip.GzipFile(fileobj=self.raw, mode='wb', compresslevel=level, mtime=0)
+        elif compression == 'zstd':
+            self.stream = zstandard.ZstdCompressor(level=level).stream_writer(self.raw, closefd=False)
+        else:
+            self.stream = self.raw
+        self.count = 0
+        self.uncompressed_bytes = 0
+
+    def write(self, line):
+        self.stream.write(line)
+        self.count += 1
+        self.uncompressed_bytes += len(line)
+
+    def close(self):
+        if self.stream is not self.raw:
+            self.stream.close()
+        self.raw.close()
+        return {'file':self.name, 'resource_type':self.resource_type, 'count':self.count, 'bytes':self.raw.bytes, 'uncompressed_bytes':self.uncompressed_bytes, 'sha256':self.raw.sha256.hexdigest()}
+
+
+class NdjsonWriter():
+    discards = False
+
+    def __init__(self, directory, compression='gzip', max_bytes=256*1024**2, queue_size=10000, level=None):
+        """
+        Streams resources into compressed NDJSON files, one set of rolling files per resource type, i.e.
+        Observation.0000.ndjson.gz. Resources are serialized by the caller and compressed/written by a background
+        thread through a bounded queue, so compression overlaps with generation and memory stays flat at any -n.
+        close() writes manifest.json with the counts and sha256 checksums of every file.
+
+        :param directory: output directory. Created if missing.
+        :param compression: 'gzip', 'zstd' (requires the zstandard package) or None
+        :param max_bytes: uncompressed bytes after which a file is rolled over
+        :param queue_size: maximum number of serialized resources waiting for the writer thread
+        :param level: compression level. Default is 6 for gzip and 3 for zstd.
+        """
+        if compression not in EXTENSIONS:
+            raise ValueError(f'unknown compression {compression}')
+        if compression == 'zstd' and zstandard is None:
+            raise ImportError('zstd compression requires the zstandard package')
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.compression = compression
+        self.max_bytes = max_bytes
+        self.level = level if level is not None else {'gzip':6, 'zstd':3}.get(compression)
+        self.parts = {}
+        self.part_numbers = {}
+        self.manifest = []
+        self.error = None
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __str__(self):
+        return f'NdjsonWriter:{self.directory}; compression: {self.compression}'
+
+    @staticmethod
+    def __repr__():
+        return 'NdjsonWriter(directory)'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, resource):
+        """
+        Queues a resource for writing.
+
+        :param resource: fhirclient resource object or json dictionary with a resourceType
+        """
+        if self.error is not None:
+            raise self.error
+        js = resource if isinstance(resource, dict) else resource.as_json()
+        line = (json.dumps(js, separators=(',', ':')) + '\n').encode('utf-8')
+        self._queue.put((js['resourceType'], line))
+
+    def _part(self, resource_type):
+        part = self.parts.get(resource_type)
+        if part is not None and part.uncompressed_bytes >= self.max_bytes:
+            self.manifest.append(part.close())
+            part = None
+        if part is None:
+            number = self.part_numbers.get(resource_type, 0)
+            self.part_numbers[resource_type] = number + 1
+            part = _Part(self.directory, resource_type, number, self.compression, self.level)
+            self.parts[resource_type] = part
+        return part
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                continue
+            try:
+                resource_type, line = item
+                self._part(resource_type).write(line)
+            except Exception as error:
+                self.error = error
+
+    def close(self):
+        """Drains the queue, closes every file and writes manifest.json."""
+        self._queue.put(None)
+        self._thread.join()
+        for part in self.parts.values():
+            self.manifest.append(part.close())
+        self.parts = {}
+        counts = {}
+        for entry in self.manifest:
+            counts[entry['resource_type']] = counts.get(entry['resource_type'], 0) + entry['count']
+        with open(os.path.join(self.directory, 'manifest.json'), 'w') as f:
+            json.dump({'compression':self.compression, 'counts':counts, 'files':sorted(self.manifest, key=lambda e: e['file'])}, f, indent=2)
+        if self.error is not None:
+            raise self.error
+        return counts
+
+
+def open_ndjson(path):
+    """Opens a (compressed) NDJSON file written by NdjsonWriter for reading lines as bytes."""
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise ImportError('reading zstd files requires the zstandard package')
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True))
+    return open(path, 'rb')
@@ -0,0 +1,101 @@
+import flyweight
+
+import functools
+import os
+os.chdir(os.path.dirname(os.path.realpath(__file__)))
+
+class ObservationTemplate():
+    def __init__(self, name, code, display, value_type, unit=None, system='http://loinc.org', value_system='http://loinc.org'):
+        """
+        Everything about an observation that does not change between patients. The code CodeableConcept is compiled once.
+
+        :param name: key of the observation within observation_dict (i.e. 'sbp')
+        :param code: observation code
+        :param display: observation display
+        :param value_type: 'quantity', 'codeable' or 'valuestring'
+        :param unit: unit of quantity values
+        :param system: coding system of the observation code
+        :param value_system: coding system of codeable values
+        """
+        if value_type not in ('quantity', 'codeable', 'valuestring'):
+            raise ValueError(f'unknown value_type {value_type}')
+        self.name = name
+        self.code = code
+        self.display = display
+        self.value_type = value_type
+        self.unit = unit
+        self.system = system
+        self.value_system = value_system
+        self.CodeableConcept = flyweight.codeable_concept(code, system, display)
+
+    def __str__(self):
+        return f'ObservationTemplate:{self.name}; code: {self.code}'
+
+    @staticmethod
+    def __repr__():
+        return 'ObservationTemplate(name,code,display,value_type)'
+
+    def fill(self, value):
+        """
+        Creates an observation_dict entry from a value. Codeable values are given as a (value_loinc, value_display) tuple.
+
+        :param value: value of the observation
+        :returns: observation dictionary used in GenerateObservation
+        """
+        entry = {'template':self,'system':self.system,'type':self.value_type,'code':self.code,'display':self.display,'unit':self.unit}
+        if self.value_type == 'codeable':
+            entry['value_loinc'], entry['value_display'] = value
+            entry['value_system'] = self.value_system if entry['value_loinc'] is not None else None
+        else:
+            entry['value'] = value
+        return entry
+
+
+SNOMED = 'http://snomed.info/sct'
+
+CATALOGUE = {t.name: t for t in [
+    ObservationTemplate('sbp','8480-6','Systolic Blood Pressure (mmHg)','quantity',unit='mmHg'),
+    ObservationTemplate('dbp','8462-4','Diastolic Blood Pressure (mmHg)','quantity',unit='mmHg'),
+    ObservationTemplate('hr','8867-4','Heart Rate (bpm)','quantity',unit='bpm'),
+    ObservationTemplate('height','8302-2','Height (inches)','quantity',unit='inches'),
+    ObservationTemplate('weight','29463-7','Weight (pounds)','quantity',unit='pounds'),
+    ObservationTemplate('smoke','72166-2','Tobacco smoking status','codeable',value_system=SNOMED),
+    ObservationTemplate('parity','11977-6','Parity','quantity'),
+    ObservationTemplate('gravidity','11996-6','Gravidity','quantity',unit='Pregnancies'),
+    ObservationTemplate('income','77244-2','Total combined household income range in last year','codeable'),
+    ObservationTemplate('pregnancy','82810-3','Pregnancy Status','codeable'),
+    ObservationTemplate('insurance','52556-8','Insurance Coverage','codeable'),
+    ObservationTemplate('payer','76437-3','Payer of Visit','codeable'),
+    ObservationTemplate('preg_reporting_method','86643-4','Pregnancy Status Reporting Method','codeable'),
+    ObservationTemplate('preg_intent','86645-9','Pregnancy Intention','codeable'),
+    ObservationTemplate('ever_had_sex','86646-7','Ever Had Sex','codeable'),
+    ObservationTemplate('sex_3_mo','86647-5','Sex Last 3 Months','codeable'),
+    ObservationTemplate('sex_12_mo','86648-3','Sex Last 12 Months','codeable'),
+    ObservationTemplate('contraceptive_intake','86649-1','Contraceptive Method at Intake','codeable'),
+    ObservationTemplate('reason_no_contraceptive_intake','86650-9','Reason for no contraceptive method at intake','codeable'),
+    ObservationTemplate('contraceptive_exit','86651-7','Contraceptive Method at Exit','codeable'),
+    ObservationTemplate('reason_no_contraceptive_exit','86652-5','Reason for no contraceptive method at exit','codeable'),
+    ObservationTemplate('how_contraceptive_exit','86653-3','How was contraceptive method provided at exit','codeable'),
+    ]}
+
+
+def fill(values):
+    """
+    Builds an observation_dict from a value vector.
+
+    :param values: ordered dictionary of template name: value
+    :returns: observation_dict used in GenerateObservation
+    """
+    return {name: CATALOGUE[name].fill(value) for name, value in values.items()}
+
+
+@functools.lru_cache(maxsize=1024)
+def lab_template(code, display):
+    """
+    Returns the valuestring template of a lab. Labs are picked from valuesets at runtime so their templates are compiled on first use.
+
+    :param code: lab LOINC code
+    :param display: lab name
+    :returns: ObservationTemplate object
+    """
+    return ObservationTemplate(code, code, display, 'valuestring')
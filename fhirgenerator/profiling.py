@@ -0,0 +1,177 @@
+import cProfile
+import collections
+import contextlib
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+import os
+os.chdir(os.path.dirname(os.path.realpath(__file__)))
+
+
+class StackSampler():
+    def __init__(self, interval=0.005):
+        """
+        Sampling profiler. A background thread records the stack of every other thread each interval seconds and
+        counts identical stacks, which are written in the folded format read by flamegraph.pl and speedscope.
+
+        :param interval: seconds between samples
+        """
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __str__(self):
+        return f'StackSampler:{self.samples} samples; {len(self.stacks)} stacks'
+
+    @staticmethod
+    def __repr__():
+        return 'StackSampler(interval)'
+
+    @staticmethod
+    def _folded(frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+            frame = frame.f_back
+        return ';'.join(reversed(stack))
+
+    def _run(self):
+        own = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    self.stacks[f'{names.get(ident, ident)};{self._folded(frame)}'] += 1
+            self.samples += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, path):
+        """Writes the folded stacks, one 'frame;frame;... count' line per distinct stack."""
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+
+class RunProfiler():
+    def __init__(self, directory, memory=False, sample_interval=None, top=25):
+        """
+        Profiles a generator run and writes the reports to directory:
+            - cprofile.prof: raw cProfile stats of the generating thread (pstats, snakeviz)
+            - cprofile.txt: functions by cumulative time
+            - generators.txt: time and calls aggregated per Generate* class and per module
+            - memory.txt: with memory, the top allocators (by line, by file and by calling fhirgenerator line) that each stage() added, from tracemalloc snapshots
+            - stacks.folded: with sample_interval, folded stacks of every thread for flamegraphs
+
+        :param directory: run directory. Created if missing.
+        :param memory: traces allocations with tracemalloc. Slows the run down considerably.
+        :param sample_interval: seconds between stack samples. Default does not sample.
+        :param top: rows per report table
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.memory = memory
+        self.top = top
+        self.profile = cProfile.Profile()
+        self.sampler = StackSampler(sample_interval) if sample_interval else None
+        self.stages = []
+        self._snapshot = None
+
+    def __str__(self):
+        return f'RunProfiler:{self.directory}; stages: {[name for name, _ in self.stages]}'
+
+    @staticmethod
+    def __repr__():
+        return 'RunProfiler(directory)'
+
+    def start(self):
+        if self.memory:
+            tracemalloc.start(10)
+            self._snapshot = tracemalloc.take_snapshot()
+        if self.sampler is not None:
+            self.sampler.start()
+        self.profile.enable()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Times a stage of the run and, with memory, snapshots the allocations it added."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            report = [f'--- {name}: {time.perf_counter()-start:.2f} s ---']
+            if self.memory:
+                # snapshots are slow; keep them out of the cProfile stats
+                self.profile.disable()
+                snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+                current, peak = tracemalloc.get_traced_memory()
+                report.append(f'traced: {current/1e6:.1f} MB; peak: {peak/1e6:.1f} MB')
+                for key_type in ('lineno', 'filename'):
+                    report.append(f'\ntop allocators by {key_type}:')
+                    for stat in snapshot.compare_to(self._snapshot, key_type)[:self.top]:
+                        report.append(f'  {stat.size_diff/1e6:+10.2f} MB {stat.count_diff:+10d} blocks  {stat.traceback}')
+                report.append('\ntop allocating fhirgenerator lines (pandas, numpy and fhirclient allocations are charged to the caller):')
+                for line, size in self._by_caller(snapshot)[:self.top]:
+                    report.append(f'  {size/1e6:+10.2f} MB  {line}')
+                self._snapshot = snapshot
+                self.profile.enable()
+            self.stages.append((name, '\n'.join(report)))
+
+    def _by_caller(self, snapshot):
+        """Allocation growth since the last snapshot grouped by the innermost frame within this package."""
+        package = os.path.dirname(os.path.realpath(__file__))
+        sizes = collections.Counter()
+        for stat in snapshot.compare_to(self._snapshot, 'traceback'):
+            frame = next((frame for frame in stat.traceback if frame.filename.startswith(package)), stat.traceback[0])
+            sizes[f'{frame.filename}:{frame.lineno}'] += stat.size_diff
+        return sizes.most_common()
+
+    def _generators(self, stats):
+        """Aggregates cProfile stats per Generate* class (its __init__, cumulative) and per module (own time)."""
+        generators = collections.defaultdict(lambda: [0, 0.0])
+        modules = collections.defaultdict(lambda: [0, 0.0])
+        for (filename, _, function), (_, calls, own, cumulative, _) in stats.stats.items():
+            module = os.path.splitext(os.path.basename(filename))[0]
+            modules[module][0] += calls
+            modules[module][1] += own
+            if module.startswith('generate') and function == '__init__':
+                generators[module][0] += calls
+                generators[module][1] += cumulative
+        lines = [f"{'generator':<28}{'calls':>10}{'cumulative s':>14}{'ms/call':>10}"]
+        for module, (calls, seconds) in sorted(generators.items(), key=lambda item: -item[1][1]):
+            lines.append(f'{module:<28}{calls:>10}{seconds:>14.2f}{1000*seconds/max(calls, 1):>10.2f}')
+        lines.append(f"\n{'module':<28}{'calls':>10}{'own s':>14}")
+        for module, (calls, seconds) in sorted(modules.items(), key=lambda item: -item[1][1])[:self.top]:
+            lines.append(f'{module:<28}{calls:>10}{seconds:>14.2f}')
+        return '\n'.join(lines)
+
+    def stop(self):
+        """Stops profiling and writes the reports."""
+        self.profile.disable()
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.sampler.write(os.path.join(self.directory, 'stacks.folded'))
+        if self.memory:
+            tracemalloc.stop()
+            with open(os.path.join(self.directory, 'memory.txt'), 'w') as f:
+                f.write('\n\n'.join(report for _, report in self.stages) + '\n')
+        self.profile.dump_stats(os.path.join(self.directory, 'cprofile.prof'))
+        with open(os.path.join(self.directory, 'cprofile.txt'), 'w') as f:
+            stats = pstats.Stats(self.profile, stream=f)
+            stats.sort_stats('cumulative').print_stats(self.top*2)
+        with open(os.path.join(self.directory, 'generators.txt'), 'w') as f:
+            f.write('\n'.join(report.splitlines()[0] for _, report in self.stages) + '\n\n')
+            f.write(self._generators(stats) + '\n')
+        return self.directory
@@ -0,0 +1,124 @@
+import threading
+import time
+import os
+os.chdir(os.path.dirname(os.path.realpath(__file__)))
+
+class AdaptiveLimiter():
+    def __init__(self, initial_limit=4, min_limit=1, max_limit=64, target_p95=1.0, max_error_rate=0.02, window=50, backoff=0.5, max_rps=None):
+        """
+        Client side AIMD controller for requests against a FHIR server. The number of in-flight requests grows by one
+        after every healthy window (p95 latency under target_p95 and few errors) and is cut by backoff as soon as the
+        server answers 429/5xx or the window is slow. An optional max_rps caps the request rate regardless of the limit.
+
+        :param initial_limit: starting number of in-flight requests
+        :param min_limit: lowest in-flight limit
+        :param max_limit: highest in-flight limit
+        :param target_p95: p95 latency in seconds considered healthy
+        :param max_error_rate: highest error rate of a window considered healthy
+        :param window: number of completed requests per adjustment
+        :param backoff: multiplicative decrease factor
+        :param max_rps: hard cap on requests per second. Default is no cap.
+        """
+        self.limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_p95 = target_p95
+        self.max_error_rate = max_error_rate
+        self.window = window
+        self.backoff = backoff
+        self.max_rps = max_rps
+
+        self.inflight = 0
+        self._latencies = []
+        self._errors = 0
+        self._decreased_at = -max_limit
+        self._completed = 0
+        self._next_slot = 0
+        self._paused_until = 0
+        self._condition = threading.Condition()
+
+    def __str__(self):
+        return f'AdaptiveLimiter:limit {self.limit}; inflight: {self.inflight}; max_rps: {self.max_rps}'
+
+    @staticmethod
+    def __repr__():
+        return 'AdaptiveLimiter()'
+
+    def acquire(self):
+        """Blocks until a request may be sent under the in-flight limit and the rate cap."""
+        with self._condition:
+            while self.inflight >= self.limit:
+                self._condition.wait()
+            self.inflight += 1
+            now = time.monotonic()
+            slot = max(now, self._paused_until)
+            if self.max_rps:
+                slot = max(slot, self._next_slot)
+                self._next_slot = slot + 1/self.max_rps
+        if slot > now:
+            time.sleep(slot - now)
+
+    def release(self, latency, status=None, retry_after=None):
+        """
+        Records a completed request and adjusts the limit.
+
+        :param latency: seconds the request took
+        :param status: http status code, None on connection errors
+        :param retry_after: seconds from a Retry-After header. Pauses every request for that long.
+        """
+        error = status is None or status == 429 or status >= 500
+        with self._condition:
+            self.inflight -= 1
+            self._completed += 1
+            self._latencies.append(latency)
+            if error:
+                self._errors += 1
+                if retry_after:
+                    self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                # back off once per round of in-flight requests so a burst of failures does not collapse the limit to min_limit
+                if self._completed - self._decreased_at >= self.inflight:
+                    self._decrease()
+            if len(self._latencies) >= self.window:
+                self._adjust()
+            self._condition.notify_all()
+
+    def _decrease(self):
+        self.limit = max(self.min_limit, int(self.limit*self.backoff))
+        self._decreased_at = self._completed
+
+    def _adjust(self):
+        """Additive increase after a healthy window, multiplicative decrease after a slow one."""
+        latencies = sorted(self._latencies)
+        p95 = latencies[int(0.95*(len(latencies)-1))]
+        error_rate = self._errors/len(latencies)
+        if p95 > self.target_p95 or error_rate > self.max_error_rate:
+            self._decrease()
+        elif self.inflight >= self.limit - 1:
+            # only grow when the current limit is actually being used
+            self.limit = min(self.max_limit, self.limit + 1)
+        self._latencies = []
+        self._errors = 0
+
+    def request(self, session, method, url, **kwargs):
+        """
+        Sends a request through the limiter.
+
+        :param session: requests.Session object
+        :param method: http method
+        :param url: request url
+        :returns: requests.Response object
+        """
+        self.acquire()
+        start = time.monotonic()
+        status = retry_after = None
+        try:
+            response = session.request(method, url, **kwargs)
+            status = response.status_code
+            if status == 429:
+                try:
+                    retry_after = float(response.headers.get('Retry-After', 0))
+                except ValueError:
+                    retry_after = None
+            return response
+        finally:
+            self.release(time.monotonic() - start, status, retry_after)
@@ -0,0 +1,446 @@
+"""
+Compact records of the generated resources. Generators fill a record with the generated values only; the fhirclient
+object graph (HumanName, Address, Extension, Coding, ...) is built by to_fhir() at the output edge, i.e. right before a
+resource is validated/posted or serialized, and dropped again afterwards. Records reference each other directly and
+keep no FHIR objects alive, so a patient's resources stay small for the length of a run.
+
+Records quack like the fhirclient resources where the rest of the code needs it: resource_name, id, identifier and
+as_json().
+"""
+
+import fhirclient.models.address as a
+import fhirclient.models.condition as cond
+import fhirclient.models.contactpoint as cp
+import fhirclient.models.encounter as enc
+import fhirclient.models.extension as e
+import fhirclient.models.fhirdate as fd
+import fhirclient.models.humanname as hn
+import fhirclient.models.identifier as ident
+import fhirclient.models.observation as o
+import fhirclient.models.organization as org
+import fhirclient.models.patient as p
+import fhirclient.models.period as period
+import fhirclient.models.practitioner as pr
+import fhirclient.models.quantity as q
+import flyweight
+import scheduler
+import timestamps
+
+import os
+os.chdir(os.path.dirname(os.path.realpath(__file__)))
+
+OMB_SYSTEM = 'urn:oid:2.16.840.1.113883.6.238'
+MRN_SYSTEM = 'urn:oid:2.16.840.1.113883.19.5.99999.1'
+
+
+def reference(resource):
+    """
+    Creates the reference to a resource or record. References to resources that already have an id are interned and shared; references to resources waiting in the upload graph are resolved when serialized.
+
+    :param resource: record or FHIRClient.models class object (i.e. Patient())
+    :returns: FHIRReference object
+    """
+    if resource.id is not None:
+        return flyweight.reference(resource.resource_name, resource.id)
+    return scheduler.PendingReference(resource)
+
+
+def add_value(Observation, measurement):
+    """
+    Adds values to an Observation FHIR object. Uses 'type' within dictionary to determine logic.
+
+    :param Observation: Observation FHIR object.
+    :param measurement: Specific observation measurement. References a dictionary.
+    :returns: Observation FHIR object.
+    """
+    if measurement['type'] == 'quantity':
+        Quantity = q.Quantity()
+        Quantity.value = measurement['value']
+        Quantity.unit = measurement['unit']
+        Observation.valueQuantity = Quantity
+    elif measurement['type'] == 'codeable':
+        Observation.valueCodeableConcept = flyweight.codeable_concept(measurement['value_loinc'], measurement.get('value_system'), measurement['value_display'])
+    elif measurement['type'] == 'valuestring':
+        Observation.valueString = measurement['value']
+    return Observation
+
+
+class Record():
+    """Base of the resource records. Holds the server id and business identifier every resource gets."""
+    __slots__ = ('id', 'identifier')
+    resource_name = None
+
+    def __init__(self):
+        self.id = None
+        self.identifier = None
+
+    def __str__(self):
+        return f'{self.resource_name}Record; id: {self.id}'
+
+    @staticmethod
+    def __repr__():
+        return 'Record()'
+
+    def _base(self, Resource):
+        Resource.id = self.id
+        Resource.identifier = self.identifier
+        return Resource
+
+    def to_fhir(self):
+        """Builds the fhirclient resource of the record."""
+        raise NotImplementedError(f'{type(self).__name__} does not implement to_fhir()')
+
+    def as_json(self):
+        """Serializes the record through its fhirclient resource."""
+        return self.to_fhir().as_json()
+
+
+class ExistingRecord(Record):
+    """Resource that already exists on the server or in the output, i.e. created by an earlier run. Only referenced; never committed again."""
+    __slots__ = ('resource_name',)
+
+    def __init__(self, resource_name, id):
+        """
+        :param resource_name: FHIR resource name
+        :param id: id of the resource
+        """
+        super().__init__()
+        self.resource_name = resource_name
+        self.id = id
+
+    def __str__(self):
+        return f'ExistingRecord:{self.resource_name}/{self.id}'
+
+    @staticmethod
+    def __repr__():
+        return 'ExistingRecord(resource_name,id)'
+
+    def to_fhir(self):
+        raise TypeError(f'ExistingRecord {self.resource_name}/{self.id} is a reference only; it has no FHIR body')
+
+
+class OrganizationRecord(Record):
+    __slots__ = ('name', 'phone', 'line', 'city', 'postal_code', 'state')
+    resource_name = 'Organization'
+
+    def __init__(self, name, phone, line, city, postal_code, state):
+        super().__init__()
+        self.name = name
+        self.phone = phone
+        self.line = line
+        self.city = city
+        self.postal_code = postal_code
+        self.state = state
+
+    def __str__(self):
+        return f'OrganizationRecord:{self.name}; id: {self.id}'
+
+    @staticmethod
+    def __repr__():
+        return 'OrganizationRecord(name,phone,line,city,postal_code,state)'
+
+    def to_fhir(self):
+        Organization = self._base(org.Organization())
+        Organization.active = True
+        Organization.name = self.name
+        Address = a.Address()
+        Address.line = self.line
+        Address.city = self.city
+        Address.postalCode = self.postal_code
+        Address.state = self.state
+        Organization.address = [Address]
+        ContactPoint = cp.ContactPoint()
+        ContactPoint.system = 'phone'
+        ContactPoint.value = self.phone
+        Organization.telecom = [ContactPoint]
+        return Organization
+
+
+class PatientRecord(Record):
+    __slots__ = ('family', 'given', 'gender', 'birthdate', 'line', 'city', 'state', 'zipcode',
+                 'race_code', 'race_description', 'ethnicity_code', 'ethnicity_description', 'organization', 'middle', 'mrn')
+    resource_name = 'Patient'
+
+    def __init__(self, family, given, gender, birthdate, line, city, state, zipcode, race_code, race_description, ethnicity_code, ethnicity_description, organization, middle=None, mrn=None):
+        """
+        :param family: family name
+        :param given: given name
+        :param gender: FHIR gender
+        :param birthdate: datetime.date birthday
+        :param line: street address line
+        :param city: address city
+        :param state: address state
+        :param zipcode: address zipcode
+        :param race_code: OMB race code. None leaves out the race extension.
+        :param race_description: OMB race display
+        :param ethnicity_code: OMB ethnicity code. None leaves out the ethnicity extension.
+        :param ethnicity_description: OMB ethnicity display
+        :param organization: managing OrganizationRecord. None leaves out managingOrganization.
+        :param middle: middle name
+        :param mrn: medical record number. Added as a second identifier of type MR.
+        """
+        super().__init__()
+        self.family = family
+        self.given = given
+        self.gender = gender
+        self.birthdate = birthdate
+        self.line = line
+        self.city = city
+        self.state = state
+        self.zipcode = zipcode
+        self.race_code = race_code
+        self.race_description = race_description
+        self.ethnicity_code = ethnicity_code
+        self.ethnicity_description = ethnicity_description
+        self.organization = organization
+        self.middle = middle
+        self.mrn = mrn
+
+    def __str__(self):
+        return f'PatientRecord:{self.family},{self.given}; id: {self.id}'
+
+    @staticmethod
+    def __repr__():
+        return 'PatientRecord(family,given,gender,birthdate,...)'
+
+    def to_fhir(self):
+        Patient = self._base(p.Patient())
+        if self.mrn is not None:
+            Identifier = ident.Identifier()
+            Identifier.use = 'usual'
+            Identifier.type = flyweight.codeable_concept('MR', 'http://hl7.org/fhir/v2/0203', 'Medical record number')
+            Identifier.system = MRN_SYSTEM
+            Identifier.value = self.mrn
+            Patient.identifier = (self.identifier or []) + [Identifier]
+        HumanName = hn.HumanName()
+        HumanName.family = [self.family] if self.family is not None else None
+        HumanName.given = [name for name in (self.given, self.middle) if name is not None] or None
+        Patient.name = [HumanName]
+
+        Patient.gender = self.gender
+
+        birthDay = fd.FHIRDate()
+        birthDay.date = self.birthdate
+        Patient.birthDate = birthDay
+
+        Address = a.Address()
+        Address.country = 'USA'
+        Address.postalCode = self.zipcode
+        Address.state = self.state
+        Address.city = self.city
+        Address.line = [self.line] if self.line is not None else None
+        Address.use = 'home'
+        Address.type = 'postal'
+        Patient.active = True
+        Patient.address = [Address]
+        PatientCommunication = p.PatientCommunication()
+        PatientCommunication.language = flyweight.codeable_concept('en-US','urn:ietf:bcp:47','English')
+        PatientCommunication.preferred = True
+        Patient.communication = [PatientCommunication]
+
+        extensions = []
+        if self.race_code is not None:
+            race = e.Extension()
+            race.url = 'http://hl7.org/fhir/us/core/StructureDefinition/us-core-race'
+            us_core = e.Extension()
+            us_core.url = 'ombCategory'
+            us_core.valueCoding = flyweight.coding(self.race_code, OMB_SYSTEM, self.race_description)
+            race_detailed = e.Extension()
+            race_detailed.url = 'detailed'
+            race_detailed.valueCoding = flyweight.coding(self.race_code, OMB_SYSTEM, self.race_description)
+            race_text = e.Extension()
+            race_text.url = 'text'
+            race_text.valueString = self.race_description
+            race.extension = [us_core,race_detailed,race_text]
+            extensions.append(race)
+
+        if self.ethnicity_code is not None:
+            ethnicity = e.Extension()
+            ethnicity.url = 'http://hl7.org/fhir/us/core/StructureDefinition/us-core-ethnicity'
+            us_core = e.Extension()
+            us_core.url = 'ombCategory'
+            us_core.valueCoding = flyweight.coding(self.ethnicity_code, OMB_SYSTEM, self.ethnicity_description)
+            ethnicity_text = e.Extension()
+            ethnicity_text.url = 'text'
+            ethnicity_text.valueString = self.ethnicity_description
+            ethnicity.extension = [us_core,ethnicity_text]
+            extensions.append(ethnicity)
+        Patient.extension = extensions or None
+
+        if self.organization is not None:
+            Patient.managingOrganization = reference(self.organization)
+        return Patient
+
+
+class PractitionerRecord(Record):
+    __slots__ = ('family', 'given', 'gender', 'qualification', 'organization', 'location')
+    resource_name = 'Practitioner'
+
+    def __init__(self, family, given, gender, qualification, organization=None, location=None):
+        """
+        :param family: family name
+        :param given: list of given names
+        :param gender: FHIR gender
+        :param qualification: v2 0360 degree code (i.e. 'MD')
+        :param organization: OrganizationRecord the practitioner works for
+        :param location: Location FHIR object the practitioner works at
+        """
+        super().__init__()
+        self.family = family
+        self.given = given
+        self.gender = gender
+        self.qualification = qualification
+        self.organization = organization
+        self.location = location
+
+    def __str__(self):
+        return f'PractitionerRecord:{self.family},{self.given[0]}; id: {self.id}'
+
+    @staticmethod
+    def __repr__():
+        return 'PractitionerRecord(family,given,gender,qualification,organization,location)'
+
+    def to_fhir(self):
+        Practitioner = self._base(pr.Practitioner())
+        PractitionerQualification = pr.PractitionerQualification()
+        PractitionerQualification.code = flyweight.codeable_concept(self.qualification, 'https://www.hl7.org/fhir/v2/0360/2.7/index.html')
+        Practitioner.qualification = [PractitionerQualification]
+        name = hn.HumanName()
+        name.family = [self.family]
+        name.given = self.given
+        Practitioner.name = name
+        Practitioner.gender = self.gender
+        if self.organization is not None:
+            PractitionerRole = pr.PractitionerPractitionerRole()
+            PractitionerRole.managingOrganization = reference(self.organization)
+            if self.location is not None:
+                PractitionerRole.location = [reference(self.location)]
+            Practitioner.practitionerRole = [PractitionerRole]
+        return Practitioner
+
+
+class ConditionRecord(Record):
+    __slots__ = ('icd_code', 'icd_description', 'patient')
+    resource_name = 'Condition'
+
+    def __init__(self, icd_code, icd_description, patient):
+        """
+        :param icd_code: ICD-10 code
+        :param icd_description: ICD-10 description
+        :param patient: PatientRecord
+        """
+        super().__init__()
+        self.icd_code = icd_code
+        self.icd_description = icd_description
+        self.patient = patient
+
+    def __str__(self):
+        return f'ConditionRecord:{self.icd_description}; id: {self.id}'
+
+    @staticmethod
+    def __repr__():
+        return 'ConditionRecord(icd_code,icd_description,patient)'
+
+    def to_fhir(self):
+        Condition = self._base(cond.Condition())
+        Condition.clinicalStatus = 'active'
+        Condition.verificationStatus = 'confirmed'
+        Condition.code = flyweight.codeable_concept(self.icd_code, 'urn:oid:2.16.840.1.113883.6.3', self.icd_description)
+        Condition.patient = reference(self.patient)
+        return Condition
+
+
+class EncounterRecord(Record):
+    __slots__ = ('patient', 'practitioner', 'condition', 'location', 'start', 'end', 'status', 'class_code')
+    resource_name = 'Encounter'
+
+    def __init__(self, patient, practitioner, condition, location, start, end, status='finished', class_code='outpatient'):
+        """
+        :param patient: PatientRecord
+        :param practitioner: PractitionerRecord
+        :param condition: ConditionRecord. Referenced as the indication of the visit.
+        :param location: Location FHIR object or record
+        :param start: ISO string of the start of the visit
+        :param end: ISO string of the end of the visit
+        :param status: DSTU2 encounter state (planned | arrived | in-progress | onleave | finished | cancelled)
+        :param class_code: DSTU2 encounter class (inpatient | outpatient | ambulatory | emergency | ...)
+        """
+        super().__init__()
+        self.patient = patient
+        self.practitioner = practitioner
+        self.condition = condition
+        self.location = location
+        self.start = start
+        self.end = end
+        self.status = status
+        self.class_code = class_code
+
+    def __str__(self):
+        return f'EncounterRecord:{self.start}; id: {self.id}'
+
+    @staticmethod
+    def __repr__():
+        return 'EncounterRecord(patient,practitioner,condition,location,start,end)'
+
+    def to_fhir(self):
+        Encounter = self._base(enc.Encounter())
+        Encounter.status = self.status
+        Encounter.class_fhir = self.class_code
+        Encounter.patient = reference(self.patient)
+        EncounterParticipant = enc.EncounterParticipant()
+        EncounterParticipant.individual = reference(self.practitioner)
+        Encounter.participant = [EncounterParticipant]
+        Encounter.indication = [reference(self.condition)]
+        EncounterLocation = enc.EncounterLocation()
+        EncounterLocation.location = reference(self.location)
+        Encounter.location = [EncounterLocation]
+        Period = period.Period()
+        Period.start = timestamps.DEFAULT.fhir_date(self.start)
+        Period.end = timestamps.DEFAULT.fhir_date(self.end)
+        Encounter.period = Period
+        return Encounter
+
+
+class ObservationRecord(Record):
+    __slots__ = ('name', 'measurement', 'effective', 'patient', 'practitioner', 'encounter')
+    resource_name = 'Observation'
+
+    def __init__(self, name, measurement, effective, patient, practitioner, encounter=None):
+        """
+        :param name: key of the observation within observation_dict
+        :param measurement: observation_dict entry. Shared with the dictionary, not copied.
+        :param effective: ISO string of the effective time
+        :param patient: PatientRecord
+        :param practitioner: PractitionerRecord. None leaves out the performer.
+        :param encounter: EncounterRecord of the visit the observation was taken at
+        """
+        super().__init__()
+        self.name = name
+        self.measurement = measurement
+        self.effective = effective
+        self.patient = patient
+        self.practitioner = practitioner
+        self.encounter = encounter
+
+    def __str__(self):
+        return f'ObservationRecord:{self.name}; id: {self.id}'
+
+    @staticmethod
+    def __repr__():
+        return 'ObservationRecord(name,measurement,effective,patient,practitioner,encounter)'
+
+    def to_fhir(self):
+        Observation = self._base(o.Observation())
+        measurement = self.measurement
+        if 'template' in measurement:
+            Observation.code = measurement['template'].CodeableConcept
+        else:
+            Observation.code = flyweight.codeable_concept(measurement['code'], measurement['system'], measurement['display'])
+        Observation.status = 'final'
+        Observation.subject = reference(self.patient)
+        if self.practitioner is not None:
+            Observation.performer = [reference(self.practitioner)]
+        Observation.effectiveDateTime = timestamps.DEFAULT.fhir_date(self.effective)
+        if self.encounter is not None:
+            Observation.encounter = reference(self.encounter)
+        return add_value(Observation, measurement)
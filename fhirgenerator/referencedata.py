@@ -0,0 +1,308 @@
+"""
+Reference tables used by the generators: name lists, streets, zipcodes, ICD weights, the lab catalogue, the FPAR
+valuesets and the tables fetched from hl7.org, loinc.org and the HSPC server. Every table is loaded once per run and
+held as a named numpy array of numbers or fixed width strings.
+
+A parent process can pack the tables into a single multiprocessing.shared_memory block with share(); worker processes
+attach() to it and get zero-copy views, so the reference data is resident once no matter how many workers run.
+"""
+
+from multiprocessing import shared_memory
+import pandas as pd
+import numpy as np
+import random
+import os
+os.chdir(os.path.dirname(os.path.realpath(__file__)))
+
+STREETS = ['Second', 'Third', 'First', 'Fourth', 'Park', 'Fifth', 'Main', 'Sixth', 'Oak', 'Seventh', 'Pine', 'Maple', 'Cedar', 'Eighth', 'Elm', 'View', 'Washington', 'Ninth', 'Lake', 'Hill']
+LAB_SETS = {
+    'hiv': 'FPARHIVTests',
+    'ct_gc': 'FPARchlamydiaTrachomatisAndNeisseriaGonorrhoeaeCombinedTests',
+    'ct': 'FPARchlamydiaTrachomatisTests',
+    'gc': 'FPARneisseriaGonorrhoeaeTests',
+    'hpv': 'FPARhumanPapillomaVirusTests',
+    'pap': 'FPARpapSmearTests',
+    'preg': 'FPARpregnancyTests',
+    }
+ALIGNMENT = 64
+
+
+def _strings(values):
+    """Fixed width unicode array. Object arrays cannot live in shared memory."""
+    return np.array([str(v) for v in values], dtype=str)
+
+
+def _load_names():
+    first = pd.read_excel('../demographic_files/common_name_first.xlsx')
+    last = pd.read_excel('../demographic_files/common_name_last.xlsx')
+    return {'name_first_male': _strings(first.men), 'name_first_female': _strings(first.women), 'name_last': _strings(last.name_last), 'street': _strings(STREETS)}
+
+
+def _load_zipcodes():
+    df = pd.read_csv('../demographic_files/zipcodes.csv')
+    return {'zipcode': _strings(df.Zipcode.astype(str).str.zfill(5)), 'zipcode_city': _strings(df.City), 'zipcode_state': _strings(df.State),
+            'zipcode_lat': df.Lat.to_numpy(dtype=np.float64), 'zipcode_long': df.Long.to_numpy(dtype=np.float64), 'zipcode_population': df.EstimatedPopulation.fillna(0).to_numpy(dtype=np.float64)}
+
+
+def _load_icd():
+    df = pd.read_excel('../demographic_files/common_obgyn_visits_parsed.xlsx', sheet_name='for OPA')
+    return {'icd_code': _strings(df.code), 'icd_description': _strings(df.description), 'icd_cum_weight': np.cumsum(df.factor.to_numpy(dtype=np.int64))}
+
+
+def _load_labs():
+    lab_list = []
+    loinc_list = []
+    value_list = []
+    df = pd.read_excel('../demographic_files/labs.xlsx')
+    for row in df.iterrows():
+        possible_values = row[1].value
+        if possible_values is not np.nan:
+            for value in possible_values.split('\n'):
+                lab_list.append(row[1].lab)
+                loinc_list.append(row[1].loinc)
+                value_list.append(value)
+    df = pd.DataFrame({'lab_name':lab_list,'loinc':loinc_list,'value':value_list})
+    df = df.replace('Not detected', 'Not Detected')
+    df = df.replace('Nonreactive', 'Non-reactive')
+    df = df.replace('Inconclusive', 'Indeterminate') #could not find better mapping
+    df = df.replace('Equivocal', 'Indeterminate')
+    return {'lab_name': _strings(df.lab_name), 'lab_loinc': _strings(df.loinc), 'lab_value': _strings(df.value)}
+
+
+def _load_lab_sets():
+    import labvaluesets
+    return {f'labset_{name}': _strings(labvaluesets.LabValueSets('ValueSet', structure).LoincSet) for name, structure in LAB_SETS.items()}
+
+
+def _load_fpar_valuesets():
+    df = pd.read_excel('../demographic_files/valueset.xlsx', sheet_name='Sheet1')
+    df = df.fillna('N/A')
+    return {'fpar_item': _strings(df.item), 'fpar_value': _strings(df.valueset)}
+
+
+def _load_race_ethnicity():
+    race = pd.read_html('http://hl7.org/fhir/ValueSet/v2-0005')[2]
+    race.columns = race.iloc[0,:]
+    race = race.iloc[1:,0:3]
+    ethnicity = pd.read_html('http://hl7.org/fhir/v3/Ethnicity')[2]
+    ethnicity.columns = ethnicity.iloc[0,:]
+    ethnicity = ethnicity[ethnicity.Level=='1']
+    ethnicity = ethnicity.iloc[0:,1:3]
+    return {'race_code': _strings(race.Code), 'race_description': _strings(race.Description), 'race_system': _strings(race.System),
+            'ethnicity_code': _strings(ethnicity.Code), 'ethnicity_description': _strings(ethnicity.Display)}
+
+
+def _load_loinc_answers():
+    smoke = pd.read_html('http://hl7.org/fhir/us/core/stu1/ValueSet-us-core-observation-ccdasmokingstatus.html')[1]
+    smoke = smoke.iloc[1:,[1,0]]
+    income = pd.read_html('https://r.details.loinc.org/LOINC/77244-2.html?sections=Comprehensive')[4]
+    income = income.iloc[4:,[3,5]]
+    pregnancy = pd.read_html('https://s.details.loinc.org/LOINC/82810-3.html')[5]
+    pregnancy = pregnancy.iloc[4:,[3,5]]
+    pregnancy.iloc[2,0] = 'Unknown'
+    return {'smoke_description': _strings(smoke.iloc[:,0]), 'smoke_loinc': _strings(smoke.iloc[:,1]),
+            'income_range': _strings(income.iloc[:,0]), 'income_loinc': _strings(income.iloc[:,1]),
+            'pregnancy_display': _strings(pregnancy.iloc[:,0]), 'pregnancy_loinc': _strings(pregnancy.iloc[:,1])}
+
+
+LOADERS = {
+    'names': _load_names,
+    'zipcodes': _load_zipcodes,
+    'icd': _load_icd,
+    'labs': _load_labs,
+    'lab_sets': _load_lab_sets,
+    'fpar_valuesets': _load_fpar_valuesets,
+    'race_ethnicity': _load_race_ethnicity,
+    'loinc_answers': _load_loinc_answers,
+    }
+
+
+class ReferenceData():
+    def __init__(self, arrays, shm=None, owner=False):
+        """
+        Named reference tables. Use load(), share() and attach() instead of calling this directly.
+
+        :param arrays: dictionary of table name: numpy array
+        :param shm: SharedMemory block the arrays are views of
+        :param owner: whether this object created shm and unlinks it
+        """
+        self.arrays = arrays
+        self.shm = shm
+        self.owner = owner
+        self._layout = None
+
+    def __str__(self):
+        location = f'shared memory {self.shm.name}' if self.shm is not None else 'private memory'
+        return f'ReferenceData:{len(self.arrays)} tables; {self.nbytes()/1e6:.1f} MB in {location}'
+
+    @staticmethod
+    def __repr__():
+        return 'ReferenceData(arrays)'
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def __contains__(self, name):
+        return name in self.arrays
+
+    @classmethod
+    def load(cls, groups=None):
+        """
+        Loads the reference tables from the demographic files and remote sources.
+
+        :param groups: names of LOADERS to run. Default is every group.
+        :returns: ReferenceData object in private memory
+        """
+        arrays = {}
+        for group in (groups or LOADERS):
+            arrays.update(LOADERS[group]())
+        return cls(arrays)
+
+    def nbytes(self):
+        """Memory used by the tables."""
+        return sum(array.nbytes for array in self.arrays.values())
+
+    def share(self):
+        """
+        Packs every table into one shared memory block.
+
+        :returns: ReferenceData object backed by the block. Keep it alive in the parent and close() it at the end of the run; pass handle() to workers.
+        """
+        layout = {}
+        offset = 0
+        for name, array in self.arrays.items():
+            layout[name] = (offset, array.dtype.str, array.shape)
+            offset += -(-array.nbytes//ALIGNMENT)*ALIGNMENT
+        shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        arrays = {}
+        for name, array in self.arrays.items():
+            start, dtype, shape = layout[name]
+            arrays[name] = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=start)
+            arrays[name][...] = array
+            arrays[name].flags.writeable = False
+        shared = ReferenceData(arrays, shm=shm, owner=True)
+        shared._layout = layout
+        return shared
+
+    def handle(self):
+        """Picklable description of the shared memory block used by attach()."""
+        if self.shm is None:
+            raise ValueError('ReferenceData is not in shared memory; call share() first')
+        return (self.shm.name, self._layout)
+
+    @classmethod
+    def attach(cls, handle):
+        """
+        Attaches to a block created by share() in another process. The tables are read-only views of the block.
+
+        :param handle: value of handle()
+        :returns: ReferenceData object
+        """
+        name, layout = handle
+        # workers started by multiprocessing share the parent's resource tracker, so the block is unlinked once, by the parent
+        shm = shared_memory.SharedMemory(name=name)
+        arrays = {}
+        for table, (offset, dtype, shape) in layout.items():
+            arrays[table] = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+            arrays[table].flags.writeable = False
+        attached = cls(arrays, shm=shm)
+        attached._layout = layout
+        return attached
+
+    def close(self):
+        """Releases the views and detaches from shared memory. Unlinks the block when this object created it."""
+        self.arrays = {}
+        if self.shm is not None:
+            self.shm.close()
+            if self.owner:
+                self.shm.unlink()
+            self.shm = None
+
+
+_data = None
+
+def get():
+    """Returns the reference data of this process, loading it on first use when no shared block was installed."""
+    global _data
+    if _data is None:
+        _data = ReferenceData.load()
+    return _data
+
+def install(data):
+    """Makes data the reference data of this process (i.e. the attached shared block of a worker)."""
+    global _data
+    _data = data
+
+def choice(*names, mask=None):
+    """
+    Picks a random row of one or more parallel tables with the random module, so seeded runs stay reproducible.
+
+    :param names: table names
+    :param mask: boolean array selecting the candidate rows
+    :returns: python value of the row, or a tuple of values when several tables are given
+    """
+    data = get()
+    if mask is None:
+        i = random.randrange(len(data[names[0]]))
+    else:
+        candidates = np.flatnonzero(mask)
+        i = candidates[random.randrange(len(candidates))]
+    values = tuple(data[name][i].item() for name in names)
+    return values[0] if len(names) == 1 else values
+
+
+BENCHMARK_GROUPS = ['names', 'zipcodes', 'icd', 'labs', 'fpar_valuesets']
+
+def _rss_mb():
+    """Resident and unique (not shared) memory of this process in MB from /proc."""
+    with open('/proc/self/smaps_rollup') as f:
+        fields = dict(line.split(':', 1) for line in f if ':' in line)
+    rss = int(fields['Rss'].split()[0])/1024
+    private = (int(fields['Private_Clean'].split()[0]) + int(fields['Private_Dirty'].split()[0]))/1024
+    return rss, private
+
+
+def _benchmark_worker(handle, queue):
+    if handle is None:
+        install(ReferenceData.load(groups=BENCHMARK_GROUPS))
+    else:
+        install(ReferenceData.attach(handle))
+    # read every page of every table so the RSS of both modes covers the whole data
+    rows = 0
+    for array in get().arrays.values():
+        rows += len(array)
+        int(array.view(np.uint8).sum())
+    queue.put((rows, *_rss_mb()))
+
+
+def benchmark(workers=4):
+    """
+    Compares per-worker memory of loading the local reference tables in every worker against attaching to one shared block.
+
+    :param workers: number of worker processes
+    :returns: dictionary of mode: list of (rows, rss MB, private MB) per worker
+    """
+    import multiprocessing
+    context = multiprocessing.get_context('spawn')
+    shared = ReferenceData.load(groups=BENCHMARK_GROUPS).share()
+    print(shared)
+    results = {}
+    try:
+        for mode, handle in [('private', None), ('shared', shared.handle())]:
+            queue = context.Queue()
+            processes = [context.Process(target=_benchmark_worker, args=(handle, queue)) for _ in range(workers)]
+            for process in processes:
+                process.start()
+            results[mode] = [queue.get() for _ in processes]
+            for process in processes:
+                process.join()
+    finally:
+        shared.close()
+    for mode, rows in results.items():
+        rss = np.mean([row[1] for row in rows])
+        private = np.mean([row[2] for row in rows])
+        print(f'{mode:<8} workers: {workers}; mean RSS {rss:.1f} MB; mean private {private:.1f} MB')
+    return results
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,159 @@
+import sqlite3
+import threading
+import os
+os.chdir(os.path.dirname(os.path.realpath(__file__)))
+
+class RunJournal():
+    """
+    Append-only SQLite journal of the resources created during a fpargenerator run.
+
+    Every patient graph is keyed by its position in the run (patient_key). Each resource within the graph is keyed by
+    resource_key (i.e. 'Patient', 'Observation/sbp') and recorded with the id returned by the server. Resource writes are
+    buffered and committed in batches so the journal does not become the bottleneck of long runs; completing a patient
+    commits everything pending, so every finished patient graph survives a killed process.
+    """
+    def __init__(self, path, batch_size=500):
+        """
+        Opens (or creates) the journal.
+
+        :param path: path to the SQLite file
+        :param batch_size: number of buffered resource writes before they are committed
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._pending_resources = []
+        self._pending_patients = []
+        self._pending_cohort = []
+        self._patient_key = None
+        self._resources = {}
+
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS run (key TEXT PRIMARY KEY, value TEXT)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS patients (patient_key INTEGER PRIMARY KEY, complete INTEGER NOT NULL)')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS resources ('
+            'patient_key INTEGER NOT NULL, resource_key TEXT NOT NULL, resource_type TEXT NOT NULL, resource_id TEXT NOT NULL, '
+            'PRIMARY KEY (patient_key, resource_key))'
+            )
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS cohort ('
+            'patient_key INTEGER PRIMARY KEY, patient_id TEXT, organization_id TEXT, practitioner_id TEXT, '
+            'family TEXT, given TEXT, gender TEXT, birthdate TEXT, zipcode TEXT)'
+            )
+        self.conn.commit()
+
+    def __str__(self):
+        return f'RunJournal:{self.path}; completed: {len(self.completed_patients())}'
+
+    @staticmethod
+    def __repr__():
+        return 'RunJournal(path)'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get_setting(self, key, default=None):
+        """Returns a run level setting (i.e. seed) or default if it was never stored."""
+        row = self.conn.execute('SELECT value FROM run WHERE key=?', (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def set_setting(self, key, value):
+        """Stores a run level setting. Committed immediately."""
+        with self._lock:
+            self.conn.execute('INSERT OR REPLACE INTO run (key, value) VALUES (?,?)', (key, str(value)))
+            self.conn.commit()
+
+    def begin(self, patient_key):
+        """
+        Loads the resources already recorded for a patient graph so a partially uploaded graph can be finished.
+
+        :param patient_key: position of the patient within the run
+        :returns: dictionary of resource_key: resource_id
+        """
+        with self._lock:
+            rows = self.conn.execute('SELECT resource_key, resource_id FROM resources WHERE patient_key=?', (patient_key,)).fetchall()
+            self._patient_key = patient_key
+            self._resources = dict(rows)
+            for key, resource_key, resource_type, resource_id in self._pending_resources:
+                if key == patient_key:
+                    self._resources[resource_key] = resource_id
+        return dict(self._resources)
+
+    def lookup(self, patient_key, resource_key):
+        """Returns the recorded server id of a resource or None if it has not been created yet."""
+        if patient_key != self._patient_key:
+            self.begin(patient_key)
+        return self._resources.get(resource_key)
+
+    def record(self, patient_key, resource_key, resource_type, resource_id):
+        """
+        Records a created resource. Buffered until batch_size writes are pending.
+
+        :param patient_key: position of the patient within the run
+        :param resource_key: key of the resource within the patient graph
+        :param resource_type: FHIR resource name
+        :param resource_id: id returned by the server
+        """
+        with self._lock:
+            self._pending_resources.append((patient_key, resource_key, resource_type, resource_id))
+            if patient_key == self._patient_key:
+                self._resources[resource_key] = resource_id
+            flush = len(self._pending_resources) + len(self._pending_patients) >= self.batch_size
+        if flush:
+            self.flush()
+
+    def complete(self, patient_key):
+        """Marks a patient graph as fully uploaded. Committed immediately with the buffered writes of the graph."""
+        with self._lock:
+            self._pending_patients.append((patient_key,))
+        self.flush()
+
+    def record_patient(self, patient_key, patient_id, organization_id, practitioner_id, family, given, gender, birthdate, zipcode):
+        """
+        Records the ids and searchable demographics of a completed patient. Used to build the CohortIndex.
+
+        :param patient_key: position of the patient within the run
+        :param birthdate: datetime.date or ISO string
+        """
+        with self._lock:
+            self._pending_cohort.append((patient_key, patient_id, organization_id, practitioner_id, family, given, gender, str(birthdate), zipcode))
+
+    def cohort(self):
+        """Returns every recorded cohort row ordered by patient_key."""
+        self.flush()
+        return self.conn.execute('SELECT patient_key, patient_id, organization_id, practitioner_id, family, given, gender, birthdate, zipcode FROM cohort ORDER BY patient_key').fetchall()
+
+    def resources(self):
+        """Iterates over every recorded (patient_key, resource_key, resource_type, resource_id)."""
+        self.flush()
+        return self.conn.execute('SELECT patient_key, resource_key, resource_type, resource_id FROM resources')
+
+    def completed_patients(self):
+        """Returns the set of patient keys whose graphs were fully uploaded."""
+        self.flush()
+        rows = self.conn.execute('SELECT patient_key FROM patients WHERE complete=1').fetchall()
+        return {row[0] for row in rows}
+
+    def flush(self):
+        """Commits all buffered writes in a single transaction."""
+        with self._lock:
+            if not self._pending_resources and not self._pending_patients and not self._pending_cohort:
+                return
+            with self.conn:
+                self.conn.executemany('INSERT OR REPLACE INTO resources (patient_key, resource_key, resource_type, resource_id) VALUES (?,?,?,?)', self._pending_resources)
+                self.conn.executemany('INSERT OR REPLACE INTO cohort VALUES (?,?,?,?,?,?,?,?,?)', self._pending_cohort)
+                self.conn.executemany('INSERT OR REPLACE INTO patients (patient_key, complete) VALUES (?,1)', self._pending_patients)
+            self._pending_resources = []
+            self._pending_patients = []
+            self._pending_cohort = []
+
+    def close(self):
+        """Flushes pending writes and closes the connection."""
+        self.flush()
+        self.conn.close()
@@ -0,0 +1,238 @@
+"""
+Logging and progress of fhirgenerator runs.
+
+Every module logs to a child of the 'fhirgenerator' logger. configure() attaches a QueueHandler, so a logging call only
+puts the record on a queue; a QueueListener thread formats it and writes it to the console and, with json_path, as one
+JSON object per line. Records carry their structured fields in record.event (resource type, id, key, latency, ...),
+which the JSON lines keep as top-level fields. --processes workers put their records on a multiprocessing queue that
+the same listener drains.
+
+Verbosity:
+    -1: warnings and errors only
+     0: run events and a rate-limited progress line
+     1: plus one 'patient' event per finished patient
+     2: plus one 'resource' event per uploaded or written resource
+
+Below their level, patient and resource events cost one cached level check and nothing is formatted or queued.
+"""
+
+from logging.handlers import QueueHandler, QueueListener
+import multiprocessing
+import datetime
+import logging
+import atexit
+import queue
+import json
+import time
+import sys
+import os
+os.chdir(os.path.dirname(os.path.realpath(__file__)))
+
+LOGGER = logging.getLogger('fhirgenerator')
+PATIENTS = logging.getLogger('fhirgenerator.patients')
+RESOURCES = logging.getLogger('fhirgenerator.resources')
+
+_listeners = []
+_worker_queue = None
+_verbosity = 0
+
+
+def getLogger(name):
+    """Logger of a fhirgenerator module."""
+    return logging.getLogger(f'fhirgenerator.{name}')
+
+
+def event(logger, name, msg, *args, level=logging.INFO, **fields):
+    """
+    Logs a structured event.
+
+    :param logger: logger of the module
+    :param name: event name, the 'event' field of the JSON line
+    :param msg: console message, formatted with args
+    :param level: logging level
+    :param fields: fields of the JSON line
+    """
+    if logger.isEnabledFor(level):
+        logger.log(level, msg, *args, extra={'event': dict(fields, event=name)})
+
+
+def resource(resource_type, id, key=None, patient_key=None, seconds=None, **fields):
+    """
+    Logs a 'resource' event for an uploaded or written resource at verbosity 2.
+
+    :param seconds: latency of the upload. None for written resources.
+    """
+    if not RESOURCES.isEnabledFor(logging.INFO):
+        return
+    latency_ms = round(seconds*1000, 2) if seconds is not None else None
+    RESOURCES.info('%s/%s %s%s', resource_type, id, key or '', f' {latency_ms} ms' if latency_ms is not None else '',
+                   extra={'event': dict(fields, event='resource', resource_type=resource_type, id=id, key=key, patient_key=patient_key, latency_ms=latency_ms)})
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """Formats a record as one JSON object: time, level, logger, process, message and the fields of record.event."""
+
+    def format(self, record):
+        line = {'time': datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'), 'level': record.levelname,
+                'logger': record.name, 'process': record.processName, 'message': record.getMessage()}
+        line.update(getattr(record, 'event', {}))
+        return json.dumps(line, default=str)
+
+
+class ConsoleHandler(logging.StreamHandler):
+    def __init__(self, stream=None):
+        """
+        Writes records as lines. On a terminal, progress records rewrite a single line in place.
+
+        :param stream: default is sys.stderr
+        """
+        super().__init__(stream or sys.stderr)
+        self.tty = hasattr(self.stream, 'isatty') and self.stream.isatty()
+        self._progress = False
+
+    def __str__(self):
+        return f'ConsoleHandler:tty: {self.tty}'
+
+    @staticmethod
+    def __repr__():
+        return 'ConsoleHandler(stream)'
+
+    def emit(self, record):
+        if not (self.tty and getattr(record, 'progress', False)):
+            if self._progress:
+                self.stream.write('\n')
+                self._progress = False
+            super().emit(record)
+            return
+        try:
+            self.stream.write(f'\r{self.format(record)}\x1b[K')
+            self.flush()
+            self._progress = True
+        except Exception:
+            self.handleError(record)
+
+
+class Progress():
+    def __init__(self, total, unit='patients', name=None, interval=1.0, logger=LOGGER):
+        """
+        Rate-limited progress: update() logs a bar with the rate and ETA at most once per interval seconds, and once
+        when total is reached.
+
+        :param total: expected number of units
+        :param unit: unit name
+        :param name: prefix of the line, i.e. the --processes worker
+        :param interval: seconds between progress records
+        :param logger: logger of the progress records
+        """
+        self.total = total
+        self.unit = unit
+        self.name = name
+        self.interval = interval
+        self.logger = logger
+        self.done = 0
+        self.start = time.monotonic()
+        self._last = self.start
+
+    def __str__(self):
+        return f'Progress:{self.done} of {self.total} {self.unit}'
+
+    @staticmethod
+    def __repr__():
+        return 'Progress(total)'
+
+    def update(self, n=1):
+        """Counts n finished units."""
+        self.done += n
+        now = time.monotonic()
+        if now - self._last >= self.interval or self.done >= self.total:
+            self._last = now
+            self._log(now)
+
+    def _log(self, now, width=30):
+        if not self.logger.isEnabledFor(logging.INFO):
+            return
+        elapsed = now - self.start
+        rate = self.done/elapsed if elapsed > 0 else 0.0
+        eta = (self.total - self.done)/rate if rate else None
+        filled = min(width*self.done//self.total, width) if self.total else width
+        eta_text = str(datetime.timedelta(seconds=round(eta))) if eta is not None else '?'
+        self.logger.info('%s[%s] %d/%d %s %.1f/s ETA %s', f'{self.name} ' if self.name else '', '#'*filled + '.'*(width-filled), self.done, self.total, self.unit, rate, eta_text,
+                         extra={'progress': True, 'event': {'event': 'progress', 'name': self.name, 'unit': self.unit, 'done': self.done, 'total': self.total,
+                                                            'rate': round(rate, 2), 'eta_seconds': round(eta, 1) if eta is not None else None}})
+
+
+def _set_levels(verbosity):
+    LOGGER.setLevel(logging.WARNING if verbosity < 0 else logging.INFO)
+    PATIENTS.setLevel(logging.INFO if verbosity >= 1 else logging.WARNING)
+    RESOURCES.setLevel(logging.INFO if verbosity >= 2 else logging.WARNING)
+
+
+def _install(handler, verbosity):
+    for existing in list(LOGGER.handlers):
+        LOGGER.removeHandler(existing)
+    LOGGER.addHandler(handler)
+    LOGGER.propagate = False
+    _set_levels(verbosity)
+
+
+def configure(verbosity=0, json_path=None, stream=None):
+    """
+    Routes the fhirgenerator loggers through a queue to the console and, with json_path, to a JSON lines file.
+
+    :param verbosity: see the module docstring
+    :param json_path: JSON lines file. Appended to, so resumed runs keep one log.
+    :param stream: console stream. Default is sys.stderr.
+    """
+    global _verbosity
+    shutdown()
+    console = ConsoleHandler(stream)
+    console.setFormatter(logging.Formatter('%(asctime)s %(message)s', '%H:%M:%S'))
+    handlers = [console]
+    if json_path is not None:
+        json_handler = logging.FileHandler(json_path, mode='a', encoding='utf-8')
+        json_handler.setFormatter(JsonLinesFormatter())
+        handlers.append(json_handler)
+    records = queue.SimpleQueue()
+    _install(QueueHandler(records), verbosity)
+    _verbosity = verbosity
+    listener = QueueListener(records, *handlers)
+    listener.start()
+    _listeners.append(listener)
+
+
+def worker_queue():
+    """
+    Queue for the records of --processes workers, drained into the handlers of configure().
+
+    :returns: tuple of (multiprocessing queue, verbosity) for configure_worker()
+    """
+    global _worker_queue
+    if _worker_queue is None:
+        _worker_queue = multiprocessing.get_context('spawn').Queue()
+        handlers = _listeners[0].handlers if _listeners else (ConsoleHandler(),)
+        listener = QueueListener(_worker_queue, *handlers)
+        listener.start()
+        # stopped before the main listener so worker records are written before the handlers close
+        _listeners.insert(0, listener)
+    return _worker_queue, _verbosity
+
+
+def configure_worker(records, verbosity):
+    """Sends the records of a worker process to the queue of worker_queue()."""
+    _install(QueueHandler(records), verbosity)
+
+
+def shutdown():
+    """Writes the queued records and closes the handlers."""
+    global _worker_queue
+    handlers = []
+    while _listeners:
+        listener = _listeners.pop(0)
+        listener.stop()
+        handlers.extend(handler for handler in listener.handlers if handler not in handlers)
+    for handler in handlers:
+        handler.close()
+    _worker_queue = None
+
+
+atexit.register(shutdown)
@@ -0,0 +1,115 @@
+import fhirclient.models.fhirreference as fr
+
+from concurrent.futures import ThreadPoolExecutor, wait
+import os
+os.chdir(os.path.dirname(os.path.realpath(__file__)))
+
+class PendingReference(fr.FHIRReference):
+    """Reference to a resource that has not been uploaded yet. The reference string is resolved when serialized."""
+    def __init__(self, resource):
+        super().__init__()
+        self.resource = resource
+
+    def as_json(self):
+        if self.resource.id is None:
+            raise ValueError(f'{self.resource.resource_name} has not been uploaded yet')
+        self.reference = f'{self.resource.resource_name}/{self.resource.id}'
+        return super().as_json()
+
+
+class ResourceNode():
+    def __init__(self, owner, resource, key, depends, validate):
+        """
+        A resource waiting to be uploaded.
+
+        :param owner: Generate* object that created the resource. Used to upload it.
+        :param resource: FHIR resource
+        :param key: key of the resource within the patient graph
+        :param depends: resources referenced by this resource
+        :param validate: validates the resource before posting
+        """
+        self.owner = owner
+        self.resource = resource
+        self.key = key
+        self.depends = depends
+        self.validate = validate
+
+    def __str__(self):
+        return f'{self.resource.resource_name}:{self.key}; id: {self.resource.id}'
+
+    @staticmethod
+    def __repr__():
+        return 'ResourceNode(owner,resource,key,depends,validate)'
+
+
+class ResourceGraph():
+    def __init__(self, max_workers=8, executor=None):
+        """
+        Dependency graph of the resources of one patient. Resources are generated in order but only uploaded by run(),
+        which posts each layer of the graph concurrently once the resources it references have server ids
+        (Organization, then Patient and Practitioner, then Condition and Observations).
+
+        :param max_workers: maximum number of concurrent uploads
+        :param executor: ThreadPoolExecutor shared between graphs. Default creates one per run.
+        """
+        self.max_workers = max_workers
+        self.executor = executor
+        self.nodes = []
+        self._nodes_by_resource = {}
+
+    def __str__(self):
+        return f'ResourceGraph:{len(self.nodes)} resources; layers: {len(self.layers())}'
+
+    @staticmethod
+    def __repr__():
+        return 'ResourceGraph()'
+
+    def add(self, owner, resource, key, depends=(), validate=True):
+        """
+        Adds a resource to the graph.
+
+        :param owner: Generate* object that created the resource
+        :param resource: FHIR resource
+        :param key: key of the resource within the patient graph
+        :param depends: resources referenced by this resource
+        :param validate: validates the resource before posting
+        :returns: ResourceNode object
+        """
+        node = ResourceNode(owner, resource, key, depends, validate)
+        self.nodes.append(node)
+        self._nodes_by_resource[id(resource)] = node
+        return node
+
+    def layers(self):
+        """
+        Groups nodes by depth. A node's depth is one more than the deepest node it depends on; resources outside of the graph (already uploaded) do not count.
+
+        :returns: list of lists of ResourceNode objects
+        """
+        depth = {}
+        for node in self.nodes:
+            parents = [self._nodes_by_resource[id(r)] for r in node.depends if id(r) in self._nodes_by_resource]
+            depth[id(node)] = 1 + max((depth[id(p)] for p in parents), default=-1)
+        layers = [[] for _ in range(max(depth.values(), default=-1)+1)]
+        for node in self.nodes:
+            layers[depth[id(node)]].append(node)
+        return layers
+
+    def run(self):
+        """
+        Uploads the graph layer by layer. Every node of a layer is uploaded concurrently; a failed upload stops the dependent layers after the rest of its layer has finished.
+
+        :returns: None
+        """
+        executor = self.executor or ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            for layer in self.layers():
+                futures = [executor.submit(node.owner._upload_resource, node.resource, node.key, node.validate) for node in layer]
+                wait(futures)
+                for future in futures:
+                    future.result()
+        finally:
+            if self.executor is None:
+                executor.shutdown()
+        self.nodes = []
+        self._nodes_by_resource = {}
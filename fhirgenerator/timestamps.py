@@ -0,0 +1,133 @@
+import fhirclient.models.fhirdate as fd
+
+from pytz import timezone
+import numpy as np
+import functools
+import datetime
+import os
+os.chdir(os.path.dirname(os.path.realpath(__file__)))
+
+@functools.lru_cache(maxsize=32)
+def get_timezone(name):
+    """Returns a cached pytz timezone object."""
+    return timezone(name)
+
+
+class TimestampService():
+    def __init__(self, tz='US/Eastern', clinic_open=8, clinic_close=17):
+        """
+        Formats timestamps for FHIR resources and generates realistic effective times. Timezones and UTC offsets are cached
+        and ISO strings are rendered once, so FHIRDate objects do not format again during as_json.
+
+        :param tz: timezone name used for all generated timestamps
+        :param clinic_open: hour the clinic opens
+        :param clinic_close: hour the clinic closes
+        """
+        self.tz_name = tz
+        self.tz = get_timezone(tz)
+        self.clinic_open = clinic_open
+        self.clinic_close = clinic_close
+
+    def __str__(self):
+        return f'TimestampService:{self.tz_name}; hours: {self.clinic_open}-{self.clinic_close}'
+
+    @staticmethod
+    def __repr__():
+        return 'TimestampService()'
+
+    @functools.lru_cache(maxsize=4096)
+    def _offset(self, day):
+        """UTC offset string (i.e. '-05:00') of the timezone at noon on a day. Clinic hours never cross a DST change."""
+        noon = self.tz.localize(datetime.datetime(day.year, day.month, day.day, 12))
+        minutes = int(noon.utcoffset().total_seconds()//60)
+        sign = '-' if minutes < 0 else '+'
+        return f'{sign}{abs(minutes)//60:02d}:{abs(minutes)%60:02d}'
+
+    def render(self, dt):
+        """
+        Renders a datetime as an ISO string in the service timezone.
+
+        :param dt: datetime object. Naive datetimes are treated as local time, matching datetime.astimezone.
+        :returns: ISO 8601 string with UTC offset
+        """
+        return dt.astimezone(self.tz).replace(microsecond=0).isoformat()
+
+    def render_many(self, local_times):
+        """
+        Vectorized rendering of local clinic times.
+
+        :param local_times: numpy datetime64 array of naive times in the service timezone
+        :returns: numpy array of ISO 8601 strings with UTC offsets
+        """
+        local_times = np.asarray(local_times, dtype='datetime64[s]')
+        days = local_times.astype('datetime64[D]')
+        unique_days, inverse = np.unique(days, return_inverse=True)
+        offsets = np.array([self._offset(day.astype(datetime.date)) for day in unique_days], dtype='U6')
+        return np.char.add(np.datetime_as_string(local_times, unit='s'), offsets[inverse])
+
+    def fhir_date(self, value):
+        """
+        Creates a FHIRDate object with its ISO string pre-rendered.
+
+        :param value: datetime object or ISO string produced by render/render_many
+        :returns: FHIRDate object
+        """
+        FHIRDate = fd.FHIRDate()
+        if isinstance(value, datetime.datetime):
+            FHIRDate.date = value.astimezone(self.tz)
+            FHIRDate.origval = FHIRDate.date.replace(microsecond=0).isoformat()
+        else:
+            FHIRDate.origval = str(value)
+        return FHIRDate
+
+    def clinic_times(self, n, start, end, random_state=None):
+        """
+        Generates n visit times on weekdays within clinic hours. Vectorized so large cohorts are generated in one call.
+
+        :param n: number of visit times
+        :param start: first possible visit date
+        :param end: last possible visit date
+        :param random_state: numpy RandomState. Default is the global numpy random state.
+        :returns: numpy datetime64 array of naive local times
+        """
+        rs = np.random if random_state is None else random_state
+        start = np.datetime64(start, 'D')
+        span = max(int((np.datetime64(end, 'D') - start).astype(int)), 1)
+        days = np.busday_offset(start + rs.randint(0, span, n), 0, roll='forward')
+        minutes = rs.randint(self.clinic_open*60, self.clinic_close*60, n)
+        return days.astype('datetime64[s]') + (minutes*60).astype('timedelta64[s]')
+
+    def timelines(self, counts, start, end, random_state=None):
+        """
+        Generates the visit timelines of a batch of patients in one vectorized call: counts[j] clinic times per patient, sorted within each patient.
+
+        :param counts: integer array of visits per patient
+        :param start: first possible visit date
+        :param end: last possible visit date
+        :param random_state: numpy RandomState. Default is the global numpy random state.
+        :returns: tuple of (offsets, times). The visits of patient j are times[offsets[j]:offsets[j+1]].
+        """
+        counts = np.asarray(counts, dtype=np.int64)
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+        times = self.clinic_times(int(offsets[-1]), start, end, random_state=random_state)
+        patient = np.repeat(np.arange(len(counts)), counts)
+        return offsets, times[np.lexsort((times, patient))]
+
+    def visit_offsets(self, visit, n, minutes=60, random_state=None):
+        """
+        Generates n sorted effective times within a visit, i.e. one per observation taken during the visit.
+
+        :param visit: datetime64 local visit time (from clinic_times) or datetime object
+        :param n: number of effective times
+        :param minutes: length of the visit in minutes
+        :param random_state: numpy RandomState. Default is the global numpy random state.
+        :returns: numpy array of ISO 8601 strings
+        """
+        rs = np.random if random_state is None else random_state
+        if isinstance(visit, datetime.datetime):
+            visit = np.datetime64(visit.astimezone(self.tz).replace(tzinfo=None), 's')
+        offsets = np.sort(rs.randint(0, minutes*60, n)).astype('timedelta64[s]')
+        return self.render_many(np.datetime64(visit, 's') + offsets)
+
+
+DEFAULT = TimestampService()
@@ -0,0 +1,144 @@
+import cohortindex
+import generatebase
+import generatecondition
+import generatefparlabs
+import generateobservation
+import generateobservationdict
+import ratecontroller
+import records
+import runjournal
+import runlog
+import scheduler
+import timestamps
+
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import datetime
+import random
+import time
+import os
+os.chdir(os.path.dirname(os.path.realpath(__file__)))
+
+log = runlog.getLogger('topup')
+
+
+class CohortTopUp():
+    def __init__(self, index, seed, round_number, days=1, condition_rate=0.2):
+        """
+        Adds a new visit to patients of a previous run that already exist on the server: vitals, FPAR items and labs,
+        and at condition_rate a new Condition. Patients and practitioners are referenced by the ids of the CohortIndex;
+        nothing but the new Observations and Conditions is generated or uploaded.
+
+        Resources are keyed 'TopUp{round_number}/...' within the patient graph, so every round gets new identifiers and an
+        interrupted round is finished from the journal when run again.
+
+        :param index: CohortIndex of the run
+        :param seed: run seed
+        :param round_number: number of the top-up round. Seeds the sample and the generated values.
+        :param days: visits are spread over this many days before today
+        :param condition_rate: share of the visits that add a new Condition
+        """
+        self.index = index
+        self.seed = seed
+        self.round_number = round_number
+        self.days = days
+        self.condition_rate = condition_rate
+        self.random_state = np.random.RandomState((seed * 2750159 + round_number) % 2**32)
+        self.patients = 0
+        self.observations = 0
+        self.conditions = 0
+
+    def __str__(self):
+        return f'CohortTopUp:round {self.round_number}; {self.patients} patients; {self.observations} observations; {self.conditions} conditions'
+
+    @staticmethod
+    def __repr__():
+        return 'CohortTopUp(index,seed,round_number)'
+
+    def sample(self, patients=None, fraction=None):
+        """
+        Samples the patients of the round without replacement.
+
+        :param patients: number of patients
+        :param fraction: share of the cohort. Used when patients is None.
+        :returns: sorted numpy array of CohortIndex rows
+        """
+        if patients is None:
+            patients = int(round(fraction*len(self.index)))
+        return np.sort(self.index.sample(min(patients, len(self.index)), random_state=self.random_state, replace=False))
+
+    def _records(self, i):
+        """PatientRecord and practitioner of CohortIndex row i, with the server ids of the original run."""
+        index = self.index
+        Patient = records.PatientRecord(index.family[i].item(), index.given[i].item(), index.gender_name(i), index.birthdate[i].astype(datetime.date),
+                                        None, None, None, index.zipcode[i].item(), None, None, None, None, None)
+        Patient.id = index.patient_id[i].item()
+        return Patient, records.ExistingRecord('Practitioner', index.practitioner_id[i].item())
+
+    def run(self, rows, executor=None):
+        """
+        Generates and uploads the visits of the sampled patients, one patient graph at a time.
+
+        :param rows: CohortIndex rows from sample()
+        :param executor: ThreadPoolExecutor shared by the patient graphs. Default posts every resource as it is generated.
+        :returns: self
+        """
+        today = datetime.date.today()
+        visit_times = timestamps.DEFAULT.clinic_times(len(rows), today - datetime.timedelta(days=self.days), today, random_state=self.random_state)
+        conditions = self.random_state.random_sample(len(rows)) < self.condition_rate
+        prefix = f'TopUp{self.round_number}/'
+        progress = runlog.Progress(len(rows))
+        for visit_time, has_condition, i in zip(visit_times, conditions, rows.tolist()):
+            patient_key = int(self.index.patient_key[i])
+            patient_start = time.monotonic()
+            random.seed(f'{self.seed}-{patient_key}-topup{self.round_number}')
+            np.random.seed((self.seed * 1000003 + patient_key * 7919 + self.round_number) % 2**32)
+            generatebase.GenerateBase.patient_key = patient_key
+            graph = scheduler.ResourceGraph(executor=executor) if executor is not None else None
+            generatebase.GenerateBase.graph = graph
+            try:
+                Patient, Practitioner = self._records(i)
+                observation_dict = generateobservationdict.GenerateObservationDict(Patient=Patient).observation_dict
+                lab_dict = generatefparlabs.GenerateFparLabs().lab_dict
+                effective_times = list(timestamps.DEFAULT.visit_offsets(visit_time, len(observation_dict)+len(lab_dict)))
+                generateobservation.GenerateObservation(observation_dict, dt=effective_times[:len(observation_dict)], Patient=Patient, Practitioner=Practitioner, key_prefix=prefix)
+                generateobservation.GenerateObservation(lab_dict, dt=effective_times[len(observation_dict):], Patient=Patient, Practitioner=Practitioner, key_prefix=prefix)
+                if has_condition:
+                    generatecondition.GenerateCondition(Patient=Patient, key=f'{prefix}Condition')
+            finally:
+                generatebase.GenerateBase.graph = None
+            if graph is not None:
+                graph.run()
+            self.patients += 1
+            self.observations += len(observation_dict) + len(lab_dict)
+            self.conditions += int(has_condition)
+            runlog.event(runlog.PATIENTS, 'patient', 'TOPPED UP patient %d of %d', self.patients, len(rows), patient_key=patient_key, round=self.round_number,
+                         seconds=round(time.monotonic()-patient_start, 4))
+            progress.update()
+        return self
+
+
+def main(args):
+    """Runs the topup subcommand of fpargenerator."""
+    index = cohortindex.CohortIndex.from_journal(args.journal)
+    runlog.event(log, 'cohort', '%s', index, patients=len(index))
+    journal = runjournal.RunJournal(args.journal)
+    seed = int(journal.get_setting('seed', args.seed or 0))
+    # the round only advances once it completed, so an interrupted round is finished by the next run
+    round_number = int(journal.get_setting('topup_rounds', 0))
+    base = generatebase.GenerateBase
+    base.run_seed = seed
+    base.upload_mode = args.upload_mode
+    base.use_limiter(ratecontroller.AdaptiveLimiter(max_limit=args.max_inflight, target_p95=args.target_p95, max_rps=args.max_rps))
+    base.journal = journal
+    executor = ThreadPoolExecutor(max_workers=args.parallel) if args.parallel > 1 else None
+    try:
+        top_up = CohortTopUp(index, seed, round_number, days=args.days, condition_rate=args.condition_rate)
+        top_up.run(top_up.sample(patients=args.patients, fraction=args.fraction), executor=executor)
+        journal.set_setting('topup_rounds', round_number + 1)
+        runlog.event(log, 'finished', 'FINISHED %s', top_up, round=round_number, patients=top_up.patients, observations=top_up.observations, conditions=top_up.conditions)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        base.journal = None
+        journal.close()
@@ -0,0 +1,289 @@
+import generatebase
+import latency
+import loaddriver
+import runjournal
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
+import numpy as np
+import collections
+import requests
+import threading
+import time
+import os
+os.chdir(os.path.dirname(os.path.realpath(__file__)))
+
+RESOURCE_TYPES = ['Patient', 'Observation', 'Condition']
+# paging parameters that address a page directly: HAPI's cached searches and plain offset paging
+OFFSET_PARAMETERS = ['_getpagesoffset', '_offset']
+
+
+class Verifier():
+    def __init__(self, journal=None, seed=None, number=None, resource_types=RESOURCE_TYPES, concurrency=16, page_size=500, samples=100, sample_seed=None):
+        """
+        Reads back what a run uploaded. Every resource type is paged through concurrently. When the next link of a
+        search addresses pages by offset (HAPI's _getpagesoffset, _offset) all pages are requested in parallel once the
+        total is known; otherwise the next links are followed one after the other.
+
+        With a journal, the paged ids are compared with the recorded ids, and a sample of recorded resources is read
+        and checked: resource type, identifier derived from the seed, references to the patient and to recorded
+        resources, and the demographics of the cohort table. Without a journal, a sample of the patient_keys of the
+        seeded run is searched by identifier.
+
+        :param journal: RunJournal object
+        :param seed: run seed. Default is the seed stored in the journal.
+        :param number: patients of the run. Required without journal.
+        :param resource_types: resource types paged through
+        :param concurrency: concurrent requests
+        :param page_size: _count of the searches
+        :param samples: resources read back and checked
+        :param sample_seed: seed of the sample
+        """
+        if journal is None and (seed is None or number is None):
+            raise ValueError('verifying without a journal requires the seed and the number of patients')
+        self.journal = journal
+        self.seed = seed if seed is not None or journal is None else journal.get_setting('seed')
+        self.number = number
+        self.resource_types = resource_types
+        self.concurrency = concurrency
+        self.page_size = page_size
+        self.samples = samples
+        self.random_state = np.random.RandomState(sample_seed)
+        self.histograms = {'page': latency.LatencyHistogram(), 'read': latency.LatencyHistogram(), 'search': latency.LatencyHistogram()}
+        self.errors = collections.Counter()
+        self._errors_lock = threading.Lock()
+        self.counts = {}
+        self.mismatches = []
+        self.checked = 0
+        self.elapsed = 0
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def __str__(self):
+        return f'Verifier:{self.resource_types}; {self.checked} checked; {len(self.mismatches)} mismatches'
+
+    @staticmethod
+    def __repr__():
+        return 'Verifier()'
+
+    def _get(self, kind, url, params=None):
+        """GET of a json resource or Bundle. Returns None on errors, including responses that are not JSON."""
+        start = time.monotonic()
+        body = None
+        try:
+            response = self.session.get(url, params=params, headers={'Accept': 'application/json+fhir'})
+            if response.status_code < 400:
+                body = response.json()
+        except (requests.exceptions.RequestException, ValueError):
+            pass
+        self.histograms[kind].record(time.monotonic() - start)
+        if body is None:
+            with self._errors_lock:
+                self.errors[kind] += 1
+        return body
+
+    def _page(self, url, params=None):
+        """
+        Fetches one page of a search.
+
+        :returns: tuple of (total, ids, next url, time the page arrived)
+        """
+        bundle = self._get('page', url, params) or {}
+        ids = [entry['resource']['id'] for entry in bundle.get('entry', []) if 'resource' in entry]
+        next_url = next((link['url'] for link in bundle.get('link', []) if link.get('relation') == 'next'), None)
+        return bundle.get('total'), ids, next_url, time.monotonic()
+
+    def _follow(self, url):
+        """
+        Follows next links one page after the other.
+
+        :returns: tuple of (pages, ids, None, time the last page arrived)
+        """
+        ids = []
+        pages = 0
+        while url is not None:
+            _, page, url, arrived = self._page(url)
+            ids.extend(page)
+            pages += 1
+        return pages, ids, None, arrived
+
+    @staticmethod
+    def _offset_urls(next_url, total, returned):
+        """URLs of the remaining pages of a search whose next link pages by offset, or None."""
+        parts = urlparse(next_url)
+        query = parse_qs(parts.query)
+        for parameter in OFFSET_PARAMETERS:
+            if parameter in query and total is not None:
+                step = int(query['_count'][0]) if '_count' in query else returned
+                urls = []
+                for offset in range(int(query[parameter][0]), total, max(step, 1)):
+                    query[parameter] = [str(offset)]
+                    urls.append(urlunparse(parts._replace(query=urlencode(query, doseq=True))))
+                return urls
+        return None
+
+    def page(self, executor):
+        """
+        Pages through every resource type concurrently.
+
+        :returns: dictionary of resource type: set of server ids
+        """
+        base = generatebase.GenerateBase.server_url
+        start = time.monotonic()
+        firsts = {resource_type: executor.submit(self._page, f'{base}{resource_type}', {'_count': self.page_size, '_elements': 'id'}) for resource_type in self.resource_types}
+        pending = []
+        server_ids = {}
+        for resource_type, future in firsts.items():
+            total, ids, next_url, arrived = future.result()
+            server_ids[resource_type] = set(ids)
+            self.counts[resource_type] = {'server': total, 'pages': 1, 'parallel': False, 'seconds': arrived - start}
+            if next_url is None:
+                continue
+            urls = self._offset_urls(next_url, total, len(ids))
+            if urls is not None:
+                self.counts[resource_type].update(parallel=True, pages=1+len(urls))
+                pending.extend((resource_type, executor.submit(self._page, url)) for url in urls)
+            else:
+                pending.append((resource_type, executor.submit(self._follow, next_url)))
+        for resource_type, future in pending:
+            pages, ids, _, arrived = future.result()
+            server_ids[resource_type].update(ids)
+            if not self.counts[resource_type]['parallel']:
+                self.counts[resource_type]['pages'] += pages
+            self.counts[resource_type]['seconds'] = max(self.counts[resource_type]['seconds'], arrived - start)
+        for resource_type, ids in server_ids.items():
+            counts = self.counts[resource_type]
+            counts.update(paged=len(ids), rps=len(ids)/max(counts['seconds'], 1e-9))
+        return server_ids
+
+    def _expected_references(self, sample):
+        """Patient ids of the sampled patients and every recorded id by resource type."""
+        known = collections.defaultdict(set)
+        patients = {}
+        for patient_key, resource_key, resource_type, resource_id in self.journal.resources():
+            known[resource_type].add(resource_id)
+            if resource_key == 'Patient':
+                patients[patient_key] = resource_id
+        return {patient_key: patients.get(patient_key) for patient_key, _, _, _ in sample}, known
+
+    def _check(self, item, patient_id, known, cohort):
+        """Reads one recorded resource and returns its mismatches."""
+        patient_key, resource_key, resource_type, resource_id = item
+        resource = self._get('read', f'{generatebase.GenerateBase.server_url}{resource_type}/{resource_id}')
+        where = f'{resource_type}/{resource_id} ({patient_key}/{resource_key})'
+        if resource is None:
+            return [f'{where}: not found']
+        mismatches = []
+        if resource.get('resourceType') != resource_type:
+            mismatches.append(f"{where}: resourceType {resource.get('resourceType')}")
+        expected = generatebase.GenerateBase.identifier_value(self.seed, patient_key, resource_key)
+        if expected not in [identifier.get('value') for identifier in resource.get('identifier', [])]:
+            mismatches.append(f'{where}: identifier is not {expected}')
+        for field in ('subject', 'patient'):
+            reference = resource.get(field, {}).get('reference')
+            if reference is not None and reference != f'Patient/{patient_id}':
+                mismatches.append(f'{where}: {field} {reference} is not Patient/{patient_id}')
+        for field in ('performer', 'managingOrganization', 'encounter'):
+            for reference in [value.get('reference') for value in np.atleast_1d(resource.get(field, []))]:
+                target_type, _, target_id = (reference or '').partition('/')
+                if target_id not in known.get(target_type, ()):
+                    mismatches.append(f'{where}: {field} {reference} was not created by the run')
+        row = cohort.get(patient_key)
+        if resource_type == 'Patient' and row is not None:
+            name = (resource.get('name') or [{}])[0]
+            family, given, gender, birthdate = row
+            actual = ((name.get('family') or [None])[0], (name.get('given') or [None])[0], resource.get('gender'), resource.get('birthDate'))
+            if actual != (family, given, gender, birthdate):
+                mismatches.append(f'{where}: demographics {actual} are not {(family, given, gender, birthdate)}')
+        return mismatches
+
+    def _search(self, patient_key, resource_key, resource_type):
+        """Searches a resource of the seeded run by identifier and returns its mismatches."""
+        value = generatebase.GenerateBase.identifier_value(self.seed, patient_key, resource_key)
+        bundle = self._get('search', f'{generatebase.GenerateBase.server_url}{resource_type}', {'identifier': f'{generatebase.GenerateBase.identifier_system}|{value}', '_elements': 'id'})
+        found = len((bundle or {}).get('entry', []))
+        if found == 1:
+            return []
+        return [f"{resource_type} {patient_key}/{resource_key}: {'not found' if not found else f'{found} matches'}"]
+
+    def verify(self):
+        """
+        Pages through the server and checks the sample.
+
+        :returns: self
+        """
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            server_ids = self.page(executor)
+            if self.journal is None:
+                keys = self.random_state.choice(self.number, min(self.samples, self.number), replace=False)
+                checks = [executor.submit(self._search, int(patient_key), resource_type, resource_type) for patient_key in keys for resource_type in ('Patient', 'Condition')]
+            else:
+                recorded = collections.defaultdict(set)
+                rows = []
+                for row in self.journal.resources():
+                    if row[2] in self.resource_types:
+                        recorded[row[2]].add(row[3])
+                        rows.append(row)
+                for resource_type in self.resource_types:
+                    counts = self.counts[resource_type]
+                    counts.update(journal=len(recorded[resource_type]), missing=len(recorded[resource_type] - server_ids[resource_type]))
+                del server_ids
+                sample = [rows[i] for i in self.random_state.choice(len(rows), min(self.samples, len(rows)), replace=False)] if rows else []
+                del rows
+                patient_ids, known = self._expected_references(sample)
+                cohort = {row[0]: (row[4], row[5], row[6], row[7]) for row in self.journal.cohort()}
+                checks = [executor.submit(self._check, item, patient_ids[item[0]], known, cohort) for item in sample]
+            for future in checks:
+                self.mismatches.extend(future.result())
+            self.checked = len(checks)
+        self.elapsed = time.monotonic() - start
+        return self
+
+    def report(self):
+        """
+        Summarizes the requests.
+
+        :returns: report dictionary in the same layout as LoadDriver.report()
+        """
+        report = {}
+        total = latency.LatencyHistogram()
+        for kind, histogram in self.histograms.items():
+            if histogram.total:
+                report[kind] = dict(histogram.summary(), errors=self.errors[kind], rps=histogram.total/self.elapsed)
+                total.merge(histogram)
+        report['all'] = dict(total.summary(), errors=sum(self.errors.values()), rps=total.total/max(self.elapsed, 1e-9))
+        return report
+
+    def print_report(self):
+        """Prints counts, throughput, request latencies and mismatches."""
+        print(self)
+        print(f"\n{'type':<14}{'journal':>10}{'server':>10}{'paged':>10}{'missing':>10}{'pages':>8}{'parallel':>10}{'seconds':>9}{'res/s':>10}")
+        for resource_type, counts in self.counts.items():
+            print(f"{resource_type:<14}{counts.get('journal', '-'):>10}{str(counts['server']):>10}{counts['paged']:>10}{counts.get('missing', '-'):>10}{counts['pages']:>8}{str(counts['parallel']):>10}{counts['seconds']:>9.2f}{counts['rps']:>10.1f}")
+        print()
+        loaddriver.LoadDriver.print_report(self.report())
+        print(f'\n{len(self.mismatches)} mismatches in {self.checked} checked resources')
+        for mismatch in self.mismatches:
+            print(f'  {mismatch}')
+
+    def ok(self):
+        """True when nothing recorded is missing, every sampled resource matches and every request succeeded."""
+        return not self.mismatches and not sum(self.errors.values()) and not any(counts.get('missing') for counts in self.counts.values())
+
+
+def main(args):
+    """Runs the verify subcommand of fpargenerator. Exits with status 1 when ok() is False."""
+    journal = runjournal.RunJournal(args.journal) if args.journal is not None else None
+    try:
+        verifier = Verifier(journal=journal, seed=args.seed, number=args.number if journal is None else None, resource_types=args.types.split(','),
+                            concurrency=args.concurrency, page_size=args.page_size, samples=args.samples, sample_seed=args.sample_seed)
+        verifier.verify().print_report()
+    finally:
+        if journal is not None:
+            journal.close()
+    if not verifier.ok():
+        raise SystemExit(1)
@@ -0,0 +1,187 @@
+import cohortindex
+import generatebase
+import latency
+import loaddriver
+import observationtemplates
+import records
+import runjournal
+import runlog
+import timestamps
+
+import fhirclient.models.identifier as ident
+
+import numpy as np
+import requests
+import threading
+import datetime
+import json
+import time
+import uuid
+import os
+os.chdir(os.path.dirname(os.path.realpath(__file__)))
+
+log = runlog.getLogger('workload')
+
+DEFAULT_MIX = {'patient_name':3, 'patient_birthdate':2, 'observation':4, 'condition':2, 'write':1}
+VITALS = ['sbp', 'dbp', 'hr', 'height', 'weight']
+
+class WorkloadDriver():
+    def __init__(self, index, mix=None, concurrency=16, duration=60, seed=None, run_seed=None, run_number=0):
+        """
+        Mixed read/write workload over a previously generated cohort. Every request samples a patient from the
+        CohortIndex so searches hit real ids and demographics.
+
+        Query types:
+            - patient_name: Patient?family=X&given=Y
+            - patient_birthdate: Patient?birthdate=YYYY-MM-DD
+            - observation: Observation?patient=X&code=Y with a vitals LOINC code
+            - condition: Condition?patient=X
+            - write: conditional POST of a new vitals Observation for the patient, with a value from the vitals generators
+                and an identifier derived from run_seed, seed, run_number and the client like the identifiers of the run
+
+        :param index: CohortIndex object
+        :param mix: dictionary of query type: relative weight. Default is DEFAULT_MIX.
+        :param concurrency: number of concurrent clients
+        :param duration: length of the run in seconds
+        :param seed: seed of the sampled requests
+        :param run_seed: seed of the run of the cohort. Default gives written Observations random identifiers.
+        :param run_number: number of earlier workload runs against the cohort, so repeated runs with the same seed write new Observations
+        """
+        self.index = index
+        self.mix = mix or DEFAULT_MIX
+        unknown = set(self.mix) - set(DEFAULT_MIX)
+        if unknown:
+            raise ValueError(f'unknown query types {sorted(unknown)}')
+        self.concurrency = concurrency
+        self.duration = duration
+        self.seed = seed
+        self.run_seed = run_seed
+        self.run_number = run_number
+        self.histograms = {query: latency.LatencyHistogram() for query in self.mix}
+        self.errors = {query: 0 for query in self.mix}
+        self._errors_lock = threading.Lock()
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def __str__(self):
+        return f'WorkloadDriver:{len(self.index)} patients; mix: {self.mix}'
+
+    @staticmethod
+    def __repr__():
+        return 'WorkloadDriver(index)'
+
+    @staticmethod
+    def parse_mix(text):
+        """Parses 'patient_name=3,observation=4' into a mix dictionary."""
+        mix = {}
+        for item in text.split(','):
+            query, weight = item.split('=')
+            mix[query.strip()] = float(weight)
+        return mix
+
+    @staticmethod
+    def _vital(name, gender, random_state):
+        """Value of a vital from the generators GenerateObservationDict uses."""
+        if name in ('sbp', 'dbp', 'hr'):
+            return dict(zip(('sbp', 'dbp', 'hr'), generatebase.GenerateBase._generate_vitals(random_state)))[name]
+        height, weight = generatebase.GenerateBase._generate_height_weight(gender, random_state)
+        return round(height if name == 'height' else weight, 1)
+
+    def _identifier(self, patient_key, key):
+        Identifier = ident.Identifier()
+        Identifier.system = generatebase.GenerateBase.identifier_system
+        if self.run_seed is None or self.seed is None:
+            Identifier.value = f'urn:uuid:{uuid.uuid4()}'
+        else:
+            Identifier.value = generatebase.GenerateBase.identifier_value(self.run_seed, patient_key, key)
+        return Identifier
+
+    def _request(self, query, i, random_state, key=None):
+        """
+        Builds the request of a query type for patient row i.
+
+        :param key: key of a written Observation within the patient graph
+        :returns: method, url, request kwargs
+        """
+        base = generatebase.GenerateBase.server_url
+        index = self.index
+        if query == 'patient_name':
+            return 'get', f'{base}Patient', {'params': {'family': index.family[i], 'given': index.given[i]}}
+        if query == 'patient_birthdate':
+            return 'get', f'{base}Patient', {'params': {'birthdate': str(index.birthdate[i])}}
+        if query == 'observation':
+            template = observationtemplates.CATALOGUE[VITALS[random_state.randint(len(VITALS))]]
+            return 'get', f'{base}Observation', {'params': {'patient': index.patient_id[i], 'code': f'{template.system}|{template.code}'}}
+        if query == 'condition':
+            return 'get', f'{base}Condition', {'params': {'patient': index.patient_id[i]}}
+        name = VITALS[random_state.randint(len(VITALS))]
+        measurement = observationtemplates.CATALOGUE[name].fill(self._vital(name, index.gender_name(i), random_state))
+        Observation = records.ObservationRecord(name, measurement, timestamps.DEFAULT.render(datetime.datetime.now()),
+                                                records.ExistingRecord('Patient', index.patient_id[i]), records.ExistingRecord('Practitioner', index.practitioner_id[i]))
+        Identifier = self._identifier(int(index.patient_key[i]), f'{key}/{name}')
+        Observation.identifier = [Identifier]
+        headers = {'Content-Type': 'application/json+fhir', 'If-None-Exist': f'identifier={Identifier.system}|{Identifier.value}'}
+        return 'post', f'{base}Observation', {'data': json.dumps(Observation.to_fhir().as_json()), 'headers': headers}
+
+    def _client(self, client_id, deadline):
+        random_state = np.random.RandomState(None if self.seed is None else self.seed + client_id)
+        queries = list(self.mix)
+        weights = np.array([self.mix[q] for q in queries], dtype=float)
+        weights /= weights.sum()
+        writes = 0
+        while time.monotonic() < deadline:
+            query = queries[random_state.choice(len(queries), p=weights)]
+            i = self.index.sample(1, random_state)[0]
+            if query == 'write':
+                writes += 1
+            method, url, kwargs = self._request(query, i, random_state, key=f'Workload{self.seed}/{self.run_number}/{client_id}/{writes}')
+            start = time.monotonic()
+            try:
+                failed = self.session.request(method, url, **kwargs).status_code >= 400
+            except requests.exceptions.RequestException:
+                failed = True
+            self.histograms[query].record(time.monotonic() - start)
+            if failed:
+                with self._errors_lock:
+                    self.errors[query] += 1
+
+    def run(self):
+        """
+        Runs the workload.
+
+        :returns: report dictionary in the same layout as LoadDriver.report()
+        """
+        start = time.monotonic()
+        deadline = start + self.duration
+        clients = [threading.Thread(target=self._client, args=(i, deadline)) for i in range(self.concurrency)]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        self.elapsed = time.monotonic() - start
+
+        report = {}
+        total = latency.LatencyHistogram()
+        for query, histogram in self.histograms.items():
+            report[query] = dict(histogram.summary(), errors=self.errors[query], rps=histogram.total/self.elapsed)
+            total.merge(histogram)
+        report['all'] = dict(total.summary(), errors=sum(self.errors.values()), rps=total.total/self.elapsed)
+        return report
+
+
+def main(args):
+    """Runs the workload subcommand of fpargenerator."""
+    index = cohortindex.CohortIndex.from_journal(args.journal)
+    runlog.event(log, 'cohort', '%s', index, patients=len(index))
+    with runjournal.RunJournal(args.journal) as journal:
+        run_seed = journal.get_setting('seed')
+        # advanced before the run, so an interrupted run's writes are never matched by the next one
+        run_number = int(journal.get_setting('workload_runs', 0))
+        journal.set_setting('workload_runs', run_number + 1)
+    mix = WorkloadDriver.parse_mix(args.mix) if args.mix else None
+    driver = WorkloadDriver(index, mix=mix, concurrency=args.concurrency, duration=args.duration, seed=args.seed,
+                            run_seed=int(run_seed) if run_seed is not None else None, run_number=run_number)
+    loaddriver.LoadDriver.print_report(driver.run())